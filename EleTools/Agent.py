@@ -0,0 +1,317 @@
+import os
+import json
+import errno
+import time
+import socket
+import urllib2
+import logging
+import threading
+import SocketServer
+import BaseHTTPServer
+
+class Agent(object):
+    """ Keep a local instance inventory fresh, and answer queries about it
+
+    Remote systems normally learn about local instances by invoking CLI
+    tools over SSH, each of which has to start Python and discover every
+    instance again. Instead, an Agent keeps an Environment in memory and
+    refreshes it in the background, so queries can be answered directly
+    from the current inventory.
+
+    Queries are plain dictionaries with a 'command' key, and responses are
+    dictionaries that can be serialized as JSON. Recognized commands:
+
+    * list: Describe every known instance.
+    * get: Describe the instance on the given 'port'.
+    * refresh: Discover instances again right away, then list them.
+
+    The serve_unix and serve_http methods expose these commands on a local
+    UNIX socket or a loopback HTTP port, respectively.
+    """
+
+    interval = 60
+
+    def __init__(self, env, interval = None, workers = None, timeout = None):
+        """ Prepare an Agent for the given Environment
+
+        :param env: Environment object to keep refreshed.
+        :param interval: Seconds between background refreshes. Default: 60.
+        :param workers: Number of instances to probe concurrently. See
+            Environment.discover.
+        :param timeout: Seconds before any concurrent probe is abandoned.
+            See Environment.discover.
+        """
+
+        self.env = env
+        self.workers = workers
+        self.timeout = timeout
+        self.refreshed = None
+        self.instances = {}
+
+        if interval:
+            self.interval = float(interval)
+
+        self.__lock = threading.Lock()
+        self.__stop = threading.Event()
+        self.__thread = None
+
+
+    def start(self):
+        """ Discover instances, then keep refreshing them in the background
+        """
+
+        self.refresh()
+
+        self.__thread = threading.Thread(target = self.__loop)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+
+    def stop(self):
+        """ Stop the background refresh thread. """
+
+        self.__stop.set()
+
+        if self.__thread:
+            self.__thread.join()
+
+
+    def refresh(self):
+        """ Discover instances right away
+
+        Only one refresh runs at a time. Queries received in the meantime
+        are answered from the previous inventory. That inventory holds a
+        description of each instance taken once discovery finished, rather
+        than the live Instance objects the next refresh updates.
+        """
+
+        with self.__lock:
+            self.env.discover(self.workers, self.timeout, incremental = True)
+            self.instances = dict(
+                (port, inst.describe())
+                for port, inst in self.env.instances.items()
+            )
+            self.refreshed = time.time()
+
+
+    def handle(self, request):
+        """ Answer a single inventory query
+
+        :param request: Dictionary with a 'command' key, and any arguments
+            that command needs.
+
+        :retval dict: Response with 'refreshed' and either 'instances',
+            'instance', or 'error' keys.
+        """
+
+        command = request.get('command', 'list')
+
+        if command == 'refresh':
+            self.refresh()
+            command = 'list'
+
+        response = {'refreshed': self.refreshed}
+
+        # A refresh replaces the inventory with new descriptions rather
+        # than changing the old ones, so a reference taken here remains
+        # consistent while it's answered.
+
+        instances = self.instances
+
+        if command == 'list':
+            response['instances'] = instances.values()
+        elif command == 'get':
+            inst = instances.get(str(request.get('port')))
+            if inst:
+                response['instance'] = inst
+            else:
+                response['error'] = "No instance on port %s" % \
+                    request.get('port')
+        else:
+            response['error'] = "Unknown command: %s" % command
+
+        return response
+
+
+    def serve_unix(self, path):
+        """ Answer queries on a local UNIX socket until interrupted
+
+        Clients send one JSON request per line, and receive one JSON
+        response per line in return. Access is limited to the user running
+        the agent, since the socket is only accessible by its owner.
+
+        The socket must be in a private directory, since anyone who can
+        write to the directory could replace it with their own. A missing
+        directory is created with mode 0700. An existing one must belong
+        to the current user, and must not be writable by anyone else.
+
+        :param path: Full path of the socket file to create.
+
+        :raises OSError: If the socket directory isn't private.
+        """
+
+        agent = self
+
+        class Handler(SocketServer.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    if not line.strip():
+                        continue
+
+                    try:
+                        response = agent.handle(json.loads(line))
+                    except Exception, e:
+                        response = {'error': str(e)}
+
+                    self.wfile.write(json.dumps(response) + '\n')
+                    self.wfile.flush()
+
+        class Server(SocketServer.ThreadingMixIn,
+                     SocketServer.UnixStreamServer):
+            daemon_threads = True
+
+        sock_dir = os.path.dirname(os.path.abspath(path))
+
+        if not os.path.isdir(sock_dir):
+            os.makedirs(sock_dir, 0700)
+
+        info = os.stat(sock_dir)
+
+        if info.st_uid != os.getuid() or info.st_mode & 0022:
+            raise OSError(errno.EPERM, ("Socket directory %s must belong " +
+                "to this user, and not be writable by others") % sock_dir)
+
+        if os.path.exists(path):
+            os.unlink(path)
+
+        old_mask = os.umask(0077)
+
+        try:
+            server = Server(path, Handler)
+        finally:
+            os.umask(old_mask)
+
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            os.unlink(path)
+
+
+    def serve_http(self, port, address = '127.0.0.1'):
+        """ Answer queries over HTTP until interrupted
+
+        The following requests are recognized, and answered with JSON:
+
+        * GET /instances: List every known instance.
+        * GET /instances/<port>: Describe the instance on one port.
+        * POST /refresh: Discover instances again, then list them.
+
+        :param port: Port number to listen on.
+        :param address: Address to listen on. Default: loopback only.
+        """
+
+        agent = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                parts = self.path.strip('/').split('/')
+
+                if parts[0] != 'instances' or len(parts) > 2:
+                    return self.reply(404, {'error': 'Not found'})
+
+                if len(parts) == 2:
+                    request = {'command': 'get', 'port': parts[1]}
+                else:
+                    request = {'command': 'list'}
+
+                self.answer(request)
+
+            def do_POST(self):
+                if self.path.strip('/') != 'refresh':
+                    return self.reply(404, {'error': 'Not found'})
+
+                self.answer({'command': 'refresh'})
+
+            def answer(self, request):
+                response = agent.handle(request)
+                self.reply('error' in response and 404 or 200, response)
+
+            def reply(self, code, response):
+                body = json.dumps(response)
+
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug(format, *args)
+
+        class Server(SocketServer.ThreadingMixIn,
+                     BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+        server = Server((address, int(port)), Handler)
+
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+
+
+    def __loop(self):
+        """ Refresh the inventory every interval until stopped. """
+
+        while not self.__stop.wait(self.interval):
+            try:
+                self.refresh()
+            except Exception, e:
+                logging.error("Inventory refresh failed: %s", e)
+
+
+def query(request, path = None, port = None, timeout = 30):
+    """ Send a single query to a running Agent
+
+    :param request: Dictionary with a 'command' key; see Agent.handle.
+    :param path: Full path to the agent's UNIX socket.
+    :param port: Loopback HTTP port of the agent, if not using a socket.
+    :param timeout: Seconds to wait for a response. Default: 30.
+
+    :retval dict: The decoded response from the agent.
+    """
+
+    if path:
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.settimeout(timeout)
+        client.connect(path)
+
+        try:
+            client.sendall(json.dumps(request) + '\n')
+            response = client.makefile('r').readline()
+        finally:
+            client.close()
+
+        return json.loads(response)
+
+    url = 'http://127.0.0.1:%s/instances' % port
+    data = None
+
+    if request.get('command') == 'get':
+        url += '/%s' % request.get('port')
+    elif request.get('command') == 'refresh':
+        url = 'http://127.0.0.1:%s/refresh' % port
+        data = ''
+
+    try:
+        response = urllib2.urlopen(url, data, timeout)
+    except urllib2.HTTPError, e:
+        response = e
+
+    return json.load(response)
+
+
+# Set up the object and external callables.
+
+__all__ = ['Agent', 'query']
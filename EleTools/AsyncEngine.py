@@ -0,0 +1,518 @@
+import sys
+import time
+import select
+import logging
+import functools
+import psycopg2
+import psycopg2.extensions
+
+from EleTools.Instance import async_connect
+from EleTools.QueryRegistry import QueryRegistry
+from EleTools.Metrics import metrics
+
+class AsyncEngine(object):
+    """ Probe instances and check them in upstream from a single thread
+
+    Probing an instance is almost entirely waiting on the network, so on
+    hosts with dozens of clusters, a thread for each probe mostly costs
+    memory and context switches. This engine instead opens asynchronous
+    psycopg2 connections, and waits on all of them at once with select.
+    Each probe runs the same QueryRegistry queries an Instance would run on
+    its own, and fills in the Instance the same way, so the results are
+    identical.
+
+    Upstream check-ins run on the same loop, over an asynchronous connection
+    to each upstream system, so instances are sent while others are still
+    being probed. No more than 'concurrency' probes and check-ins run at
+    once.
+
+    To use it, set an Environment's 'engine' attribute to an AsyncEngine.
+    Discovery then builds every Instance without connecting, and leaves
+    the probing to the engine. Connections to each instance are kept
+    between probes, so refreshes don't need to connect again; call close
+    when finished with the engine.
+
+    Queries are never prepared here, since asynchronous connections can only
+    run one statement at a time, and the saving is small next to the cost
+    of the round trips themselves.
+
+    libpq ignores connect_timeout for asynchronous connections, so every
+    probe and check-in gets a deadline instead. Unless one is given, it's
+    the connect timeout plus the statement timeout of the instance or
+    upstream system involved.
+    """
+
+    concurrency = 32
+
+    def __init__(self, concurrency = None):
+        """ Start with an empty event loop
+
+        :param concurrency: Most probes and check-ins to run at once.
+            Default: 32.
+        """
+
+        if concurrency:
+            self.concurrency = int(concurrency)
+
+        self.__upstreams = {}
+        self.__conns = {}
+        self.__waiting = []
+        self.__running = []
+
+
+    def close(self):
+        """ Close every retained instance and upstream connection. """
+
+        for port in list(self.__conns):
+            self.__drop(port)
+
+        for key in list(self.__upstreams):
+            self.__drop_upstream(key)
+
+
+    def probe_all(self, jobs, timeout = None):
+        """ Probe several instances at once, yielding each as it's ready
+
+        Full probes gather everything an Instance gathers when it connects:
+        version, role, xlog position, standbys, and databases. Otherwise,
+        only what Instance.refresh polls is gathered. Any retained
+        connection to an instance that isn't listed is closed.
+
+        Errors are recorded on each Instance just as if it had connected
+        itself. Any probe that runs past its deadline is abandoned, and its
+        instance is marked offline.
+
+        :param jobs: List of (Instance, full) tuples, where 'full' is True
+            for newly built instances.
+        :param timeout: Seconds a probe may run before it's abandoned.
+            Default: the instance's connect and statement timeouts combined.
+
+        :retval generator: Yields each Instance once its probe is finished.
+        """
+
+        ports = set(inst.port for inst, full in jobs)
+
+        for port in list(self.__conns):
+            if port not in ports:
+                self.__drop(port)
+
+        finished = []
+
+        for inst, full in jobs:
+            pool = inst.databases
+
+            self.__submit(self.__probe(inst, full),
+                timeout or self.__limit(pool.connect_timeout,
+                    pool.statement_timeout),
+                functools.partial(self.__probed, inst, time.time(), finished),
+                functools.partial(self.__probe_failed, inst, finished))
+
+        for count in range(len(jobs)):
+            while not finished:
+                self.__step()
+
+            yield finished.pop(0)
+
+
+    def report(self, env, reporters, timeout = None, incremental = False,
+        prune = True, errors = None):
+        """ Discover local instances, and send any changes upstream
+
+        This works like Reporter.transmit_stream, except that check-ins are
+        sent from the event loop rather than a separate thread. Whenever a
+        check-in is underway, any changes found in the meantime are gathered
+        into the next one.
+
+        Several upstream systems can be reported to at once, each with its
+        own Reporter, as with ReporterGroup. Each upstream is checked in
+        separately, so one that is slow or down never holds up the others.
+
+        If a check-in fails, the remaining instances are still probed, but
+        not sent to that upstream. Once every probe and check-in is finished,
+        the state of every other upstream is saved, and the first error is
+        raised.
+
+        :param env: Environment to discover instances with. Its 'engine'
+            attribute should be this engine.
+        :param reporters: Reporter for the upstream system, or a dictionary
+            of Reporters keyed by label. Only their state and upstream
+            configuration are used, not their connections.
+        :param timeout: Seconds any single probe may take. See probe_all.
+        :param incremental: See Environment.discover.
+        :param prune: See Reporter.transmit.
+        :param errors: Dictionary to fill with the sys.exc_info() of every
+            upstream that failed, keyed by label. If given, failures are left
+            to the caller, rather than logged and raised.
+
+        :retval mixed: Number of instances transmitted, or a dictionary of
+            them keyed by label if several Reporters were given.
+        """
+
+        group = reporters
+        if not isinstance(reporters, dict):
+            group = {None: reporters}
+
+        statuses = dict(
+            (label, {'pending': [], 'busy': False, 'sent': 0, 'error': None})
+            for label in group
+        )
+        current = []
+
+        for info in env.iter_snapshots(None, timeout, incremental):
+            if info.invalid:
+                continue
+
+            current.append((info.name, info.port))
+
+            for label, reporter in group.items():
+                change = reporter.change(info)
+                if change:
+                    statuses[label]['pending'].append(change)
+                    self.__send(reporter, statuses[label])
+
+        while [s for s in statuses.values() if s['busy']]:
+            self.__step()
+
+        error = None
+
+        for label, status in sorted(statuses.items()):
+            if not status['error']:
+                group[label].save(current, prune)
+                continue
+
+            if errors is not None:
+                errors[label] = status['error']
+                continue
+
+            if label is not None:
+                logging.error("Could not report to %s: %s", label,
+                    status['error'][1])
+
+            error = error or status['error']
+
+        if error:
+            raise error[0], error[1], error[2]
+
+        if group is not reporters:
+            return statuses[None]['sent']
+
+        return dict(
+            (label, status['sent']) for label, status in statuses.items()
+        )
+
+
+    def __probe(self, inst, full):
+        """ Poll one instance, waiting on its connection at every step
+
+        This generator yields a connection whenever it needs the loop to
+        wait for that connection to finish connecting or running a query.
+
+        :param inst: Instance to fill in.
+        :param full: Gather everything, rather than only volatile fields.
+        """
+
+        conn = self.__conns.get(inst.port)
+
+        if full or conn is None or conn.closed:
+            self.__drop(inst.port)
+
+            pool = inst.databases
+            conn = async_connect('localhost', pool.user, 'template1',
+                inst.port, pool.connect_timeout, pool.statement_timeout)
+            self.__conns[inst.port] = conn
+
+            yield conn
+
+        inst.online = True
+        sql = QueryRegistry(conn)
+        cur = conn.cursor()
+
+        if full:
+            cur.execute(sql.get('status'))
+            yield conn
+            inst.set_status(*cur.fetchone())
+        else:
+            cur.execute(sql.get('poll'))
+            yield conn
+            inst.set_status(None, *cur.fetchone())
+
+        cur.execute(sql.get('replication'))
+        yield conn
+        rows = cur.fetchall()
+        conninfo = None
+
+        if inst.role == 'slave' and sql.supports('wal_receiver'):
+            cur.execute(sql.get('wal_receiver'))
+            yield conn
+            row = cur.fetchone()
+            conninfo = row and row[0]
+
+        inst.set_replication(rows, conninfo)
+
+        if full:
+            cur.execute(sql.get('databases'))
+            yield conn
+            inst.databases.reset(row[0] for row in cur.fetchall())
+
+        inst.error = None
+
+
+    def __probed(self, inst, start, finished):
+        """ Note a finished probe. """
+
+        metrics.record('instance_probe', time.time() - start,
+            port = inst.port)
+
+        finished.append(inst)
+
+
+    def __probe_failed(self, inst, finished, error):
+        """ Record a failed probe on its Instance
+
+        As with Instance itself, only connection problems mean the instance
+        is offline. Any other database error means a query failed.
+        """
+
+        self.__drop(inst.port)
+
+        if (not isinstance(error, psycopg2.Error) or
+            isinstance(error, psycopg2.OperationalError)):
+            inst.online = False
+
+        inst.error = error
+        finished.append(inst)
+
+
+    def __send(self, reporter, status):
+        """ Start a check-in with every pending change, unless one is busy
+
+        :param reporter: Reporter that produced the changes.
+        :param status: Dictionary tracking pending changes, whether a
+            check-in is busy, how many were sent, and any error.
+        """
+
+        if status['busy'] or status['error'] or not status['pending']:
+            return
+
+        changed = status['pending']
+        status['pending'] = []
+        status['busy'] = True
+
+        def done():
+            status['busy'] = False
+            status['sent'] += len(changed)
+            self.__send(reporter, status)
+
+        # Check-ins fail either with an exception, while it's being handled,
+        # or with a message when they pass their deadline.
+
+        def failed(error):
+            status['busy'] = False
+            status['error'] = sys.exc_info()
+
+            if isinstance(error, basestring):
+                status['error'] = (psycopg2.OperationalError,
+                    psycopg2.OperationalError(error), None)
+
+            self.__drop_upstream(self.__upstream_key(reporter))
+
+        self.__submit(self.__checkin(reporter, changed),
+            self.__limit(reporter.connect_timeout, reporter.statement_timeout),
+            done, failed, 'Check-in')
+
+
+    def __checkin(self, reporter, changed):
+        """ Send one batch of changes upstream
+
+        Like __probe, this generator yields the upstream connection whenever
+        the loop should wait on it.
+        """
+
+        start = time.time()
+        key = self.__upstream_key(reporter)
+        conn = self.__upstreams.get(key)
+
+        if conn is None or conn.closed:
+            logging.debug("Connecting to %s", reporter.conf.db_host)
+
+            conn = async_connect(*key + (reporter.connect_timeout,
+                reporter.statement_timeout))
+            self.__upstreams[key] = conn
+
+            yield conn
+
+        cur = conn.cursor()
+        cur.execute(*reporter.checkin_call(changed))
+
+        yield conn
+
+        reporter.record(changed, cur.fetchone()[0])
+        metrics.record('checkin', time.time() - start)
+
+
+    def __submit(self, steps, timeout, done, failed, name = 'Probe'):
+        """ Queue a generator to run on the loop
+
+        :param steps: Generator yielding connections to wait on.
+        :param timeout: Seconds it may run before it's abandoned, if any.
+        :param done: Called with no arguments when it finishes.
+        :param failed: Called with the exception, or a message, if it fails.
+        :param name: What the task is, for the deadline message.
+            Default: Probe.
+        """
+
+        self.__waiting.append(dict(steps = steps, timeout = timeout,
+            done = done, failed = failed, conn = None, wait = None,
+            deadline = None, name = name))
+
+
+    def __step(self):
+        """ Start queued tasks, and wait once for any of them to progress
+
+        Each wait lasts until at least one connection is ready, or the
+        earliest deadline passes.
+        """
+
+        while self.__waiting and len(self.__running) < self.concurrency:
+            task = self.__waiting.pop(0)
+
+            if task['timeout']:
+                task['deadline'] = time.time() + task['timeout']
+
+            self.__running.append(task)
+            self.__advance(task)
+
+        if not self.__running:
+            return
+
+        readers = {}
+        writers = {}
+
+        for task in self.__running:
+            if task['wait'] == psycopg2.extensions.POLL_READ:
+                readers[task['conn'].fileno()] = task
+            elif task['wait'] == psycopg2.extensions.POLL_WRITE:
+                writers[task['conn'].fileno()] = task
+
+        wait = None
+        deadlines = [t['deadline'] for t in self.__running if t['deadline']]
+
+        if deadlines:
+            wait = max(0, min(deadlines) - time.time())
+
+        # A signal, such as SIGHUP to a daemon, can interrupt the wait. In
+        # that case, simply check the deadlines and wait again next time.
+
+        try:
+            (ready_r, ready_w, ready_x) = select.select(
+                readers.keys(), writers.keys(), [], wait)
+        except select.error:
+            (ready_r, ready_w) = ([], [])
+
+        for fd in ready_r:
+            self.__advance(readers[fd])
+
+        for fd in ready_w:
+            self.__advance(writers[fd])
+
+        now = time.time()
+
+        for task in list(self.__running):
+            if task['deadline'] and now >= task['deadline']:
+                task['steps'].close()
+                self.__finish(task, task['failed'],
+                    '%s exceeded %s second deadline' % (task['name'],
+                        task['timeout']))
+
+
+    def __advance(self, task):
+        """ Run a task until it has to wait on a connection, or finishes
+
+        :param task: Task dictionary, as queued by __submit.
+        """
+
+        try:
+            while True:
+                if task['conn'] is None:
+                    task['conn'] = task['steps'].next()
+
+                task['wait'] = task['conn'].poll()
+
+                if task['wait'] != psycopg2.extensions.POLL_OK:
+                    return
+
+                task['conn'] = None
+
+        except StopIteration:
+            self.__finish(task, task['done'])
+
+        except Exception, e:
+            task['steps'].close()
+            self.__finish(task, task['failed'], e)
+
+
+    def __finish(self, task, callback, *args):
+        """ Take a task off the loop, and call its callback. """
+
+        if task in self.__running:
+            self.__running.remove(task)
+
+        callback(*args)
+
+
+    def __limit(self, connect_timeout, statement_timeout):
+        """ Choose a deadline from connection timeouts
+
+        :param connect_timeout: Seconds allowed for connecting, if limited.
+        :param statement_timeout: Seconds allowed per statement, if limited.
+
+        :retval float: Both timeouts combined, or None if neither is set.
+        """
+
+        if not (connect_timeout or statement_timeout):
+            return None
+
+        return (connect_timeout or 0) + (statement_timeout or 0)
+
+
+    def __upstream_key(self, reporter):
+        """ Identify the upstream system of a Reporter
+
+        Connections are kept by upstream, rather than by Reporter, so they
+        survive Reporters being rebuilt, such as when a daemon reloads.
+
+        :retval tuple: async_connect arguments for the upstream system.
+        """
+
+        conf = reporter.conf
+
+        return (conf.db_host, conf.db_user, conf.db_name, conf.db_port)
+
+
+    def __drop_upstream(self, key):
+        """ Close and forget the connection to one upstream system. """
+
+        conn = self.__upstreams.pop(key, None)
+
+        if conn is not None and not conn.closed:
+            try:
+                conn.close()
+            except psycopg2.Error:
+                pass
+
+
+    def __drop(self, port):
+        """ Close and forget the retained connection to one instance. """
+
+        conn = self.__conns.pop(port, None)
+
+        if conn is not None and not conn.closed:
+            try:
+                conn.close()
+            except psycopg2.Error:
+                pass
+
+
+# Set up the object and external callables.
+
+__all__ = ['AsyncEngine']
@@ -25,10 +25,16 @@ class Config:
     in text substitution. The same config file would allow this usage:
 
     print "Host: %(db_host)" % config.local
+
+    Sections listed as repeatable may also appear any number of times with a
+    label, such as [Local:backup]. Each copy starts with the same defaults,
+    and all of them, including the unlabeled one, are available through the
+    'sections' method.
     """
 
     config_file = None
     pattern = {}
+    repeat = ()
 
     class Container:
         """ Basic raw container for section config elements.
@@ -52,7 +58,7 @@ class Config:
             return None
 
 
-    def __init__(self, config_file, pattern):
+    def __init__(self, config_file, pattern, repeat = ()):
         """ Checks for, and Reads a Specified Config File
 
         In order for CLI operations to remain consistent across all operations,
@@ -63,6 +69,8 @@ class Config:
         :param config_file: Full path to desired config file.
         :param pattern: Dictionary of sections and fields to search for in
             indicated config file.
+        :param repeat: Names of sections in 'pattern' that may also appear
+            with a label, as [Name:label]. Default: none.
         """
 
         if not os.path.isfile(config_file):
@@ -70,6 +78,8 @@ class Config:
 
         self.config_file = config_file
         self.pattern = pattern
+        self.repeat = tuple(repeat)
+        self.__labeled = {}
         self.__read_config()
 
 
@@ -108,6 +118,43 @@ class Config:
 
             self.__dict__[sect] = cont
 
+        # Labeled copies of repeatable sections only get the defaults of the
+        # section they copy, so fill in anything they leave out.
+
+        for section in conf_parse.sections():
+            (name, colon, label) = section.partition(':')
+
+            if not colon or name not in self.repeat:
+                continue
+
+            cont = self.Container()
+
+            for option, value in self.pattern[name].items():
+                if not conf_parse.has_option(section, option):
+                    conf_parse.set(section, option, value)
+
+                cont.__dict__[option] = conf_parse.get(section, option)
+
+            self.__labeled[section] = cont
+
+
+    def sections(self, name):
+        """ Get every copy of a repeatable section
+
+        :param name: Name of the section, as listed in the pattern.
+
+        :retval dict: Section containers keyed by full section name, such
+            as 'Local' and 'Local:backup'.
+        """
+
+        found = {name: self.__dict__[name.lower()]}
+
+        for section, cont in self.__labeled.items():
+            if section.partition(':')[0] == name:
+                found[section] = cont
+
+        return found
+
 
 # Set up the object and external callables.
 
@@ -0,0 +1,175 @@
+import os
+import errno
+import struct
+
+class ControlData(object):
+    """ Read PostgreSQL cluster state directly from its data directory
+
+    Much like the pg_controldata utility, this class decodes the binary
+    global/pg_control file for an instance, along with its postmaster.pid
+    lock file. This provides the cluster state, checkpoint locations,
+    timeline, and system identifier without connecting to the instance,
+    so it works even when the instance is down or won't accept connections.
+
+    The pg_control file is written in the native byte order of the server,
+    and its layout depends on the pg_control version. Only the leading
+    fields, which have remained at stable offsets, are decoded here.
+    """
+
+    pid = None
+    port = None
+    start_time = None
+    running = False
+
+    system_identifier = None
+    control_version = None
+    catalog_version = None
+    state = None
+    checkpoint_time = None
+    checkpoint_lsn = None
+    redo_lsn = None
+    timeline = None
+
+    error = None
+
+    # Cluster states, indexed by the DBState enum in pg_control. Versions
+    # prior to 9.2 lacked the 'shut down in recovery' state.
+
+    states = (
+        'starting up', 'shut down', 'shut down in recovery', 'shutting down',
+        'in crash recovery', 'in archive recovery', 'in production',
+    )
+
+    old_states = (
+        'starting up', 'shut down', 'shutting down', 'in crash recovery',
+        'in archive recovery', 'in production',
+    )
+
+    recovery_states = ('shut down in recovery', 'in archive recovery')
+
+    def __init__(self, pgdata):
+        """ Read the pid and control files for the given data directory
+
+        Neither file is required. A missing postmaster.pid simply means the
+        instance isn't running. If pg_control can't be read or decoded, the
+        reason is stored in the 'error' attribute.
+
+        :param pgdata: Full path to the instance data directory.
+        """
+
+        self.pgdata = pgdata
+
+        self.__read_pid()
+
+        try:
+            self.__read_control()
+        except (IOError, struct.error), e:
+            self.error = e
+
+
+    def in_recovery(self):
+        """ Check whether the control file indicates a replica
+
+        :retval bool: True if the cluster is, or was shut down, in recovery.
+        """
+
+        return self.state in self.recovery_states
+
+
+    def __read_pid(self):
+        """ Read the postmaster.pid file, if the instance is running
+
+        The lock file lists the postmaster PID, data directory, start time,
+        and port on its first four lines. Older versions only provide the
+        first two. Since a crashed instance can leave a stale file behind,
+        we also check whether the listed process actually exists.
+        """
+
+        try:
+            with open(os.path.join(self.pgdata, 'postmaster.pid')) as x:
+                lock_data = [line.strip() for line in x.readlines()]
+        except IOError:
+            return
+
+        try:
+            self.pid = int(lock_data[0])
+
+            if len(lock_data) > 3:
+                self.start_time = int(lock_data[2])
+                self.port = int(lock_data[3])
+        except (IndexError, ValueError):
+            return
+
+        try:
+            os.kill(self.pid, 0)
+            self.running = True
+        except OSError, e:
+            self.running = (e.errno == errno.EPERM)
+
+
+    def __read_control(self):
+        """ Decode the leading fields of the global/pg_control file
+
+        The fields we need are laid out as follows in every version since
+        8.4, with 8-byte alignment:
+
+        * 0: System identifier (uint64)
+        * 8: pg_control version (uint32)
+        * 12: Catalog version (uint32)
+        * 16: Cluster state (enum)
+        * 24: Time of last update (int64)
+        * 32: Latest checkpoint location
+        * 40: Prior checkpoint location (removed in 11)
+        * 40/48: Copy of the latest checkpoint record, which starts with
+          the redo location, followed by the timeline.
+        """
+
+        control_file = os.path.join(self.pgdata, 'global', 'pg_control')
+
+        with open(control_file, 'rb') as x:
+            data = x.read(64)
+
+        (self.system_identifier, self.control_version, self.catalog_version,
+         state, self.checkpoint_time) = struct.unpack_from('=QIIi4xq', data)
+
+        state_list = self.states
+        if self.control_version < 922:
+            state_list = self.old_states
+
+        if 0 <= state < len(state_list):
+            self.state = state_list[state]
+
+        copy_offset = 48
+        if self.control_version >= 1100:
+            copy_offset = 40
+
+        self.checkpoint_lsn = self.__lsn(data, 32)
+        self.redo_lsn = self.__lsn(data, copy_offset)
+        (self.timeline,) = struct.unpack_from('=I', data, copy_offset + 8)
+
+
+    def __lsn(self, data, offset):
+        """ Decode a WAL location as a 64-bit byte position
+
+        Before 9.3, locations were stored as two 32-bit integers: the log
+        ID followed by the record offset, and each log ID only spanned 255
+        16MB segments. Since then, they're a single 64-bit integer.
+
+        :param data: Raw bytes from the control file.
+        :param offset: Byte offset of the location within data.
+
+        :retval int: Location as a byte position, comparable to the output
+            of pg_xlog_location_diff(location, '0/0').
+        """
+
+        if self.control_version < 930:
+            (xlogid, xrecoff) = struct.unpack_from('=II', data, offset)
+            return xlogid * 0xFF000000 + xrecoff
+
+        (lsn,) = struct.unpack_from('=Q', data, offset)
+        return lsn
+
+
+# Set up the object and external callables.
+
+__all__ = ['ControlData']
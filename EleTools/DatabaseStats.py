@@ -0,0 +1,255 @@
+import time
+import bisect
+import logging
+import functools
+import psycopg2
+
+from EleTools.Instance import run_parallel
+from EleTools.StateStore import StateStore
+from EleTools.Metrics import metrics
+
+# Size and bloat can only be measured from within each database. Bloat is a
+# rough estimate: the pages each table uses beyond what its live rows should
+# need, given the average row width from pg_stats, plus per-row and per-page
+# overhead. Tables that were never analyzed don't count toward it.
+
+DETAIL = """
+WITH widths AS (
+  SELECT schemaname, tablename,
+         sum((1 - null_frac) * avg_width) AS row_width
+    FROM pg_stats
+   GROUP BY schemaname, tablename
+),
+tables AS (
+  SELECT c.relpages,
+         greatest(0, c.relpages - ceil(c.reltuples * (w.row_width + 28) /
+             (current_setting('block_size')::INT - 24))) AS extra_pages,
+         s.n_dead_tup
+    FROM pg_class c
+    JOIN pg_namespace n ON (n.oid = c.relnamespace)
+    LEFT JOIN widths w ON (w.schemaname = n.nspname
+                           AND w.tablename = c.relname)
+    LEFT JOIN pg_stat_user_tables s ON (s.relid = c.oid)
+   WHERE c.relkind = 'r'
+     AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+)
+SELECT pg_database_size(current_database()),
+       count(*),
+       (coalesce(sum(relpages), 0) *
+           current_setting('block_size')::INT)::BIGINT,
+       (coalesce(sum(extra_pages), 0) *
+           current_setting('block_size')::INT)::BIGINT,
+       coalesce(sum(n_dead_tup), 0)::BIGINT
+  FROM tables
+"""
+
+class DatabaseStats(object):
+    """ Collect size, activity, and bloat statistics for every database
+
+    Activity counters for every database in an instance come from a single
+    query against pg_stat_database over the 'template1' connection, so
+    they're gathered on every collection. Sizes and bloat estimates are
+    another matter: each database must be connected to and examined
+    separately, which is far too slow on instances with hundreds of them.
+
+    Instead, each collection continues through the databases where the last
+    one stopped, and only examines as many as its time and query budgets
+    allow. The last results for every database are kept in a StateStore, so
+    the rotation and results survive between runs. Every collection returns
+    the freshest information for each database, along with when its counters
+    and its size were last gathered, as 'stats_time' and 'detail_time'.
+    """
+
+    time_budget = 5
+    query_budget = 10
+
+    stat_fields = (
+        'numbackends', 'xact_commit', 'xact_rollback', 'blks_read',
+        'blks_hit', 'tup_inserted', 'tup_updated', 'tup_deleted',
+        'temp_bytes', 'deadlocks',
+    )
+
+    detail_fields = (
+        'size_bytes', 'tables', 'table_bytes', 'bloat_bytes', 'dead_tuples',
+    )
+
+    def __init__(self, state_file, time_budget = None, query_budget = None):
+        """ Load previous results and rotation positions, if any
+
+        :param state_file: Full path to the file where results are stored.
+        :param time_budget: Most seconds to spend examining databases in
+            each instance per collection. Zero disables this limit.
+            Default: 5.
+        :param query_budget: Most databases to examine in each instance per
+            collection. Zero disables this limit. Default: 10.
+        """
+
+        self.store = StateStore(state_file)
+
+        if time_budget is not None:
+            self.time_budget = float(time_budget)
+
+        if query_budget is not None:
+            self.query_budget = int(query_budget)
+
+
+    def collect(self, inst):
+        """ Gather statistics for one instance, within the budget
+
+        Instances that are offline, or weren't connected to, aren't queried
+        at all; their last known results are returned instead.
+
+        :param inst: Instance to collect statistics for.
+
+        :retval list: A dictionary for each database, with 'database',
+            'stats_time', and 'detail_time' keys, plus stat_fields and
+            detail_fields. Anything not yet gathered is None.
+        """
+
+        (stamp, info) = self.store.get(inst.port)
+
+        if info is None:
+            info = {'cursor': None, 'databases': {}}
+
+        cached = info['databases']
+        names = sorted(inst.databases.keys())
+
+        if inst.probe and inst.online:
+            for name in list(cached):
+                if name not in names:
+                    del cached[name]
+
+            for name in names:
+                if name not in cached:
+                    cached[name] = dict.fromkeys(
+                        ('stats_time', 'detail_time') + self.stat_fields +
+                        self.detail_fields
+                    )
+
+            self.__collect_stats(inst, cached)
+            info['cursor'] = self.__collect_details(inst, cached, names,
+                info['cursor'])
+
+        self.store.update(inst.port, info)
+
+        return [
+            dict(cached[name], database = name) for name in sorted(cached)
+        ]
+
+
+    def collect_all(self, instances, workers = None, close = False):
+        """ Gather statistics for several instances, then save the results
+
+        :param instances: Iterable of Instance objects.
+        :param workers: Most instances to collect from at once. Default: 1.
+        :param close: Close each instance's connections once it's finished,
+            as one-off reports should. Default: False.
+
+        :retval dict: Lists of databases as returned by collect, keyed by
+            instance port.
+        """
+
+        tasks = [
+            functools.partial(self.__collect_one, inst, close)
+            for inst in instances
+        ]
+
+        stats = dict(run_parallel(tasks, workers or 1))
+
+        self.store.retain(stats.keys())
+
+        with metrics.timer('database_stats_save'):
+            self.store.save()
+
+        return stats
+
+
+    def __collect_one(self, inst, close):
+        """ Collect one instance for collect_all, closing it if requested. """
+
+        try:
+            return (inst.port, self.collect(inst))
+        finally:
+            if close:
+                inst.databases.close()
+
+
+    def __collect_stats(self, inst, cached):
+        """ Refresh the activity counters of every database at once
+
+        :param inst: Instance to query.
+        :param cached: Database results to update, keyed by name.
+        """
+
+        try:
+            with metrics.timer('database_stats', port = inst.port):
+                rows = inst.query('database_stats')
+        except psycopg2.Error, e:
+            logging.debug("Could not read database stats on port %s: %s",
+                inst.port, e)
+            return
+
+        now = time.time()
+
+        for row in rows:
+            if row[0] not in cached:
+                continue
+
+            cached[row[0]].update(zip(self.stat_fields, row[1:]))
+            cached[row[0]]['stats_time'] = now
+
+
+    def __collect_details(self, inst, cached, names, cursor):
+        """ Examine as many databases as the budget allows
+
+        Databases are visited in name order, starting after the one last
+        examined, and wrapping around. Each query may run for no longer than
+        the time remaining in the budget.
+
+        :param inst: Instance to query.
+        :param cached: Database results to update, keyed by name.
+        :param names: Sorted names of every database in the instance.
+        :param cursor: Name of the database last examined, if any.
+
+        :retval string: Name of the database examined last.
+        """
+
+        start = 0
+        if cursor is not None:
+            start = bisect.bisect_right(names, cursor)
+
+        deadline = time.time() + self.time_budget
+        limit = inst.databases.statement_timeout
+
+        for count, name in enumerate(names[start:] + names[:start]):
+            remaining = deadline - time.time()
+
+            if self.query_budget and count >= self.query_budget:
+                break
+
+            if self.time_budget and remaining < 0.001:
+                break
+
+            timeout = limit
+            if self.time_budget:
+                timeout = min(remaining, limit or remaining)
+
+            cursor = name
+
+            try:
+                with metrics.timer('database_detail', port = inst.port):
+                    row = inst.run(name, DETAIL, timeout = timeout)[0]
+            except (KeyError, psycopg2.Error), e:
+                logging.debug("Could not examine database %s on port %s: %s",
+                    name, inst.port, e)
+                continue
+
+            cached[name].update(zip(self.detail_fields, row))
+            cached[name]['detail_time'] = time.time()
+
+        return cursor
+
+
+# Set up the object and external callables.
+
+__all__ = ['DatabaseStats']
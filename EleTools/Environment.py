@@ -2,12 +2,20 @@
 import re
 import os
 import pwd
+import errno
+import time
+import Queue
 import getpass
+import functools
+import itertools
+import threading
+import psycopg2
 import subprocess
 
 from glob import glob
 from distutils import spawn
-from EleTools.Instance import Instance
+from EleTools.Instance import Instance, run_parallel
+from EleTools.Metrics import metrics
 
 class Environment(object):
     """ Mine a local server environment for PostgreSQL cluster instances
@@ -27,63 +35,871 @@ class Environment(object):
         '/var/run/postgresql',
     ]
 
+    debian_conf_dir = '/etc/postgresql'
+    use_lsclusters = False
+    watching = False
+    failures = None
+    engine = None
+    run_workers = 8
+
+    # Postgres refuses connections with these messages until it's ready for
+    # them. A probe that sees one hasn't failed; the instance is just still
+    # starting, so probe retries it for up to 'startup_wait' seconds.
+
+    startup_errors = (
+        'the database system is starting up',
+        'the database system is not yet accepting connections',
+    )
+    startup_wait = 10
+
     __blank = {
         'name': 'main', 'port': 5432, 'pgdata': '', 'online': False,
         'user': 'postgres', 'online': False, 'role': 'master', 
     }
 
 
-    def discover(self):
+    def __init__(self, **instance_opts):
+        """ Start with no detected instances
+
+        Keep detection results on each object, so a long-running process can
+        call discover repeatedly without other objects interfering.
+
+        Any keyword arguments are passed along to every Instance created
+        during discovery. This makes it possible to, for example, skip
+        connecting to instances entirely with probe=False, or read their
+        control files with control=True.
+
+        To stop probing instances that keep failing, set the 'failures'
+        attribute to a FailureTracker. Such instances are then reported as
+        offline without being contacted until their backoff expires. The
+        tracker is saved after each complete scan.
+
+        To probe every instance from a single thread, set the 'engine'
+        attribute to an AsyncEngine. Its concurrency limit then applies
+        instead of 'workers'.
+        """
+
+        self.detect = {}
+        self.instances = {}
+        self.sockets = {}
+        self.fingerprints = {}
+        self.instance_opts = instance_opts
+
+
+    def close(self):
+        """ Close every connection retained by discovered instances. """
+
+        for inst in self.instances.values():
+            inst.databases.close()
+
+        if self.engine:
+            self.engine.close()
+
+
+    def discover(self, workers = None, timeout = None, incremental = False):
         """ Check the current environment for PG instances
 
         Use any known socket directories, lock locations, distribution-based
         or otherwise influential methods for detecting Postgres instances on
         the local system. Use that information to fill an 'instances'
         attribute with Instance objects for each port detected.
+
+        In incremental mode, each detected instance is fingerprinted by its
+        detected settings, postmaster.pid file, and recovery configuration.
+        If the fingerprint matches the previous scan, the existing Instance
+        is kept and only its online state and xlog position are refreshed.
+
+        :param workers: Number of instances to probe concurrently. If not
+            set, instances are probed one after another.
+        :param timeout: Seconds any single concurrent probe may take before
+            it is abandoned, and the instance is reported as offline.
+            Only honored when workers is set. Default: no deadline.
+        :param incremental: Reuse unchanged instances from the previous
+            scan rather than rebuilding them. Default: False.
         """
 
-        self.__try_sockets()
-        self.__try_lsclusters()
+        for inst in self.iter_discover(workers, timeout, incremental):
+            pass
+
+
+    def iter_discover(self, workers = None, timeout = None,
+        incremental = False):
+        """ Check the current environment for PG instances, one at a time
+
+        This works exactly like discover, except each Instance is yielded
+        as soon as it is ready. Callers can act on each instance while
+        others are still being probed. The 'instances' attribute is only
+        complete once the generator is exhausted.
+
+        :param workers: See discover.
+        :param timeout: See discover.
+        :param incremental: See discover.
+
+        :retval generator: Yields Instance objects as they become ready.
+        """
+
+        previous = self.instances
+
+        self.detect = {}
+        self.instances = {}
+
+        if not self.watching:
+            with metrics.timer('socket_scan'):
+                self.scan_sockets()
+
+        for port, inst_env in self.sockets.items():
+            self.detect[port] = inst_env.copy()
+
+            # Once a scan has seen a stopped instance, the watcher has no
+            # reason to remember it, just as a fresh socket scan wouldn't.
+
+            if self.watching and not inst_env['online']:
+                del self.sockets[port]
+
+        with metrics.timer('debian_scan'):
+            known = self.__try_debian()
+
+        if self.use_lsclusters:
+            with metrics.timer('lsclusters'):
+                self.__try_lsclusters(known)
+
+        # Decide which instances can simply be refreshed, and which need to
+        # be built from scratch. Any connections retained by instances that
+        # are rebuilt or have disappeared can safely be closed.
+
+        tasks = []
+        prints = {}
+        jobs = []
+        keys = {}
+
+        # With an engine, instances are built without connecting, and the
+        # engine probes them all at once afterwards.
+
+        engine = self.engine
+        if not self.instance_opts.get('probe', True):
+            engine = None
 
         for port, inst_env in self.detect.items():
-            self.instances[port] = Instance(**inst_env)
+            inst = previous.pop(port, None)
+            fingerprint = self.__fingerprint(inst_env)
+
+            # Instances that keep failing are only contacted once their
+            # backoff expires. Until then, report them as offline.
+
+            if self.failures and not self.failures.should_probe(port,
+                fingerprint):
+                if inst is not None:
+                    inst.databases.close()
+
+                tasks.append((port, inst_env, functools.partial(
+                    self.__offline, inst_env, 'Not probed after %d failures'
+                    % self.failures.failures(port, fingerprint))))
+                continue
+
+            prints[port] = fingerprint
+
+            if (incremental and inst is not None and
+                self.fingerprints.get(port) == fingerprint):
+                if engine:
+                    inst.refresh(poll = False)
+                    jobs.append((inst, False))
+                    keys[inst.port] = port
+                else:
+                    tasks.append((port, inst_env,
+                        functools.partial(self.__refresh, inst)))
+                continue
+
+            if inst is not None:
+                inst.databases.close()
+
+            self.fingerprints[port] = fingerprint
+
+            if engine:
+                try:
+                    inst = self.__build_deferred(inst_env)
+                    jobs.append((inst, True))
+                    keys[inst.port] = port
+                except Exception, e:
+                    tasks.append((port, inst_env, functools.partial(
+                        self.__offline, inst_env, e)))
+                continue
+
+            tasks.append((port, inst_env,
+                functools.partial(self.__build, inst_env)))
+
+        for inst in previous.values():
+            inst.databases.close()
+
+        for port in self.fingerprints.keys():
+            if port not in self.detect:
+                del self.fingerprints[port]
+
+        if engine:
+            results = itertools.chain(
+                ((port, task()) for port, inst_env, task in tasks),
+                self.__probe_engine(engine, jobs, keys, timeout)
+            )
+        elif workers:
+            results = self.__probe_all(tasks, workers, timeout)
+        else:
+            results = ((port, task()) for port, inst_env, task in tasks)
+
+        for port, inst in results:
+            self.instances[port] = inst
+
+            if port in prints:
+                self.__track(port, inst, prints[port])
+
+            yield inst
+
+        if self.failures:
+            self.failures.retain(self.detect.keys())
+
+            with metrics.timer('failures_save'):
+                self.failures.save()
+
+
+    def iter_snapshots(self, workers = None, timeout = None,
+        incremental = False):
+        """ Check the current environment, yielding instance snapshots
+
+        This works like iter_discover, except each instance is yielded as an
+        InstanceInfo snapshot with no connections attached. Unless this is
+        incremental, connections won't be reused, so each instance's pool is
+        closed as soon as it's captured. That way, no more than 'workers'
+        connections are open at once, however many instances there are.
+
+        :param workers: See discover.
+        :param timeout: See discover.
+        :param incremental: See discover.
+
+        :retval generator: Yields InstanceInfo objects as they become ready.
+        """
+
+        for inst in self.iter_discover(workers, timeout, incremental):
+            info = inst.snapshot()
+
+            if not incremental:
+                inst.databases.close()
+
+            yield info
+
+
+    def snapshots(self):
+        """ Capture every known instance as an InstanceInfo snapshot
+
+        :retval dict: InstanceInfo objects keyed by port.
+        """
+
+        return dict(
+            (port, inst.snapshot()) for port, inst in self.instances.items()
+        )
+
+
+    def run_all(self, sql, params = None, workers = None, timeout = None):
+        """ Run a statement in every database of every online instance
+
+        This works like Instance.run_all, except the statement is run in
+        the databases of all discovered instances, sharing a single limit on
+        how many run at once. Call discover first.
+
+        :param sql: Statement to run.
+        :param params: Sequence or mapping of statement parameters, if any.
+        :param workers: Most databases to run in at once. Default: 8.
+        :param timeout: Seconds the statement may run in each database.
+            Default: each instance's statement timeout, if any.
+
+        :retval generator: Yields (port, database, result, error) tuples as
+            each database finishes. See Instance.run_all.
+        """
+
+        tasks = [
+            functools.partial(self.__attempt, inst, name, sql, params,
+                timeout)
+            for port, inst in sorted(self.instances.items())
+            if inst.online
+            for name in inst.databases.keys()
+        ]
+
+        for result in run_parallel(tasks, workers or self.run_workers):
+            yield result
+
+
+    def __attempt(self, inst, database, sql, params, timeout):
+        """ Run a statement in one database, capturing any error
+
+        :retval tuple: (port, database, result, error) as yielded by run_all.
+        """
+
+        try:
+            result = inst.run(database, sql, params, timeout)
+            return (inst.port, database, result, None)
+        except (KeyError, psycopg2.Error), e:
+            return (inst.port, database, None, e)
+
+
+    def __probe_all(self, tasks, workers, timeout):
+        """ Build or refresh Instance objects concurrently
+
+        Each task is run in its own thread, with no more than 'workers'
+        probes running at once. Instances are yielded as soon as they are
+        ready. Any probe that runs past its deadline is abandoned, and the
+        instance is yielded in an offline state instead. The probe thread
+        itself can't be stopped, so it is left to finish in the background.
+        Its eventual result is discarded, and any connections it opened are
+        closed. Until then, it still counts against 'workers', so no more
+        than that many probes are ever connecting at once.
+
+        :param tasks: List of (port, inst_env, callable) tuples, where each
+            callable returns a ready Instance for that port.
+        :param workers: Maximum number of probes to run at once.
+        :param timeout: Seconds a probe may run before it's abandoned.
+
+        :retval generator: Yields (port, Instance) tuples as they complete.
+        """
+
+        results = Queue.Queue()
+        waiting = list(tasks)
+        running = {}
+        abandoned = set()
+        lock = threading.Lock()
+
+        # Each probe reports back unless it was abandoned first. Then it
+        # closes its own connections, and only frees its slot afterwards.
+
+        def probe(port, inst_env, task, state):
+            try:
+                inst = task()
+            except Exception, e:
+                inst = self.__offline(inst_env, e)
+
+            with lock:
+                if not state['abandoned']:
+                    state['done'] = True
+                    results.put((port, inst))
+                    return
+
+            inst.databases.close()
+
+            with lock:
+                abandoned.discard(port)
+
+            results.put((port, None))
+
+        while waiting or running:
+            while waiting and len(running) + len(abandoned) < workers:
+                port, inst_env, task = waiting.pop(0)
+                state = {'abandoned': False, 'done': False}
+                running[port] = (time.time(), inst_env, state)
+
+                worker = threading.Thread(target = probe,
+                    args = (port, inst_env, task, state))
+                worker.daemon = True
+                worker.start()
+
+            # Wait for the next probe to finish, but no longer than it takes
+            # for the oldest running probe to exceed its deadline. If only
+            # abandoned probes hold every slot, wait for one of them.
+
+            wait = None
+            if timeout and running:
+                oldest = min(start for start, env, state in running.values())
+                wait = max(0, oldest + timeout - time.time())
+
+            try:
+                port, inst = results.get(True, wait)
+                if inst is not None:
+                    del running[port]
+                    yield port, inst
+            except Queue.Empty:
+                pass
+
+            if not timeout:
+                continue
+
+            now = time.time()
+
+            for port, (start, inst_env, state) in running.items():
+                if now - start < timeout:
+                    continue
+
+                # A probe that finished just now has its result queued
+                # already, so take that instead of abandoning it.
+
+                with lock:
+                    if state['done']:
+                        continue
+
+                    state['abandoned'] = True
+                    abandoned.add(port)
+
+                del running[port]
+                yield port, self.__offline(inst_env,
+                    'Probe exceeded %s second deadline' % timeout)
+
+
+    def __probe_engine(self, engine, jobs, keys, timeout):
+        """ Probe deferred instances with an AsyncEngine
+
+        Instances whose probe failed are rebuilt in full on the next scan,
+        just like threaded probes that miss their deadline.
+
+        :param engine: AsyncEngine to probe with.
+        :param jobs: List of (Instance, full) tuples. See AsyncEngine.
+        :param keys: Dictionary mapping each Instance port to its key in
+            'detect'.
+        :param timeout: Seconds a probe may run before it's abandoned.
+
+        :retval generator: Yields (port, Instance) tuples as they complete.
+        """
+
+        for inst in engine.probe_all(jobs, timeout):
+            port = keys[inst.port]
+
+            if inst.error is not None:
+                self.fingerprints.pop(port, None)
+
+            yield port, inst
+
+
+    def __track(self, port, inst, fingerprint):
+        """ Record whether probing an instance succeeded
+
+        Instances that are offline with an error, including probes that ran
+        past their deadline, count as failures. Instances that are still
+        starting up don't count either way.
+
+        :param port: Port of the probed instance.
+        :param inst: The resulting Instance object.
+        :param fingerprint: Fingerprint of the instance when it was probed.
+        """
+
+        if not self.failures:
+            return
+
+        if inst.online:
+            self.failures.success(port)
+        elif inst.error is not None and not self.__starting(inst):
+            self.failures.failure(port, fingerprint)
+
+
+    def __starting(self, inst):
+        """ Check whether an instance refused a probe while starting up
+
+        :param inst: Instance object to check.
+
+        :retval bool: True if its error is a startup refusal.
+        """
+
+        if not isinstance(inst.error, psycopg2.OperationalError):
+            return False
+
+        return any(msg in str(inst.error) for msg in self.startup_errors)
+
+
+    def __fingerprint(self, inst_env):
+        """ Summarize everything that would require rebuilding an Instance
+
+        A cluster that restarts rewrites its postmaster.pid file, and one
+        that is promoted or demoted changes its recovery configuration.
+        Either of these, or any change in how the cluster was detected,
+        produces a different fingerprint. Only a few stat calls and one
+        small read are needed.
+
+        :param inst_env: Detected instance settings, as stored in 'detect'.
+
+        :retval tuple: Hashable fingerprint for this instance.
+        """
+
+        pgdata = inst_env.get('pgdata') or ''
+        stamps = []
+
+        for name in ('postmaster.pid', 'recovery.conf', 'standby.signal'):
+            try:
+                info = os.stat(os.path.join(pgdata, name))
+                stamps.append((info.st_mtime, info.st_size))
+            except OSError:
+                stamps.append(None)
+
+        try:
+            with open(os.path.join(pgdata, 'postmaster.pid')) as x:
+                stamps.append(x.read(256))
+        except IOError:
+            stamps.append(None)
+
+        return (tuple(sorted(inst_env.items())), tuple(stamps))
+
 
+    def __refresh(self, inst):
+        """ Refresh volatile information for an existing Instance
 
-    def __try_sockets(self):
+        :param inst: Instance object to refresh.
+
+        :retval Instance: The same Instance, for convenience.
+        """
+
+        inst.refresh()
+
+        return inst
+
+
+    def __build(self, inst_env, **extra):
+        """ Build an Instance from detected settings and instance options
+
+        :param inst_env: Detected instance settings, as stored in 'detect'.
+        :param extra: Any further Instance arguments, overriding the rest.
+
+        :retval Instance: The new Instance object.
+        """
+
+        kwargs = dict(self.instance_opts)
+        kwargs.update(inst_env)
+        kwargs.update(extra)
+
+        return Instance(**kwargs)
+
+
+    def __build_deferred(self, inst_env):
+        """ Build an Instance for the engine to probe, without connecting
+
+        The instance is still marked as one that should be probed, so it can
+        connect on demand later, such as to run statements or refresh.
+
+        :param inst_env: Detected instance settings, as stored in 'detect'.
+
+        :retval Instance: The new Instance object, not yet probed.
+        """
+
+        inst = self.__build(inst_env, probe = False)
+        inst.probe = True
+
+        return inst
+
+
+    def __offline(self, inst_env, error):
+        """ Build an Instance marked offline without contacting it
+
+        :param inst_env: Detected instance settings, as stored in 'detect'.
+        :param error: Exception or message explaining the failed probe.
+
+        :retval Instance: Instance with file-based information only.
+        """
+
+        inst = self.__build(inst_env, probe = False)
+        inst.online = False
+        inst.error = error
+
+        # The next scan shouldn't mistake this placeholder for a fully
+        # probed instance that only needs a refresh.
+
+        self.fingerprints.pop(inst_env['port'], None)
+
+        return inst
+
+
+    def scan_sockets(self):
         """ Look for Postgres instances based on running socket/lock files.
 
         This function only works on running Postgres instances, unfortunately.
         While running, Postgres instances leave a socket file in a directory
         (usually /tmp) along with a file detailing some information about the
         instance on the reserved port.
+
+        Results are kept in the 'sockets' attribute, which discover uses as
+        the starting point for each scan. Unless 'watching' is set, discover
+        calls this automatically.
         """
 
+        self.sockets = {}
+
         for sock in self.socket_dirs:
             if not os.path.exists(sock):
                 continue
 
             for lock_file in glob(os.path.join(sock, '.s.PGSQL.*.lock')):
-                with open(lock_file) as x: lock_data = x.readlines()
+                self.add_socket(lock_file)
+
 
-                pgport = lock_data[3].strip()
+    def add_socket(self, lock_file):
+        """ Record the instance described by a socket lock file
 
-                self.detect[pgport] = self.__blank.copy()
+        :param lock_file: Full path to a .s.PGSQL.<port>.lock file.
 
-                inst_conf = {
-                    'port': pgport,
-                    'pgdata': lock_data[1].strip(),
-                    'user': pwd.getpwuid(os.stat(lock_file).st_uid).pw_name,
-                    'online': True
-                }
+        :retval string: Port of the recorded instance, or None if the lock
+            file couldn't be read. This can happen if it is still being
+            written, or was removed in the meantime.
+        """
+
+        try:
+            with open(lock_file) as x: lock_data = x.readlines()
+
+            pgport = lock_data[3].strip()
+            owner = os.stat(lock_file).st_uid
+        except (IOError, OSError, IndexError):
+            return None
+
+        self.sockets[pgport] = self.__blank.copy()
+
+        inst_conf = {
+            'port': pgport,
+            'pgdata': lock_data[1].strip(),
+            'user': self.__user_name(owner),
+            'online': True
+        }
 
-                self.detect[pgport].update(inst_conf)
+        self.sockets[pgport].update(inst_conf)
 
+        return pgport
 
-    def __try_lsclusters(self):
+
+    def remove_socket(self, port):
+        """ Mark the instance on a port as stopped
+
+        When an instance shuts down, it removes its socket lock file. Rather
+        than forgetting the instance right away, keep it until the next scan,
+        so it can be reported as offline.
+
+        :param port: Port whose lock file was removed.
+        """
+
+        if port in self.sockets:
+            self.sockets[port]['online'] = False
+
+
+    def probe(self, port):
+        """ Rebuild the Instance for a single detected port
+
+        This is meant for reacting to a change in one instance, such as a
+        startup or shutdown, without scanning everything else again. Any
+        settings from the last full scan are kept, and overridden by the
+        current socket lock information.
+
+        Postgres writes its lock file before it accepts connections, so an
+        instance that has only just started may refuse the probe. In that
+        case, it's retried with a short backoff for up to 'startup_wait'
+        seconds, and isn't counted as a failure if it's still starting.
+
+        :param port: Port of the instance to probe.
+
+        :retval Instance: The new Instance object for that port.
+        """
+
+        inst_env = self.__blank.copy()
+        inst_env.update(self.detect.get(port, {}))
+        inst_env.update(self.sockets.get(port, {}))
+
+        fingerprint = self.__fingerprint(inst_env)
+
+        self.detect[port] = inst_env
+        self.fingerprints[port] = fingerprint
+
+        old = self.instances.get(port)
+        if old is not None:
+            old.databases.close()
+
+        deadline = time.time() + self.startup_wait
+        delay = 0.1
+
+        while True:
+            try:
+                inst = self.__build(inst_env)
+            except Exception, e:
+                inst = self.__offline(inst_env, e)
+
+            if not self.__starting(inst) or time.time() + delay > deadline:
+                break
+
+            inst.databases.close()
+            time.sleep(delay)
+            delay *= 2
+
+        self.instances[port] = inst
+        self.__track(port, inst, fingerprint)
+
+        return inst
+
+
+    def __try_debian(self):
+        """ Look for Postgres instances in Debian cluster configurations.
+
+        Debian/Ubuntu variants organize clusters by version and name, with a
+        configuration directory for each in /etc/postgresql. Rather than
+        calling pg_lsclusters, which is a Perl script that does far more work
+        than we need, read each cluster's postgresql.conf for its port and
+        data directory, and check the postmaster.pid file to see if it's
+        running.
+
+        If the postmaster.pid file can't be read, such as when the data
+        directory belongs to another user, whether the cluster is running
+        is left to socket detection.
+
+        :retval set: Ports of clusters whose running state could be read.
+        """
+
+        known = set()
+
+        # If this is not a Debian/Ubuntu system, there's nothing to do here.
+
+        if not os.path.isdir(self.debian_conf_dir):
+            return known
+
+        pattern = os.path.join(self.debian_conf_dir, '*', '*',
+            'postgresql.conf')
+
+        for conf_file in glob(pattern):
+            conf_dir = os.path.dirname(conf_file)
+            (ver, name) = conf_dir.split(os.sep)[-2:]
+
+            try:
+                settings = self.__read_pg_conf(conf_file)
+            except IOError:
+                continue
+
+            port = settings.get('port', '5432')
+            pgdata = settings.get('data_directory',
+                os.path.join(os.sep, 'var', 'lib', 'postgresql', ver, name))
+
+            try:
+                owner = os.stat(pgdata).st_uid
+            except OSError:
+                owner = os.stat(conf_file).st_uid
+
+            role = 'master'
+            for signal_file in ('recovery.conf', 'standby.signal'):
+                if os.path.exists(os.path.join(pgdata, signal_file)):
+                    role = 'slave'
+
+            if port not in self.detect:
+                self.detect[port] = self.__blank.copy()
+
+            inst_conf = {
+                'name': name,
+                'port': port,
+                'user': self.__user_name(owner),
+                'pgdata': pgdata,
+                'role': role
+            }
+
+            running = self.__pid_running(pgdata)
+
+            if running is not None:
+                inst_conf['online'] = running
+                known.add(port)
+
+            self.detect[port].update(inst_conf)
+
+        return known
+
+
+    def __read_pg_conf(self, conf_file):
+        """ Read settings from a postgresql.conf file
+
+        Only simple 'name = value' settings are recognized. Quotes and
+        trailing comments are removed, and include directives are followed
+        relative to the including file. Later settings override earlier
+        ones, just as they do in Postgres itself.
+
+        :param conf_file: Full path to the configuration file.
+
+        :retval dict: Setting names and their string values.
+        """
+
+        settings = {}
+        conf_dir = os.path.dirname(conf_file)
+
+        with open(conf_file) as x:
+            lines = x.readlines()
+
+        for line in lines:
+            match = re.match(
+                "\s*(\w+)\s*=?\s*('(?:[^']|'')*'|[^\s#]*)", line)
+
+            if not match or not match.group(2):
+                continue
+
+            (key, val) = (match.group(1).lower(), match.group(2))
+
+            if val.startswith("'"):
+                val = val[1:-1].replace("''", "'")
+
+            if key in ('include', 'include_if_exists', 'include_dir'):
+                path = os.path.join(conf_dir, val)
+                includes = [path]
+
+                if key == 'include_dir':
+                    includes = sorted(glob(os.path.join(path, '*.conf')))
+
+                for include in includes:
+                    try:
+                        settings.update(self.__read_pg_conf(include))
+                    except IOError:
+                        if key == 'include':
+                            raise
+
+                continue
+
+            settings[key] = val
+
+        return settings
+
+
+    def __pid_running(self, pgdata):
+        """ Check whether a postmaster is running for a data directory
+
+        :param pgdata: Full path to the instance data directory.
+
+        :retval bool: True if postmaster.pid lists a live process, False
+            if it doesn't exist or lists a dead one, or None if it couldn't
+            be read.
+        """
+
+        try:
+            with open(os.path.join(pgdata, 'postmaster.pid')) as x:
+                pid = int(x.readline().strip())
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return False
+            return None
+        except ValueError:
+            return False
+
+        try:
+            os.kill(pid, 0)
+        except OSError, e:
+            return e.errno == errno.EPERM
+
+        return True
+
+
+    def __user_name(self, uid):
+        """ Find the name of the user with a given UID
+
+        Files can belong to a UID with no passwd entry, such as after the
+        account is removed, or in a container. That shouldn't stop the
+        instance from being found, so the number itself is used instead.
+
+        :param uid: Numeric user ID to look up.
+
+        :retval str: User name, or the UID as a string if it's unknown.
+        """
+
+        try:
+            return pwd.getpwuid(uid).pw_name
+        except KeyError:
+            return str(uid)
+
+
+    def __try_lsclusters(self, known = ()):
         """ Look for Postgres instances on a Debian-derived system.
 
         This function tries to use pg_lsclusters to locate running instances,
-        thus works with Debian/Ubuntu variants. 
+        thus works with Debian/Ubuntu variants. Since the native Debian
+        detection covers the same ground, this is only used if the
+        'use_lsclusters' attribute is set, and only as a fallback: clusters
+        that native detection already found, and could read the running
+        state of, are left as they are.
+
+        :param known: Ports of clusters native detection fully read.
         """
 
         # If this is not a Debian/Ubuntu system, there's nothing to do here.
@@ -108,6 +924,9 @@ class Environment(object):
             fields = re.split('\s+', line)
             (ver, name, port, status, user, pgdata) = fields[:6]
 
+            if port in known:
+                continue
+
             if port not in self.detect:
                 self.detect[port] = self.__blank.copy()
 
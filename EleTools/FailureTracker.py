@@ -0,0 +1,130 @@
+import time
+
+from EleTools.StateStore import StateStore
+
+class FailureTracker(object):
+    """ Remember which instances keep failing, and probe them less often
+
+    A cluster that is stuck in recovery, out of connection slots, or
+    otherwise broken can take a full timeout to fail every time it's
+    probed. When that happens on every report, a few broken clusters slow
+    down reporting for all of the healthy ones.
+
+    This class counts consecutive failures for each port in a StateStore,
+    so the counts survive between runs. Once a port reaches the failure
+    threshold, it's only probed again after an exponentially growing delay.
+    In the meantime, callers should report it as offline without contacting
+    it. Any success clears the count.
+
+    Failures are tied to a token describing the instance, such as its
+    discovery fingerprint. If the token changes, for example because the
+    instance restarted, past failures no longer count against it.
+    """
+
+    threshold = 3
+    backoff = 60
+    max_backoff = 3600
+
+    def __init__(self, state_file, threshold = None, backoff = None,
+        max_backoff = None):
+        """ Load failure counts from the state file, if it exists
+
+        :param state_file: Full path to the file where counts are stored.
+        :param threshold: Consecutive failures before probes are skipped.
+            Default: 3.
+        :param backoff: Seconds to skip probes after reaching the threshold.
+            This doubles with every further failure. Default: 60.
+        :param max_backoff: Most seconds probes are ever skipped for.
+            Default: 3600.
+        """
+
+        self.store = StateStore(state_file)
+
+        if threshold is not None:
+            self.threshold = int(threshold)
+
+        if backoff is not None:
+            self.backoff = float(backoff)
+
+        if max_backoff is not None:
+            self.max_backoff = float(max_backoff)
+
+
+    def failures(self, port, token = None):
+        """ Count consecutive failures for a port
+
+        :param port: Port of the instance to check.
+        :param token: Current token for the instance, if any.
+
+        :retval int: Consecutive failures, or 0 if the token has changed.
+        """
+
+        (stamp, info) = self.store.get(port)
+
+        if info is None or info['token'] != token:
+            return 0
+
+        return info['failures']
+
+
+    def should_probe(self, port, token = None):
+        """ Decide whether an instance should be contacted right now
+
+        :param port: Port of the instance to check.
+        :param token: Current token for the instance, if any.
+
+        :retval bool: False if the port is backing off after failures.
+        """
+
+        if self.failures(port, token) < self.threshold:
+            return True
+
+        (stamp, info) = self.store.get(port)
+
+        return time.time() >= info['retry']
+
+
+    def failure(self, port, token = None):
+        """ Record a failed probe, and back off if there were too many
+
+        :param port: Port of the instance that failed.
+        :param token: Current token for the instance, if any.
+
+        :retval int: Consecutive failures, including this one.
+        """
+
+        failures = self.failures(port, token) + 1
+        retry = 0
+
+        if failures >= self.threshold:
+            retry = time.time() + min(self.max_backoff,
+                self.backoff * 2 ** (failures - self.threshold))
+
+        self.store.update(port,
+            {'token': token, 'failures': failures, 'retry': retry})
+
+        return failures
+
+
+    def success(self, port):
+        """ Record a successful probe, clearing any failures. """
+
+        self.store.entries.pop(port, None)
+
+
+    def retain(self, ports):
+        """ Forget every port not in the given list. See StateStore.retain.
+        """
+
+        self.store.retain(ports)
+
+
+    def save(self):
+        """ Atomically save all failure counts. See StateStore.save. """
+
+        self.store.save()
+
+
+# Set up the object and external callables.
+
+__all__ = ['FailureTracker']
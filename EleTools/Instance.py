@@ -1,13 +1,64 @@
 
 import re
 import os
+import sys
+import time
+import Queue
 import socket
 import getpass
+import functools
+import threading
 import psycopg2
 import psycopg2.extras
 
+from contextlib import contextmanager
 
-def db_connect(host, user, db, port = 5432):
+from EleTools.ControlData import ControlData
+from EleTools.QueryRegistry import QueryRegistry
+from EleTools.InstanceInfo import InstanceInfo
+from EleTools.Metrics import metrics
+
+# Every connection is made through this callable, which must accept the same
+# keyword arguments as psycopg2.connect. Benchmarks and similar tools can
+# replace it to simulate or redirect connections.
+
+connection_factory = psycopg2.connect
+
+
+def connect_params(host, user, db, port = 5432, connect_timeout = None,
+    statement_timeout = None):
+    """ Build the keyword arguments for connecting to a database
+
+    This is separate from db_connect so callers that need a different kind
+    of connection, such as an asynchronous one, connect the same way. See
+    db_connect for the parameters.
+
+    :retval dict: Keyword arguments for connection_factory.
+    """
+
+    params = dict(port = port, user = user, database = db)
+
+    # If the connection is localhost, don't even supply the host parameter,
+    # as that will avoid a UNIX socket.
+
+    if host != 'localhost':
+        params['host'] = host
+
+    # libpq only accepts whole seconds for connect_timeout, and treats
+    # anything below two seconds as two.
+
+    if connect_timeout:
+        params['connect_timeout'] = max(2, int(round(connect_timeout)))
+
+    if statement_timeout:
+        params['options'] = '-c statement_timeout=%d' % (
+            statement_timeout * 1000)
+
+    return params
+
+
+def db_connect(host, user, db, port = 5432, connect_timeout = None,
+    statement_timeout = None):
     """ Connect to the indicated database and return the connection object.
 
     This is a helper function for utilities that need to connect to a
@@ -19,33 +70,320 @@ def db_connect(host, user, db, port = 5432):
         auth enabled.
     :param db: Name of the database for this connection.
     :param port: Port for the target PG instance. Default: 5432.
+    :param connect_timeout: Seconds to wait for the connection before giving
+        up. Default: wait indefinitely.
+    :param statement_timeout: Seconds any statement on this connection may
+        run before the server cancels it. Default: no limit.
 
     :retval connection: A psycopg2 connection object with autocommit enabled
         to encourage explicit transaction management if necessary.
     """
 
-    # If the connection is localhost, don't even supply the host parameter,
-    # as that will avoid a UNIX socket.
-
-    if host == 'localhost':
-        conn = psycopg2.connect(
-            port = port,
-            user = user,
-            database = db
-        )
-    else:
-        conn = psycopg2.connect(
-            host = host,
-            port = port,
-            user = user,
-            database = db
-        )
-
+    conn = connection_factory(**connect_params(host, user, db, port,
+        connect_timeout, statement_timeout))
     conn.autocommit = True
 
     return conn
 
 
+def async_connect(host, user, db, port = 5432, connect_timeout = None,
+    statement_timeout = None):
+    """ Start connecting to the indicated database asynchronously
+
+    Parameters match db_connect. The connection is returned right away, and
+    is only usable once its poll method returns POLL_OK. Asynchronous
+    connections are always in autocommit mode. See AsyncEngine.
+
+    :retval connection: An asynchronous psycopg2 connection object.
+    """
+
+    return connection_factory(async = 1, **connect_params(host, user, db,
+        port, connect_timeout, statement_timeout))
+
+
+def run_parallel(tasks, workers):
+    """ Run callables concurrently, yielding each result as it's ready
+
+    No more than 'workers' tasks run at once, each in its own thread.
+    Results are yielded in the order tasks finish, not the order they were
+    given. If a task raises an exception, it's re-raised here instead.
+
+    :param tasks: List of callables that take no arguments.
+    :param workers: Maximum number of tasks to run at once.
+
+    :retval generator: Yields the return value of each task.
+    """
+
+    pending = Queue.Queue()
+    results = Queue.Queue()
+
+    for task in tasks:
+        pending.put(task)
+
+    def work():
+        while True:
+            try:
+                task = pending.get_nowait()
+            except Queue.Empty:
+                return
+
+            try:
+                results.put((True, task()))
+            except Exception:
+                results.put((False, sys.exc_info()))
+
+    for i in range(min(max(1, int(workers or 1)), len(tasks))):
+        worker = threading.Thread(target = work)
+        worker.daemon = True
+        worker.start()
+
+    for i in range(len(tasks)):
+        (ok, result) = results.get()
+
+        if not ok:
+            raise result[0], result[1], result[2]
+
+        yield result
+
+
+class ConnectionPool(object):
+    """ Lazily Connect to, and Retain, Databases Within an Instance
+
+    Rather than connecting to every database in an instance up front, this
+    class records the known database names and only opens a connection the
+    first time a database is requested. Connections are reused across calls,
+    and closed again once they sit idle for too long, or when the pool
+    reaches its size limit and needs room for another database.
+
+    For convenience, the pool can be used much like a dictionary of
+    connections keyed by database name:
+
+    conn = inst.databases['postgres']
+
+    Just like a dictionary, asking for a database that isn't known raises
+    KeyError. The 'template1' database is the exception, since it must
+    always exist, and is used to find the others.
+
+    Connections are safe to use from several threads, but psycopg2 runs
+    only one statement per connection at a time. To run statements in
+    several databases at once, take each connection with 'use', which also
+    keeps the pool from closing it until the block is finished.
+    """
+
+    max_size = 20
+    idle_timeout = 600
+    connect_timeout = None
+    statement_timeout = None
+
+    def __init__(self, port, user = None, max_size = None,
+        idle_timeout = None, connect_timeout = None,
+        statement_timeout = None):
+        """ Initialize an Empty Pool for a Single Instance Port
+
+        :param port: Port number of the instance these databases belong to.
+        :param user: DB username to use while connecting. Default: the
+            current system user.
+        :param max_size: Maximum number of open connections to retain. When
+            this is reached, the least recently used connection is closed.
+            Zero or None disables the limit. Default: 20.
+        :param idle_timeout: Seconds a connection may remain unused before
+            it is closed. Zero or None disables idle expiration.
+            Default: 600.
+        :param connect_timeout: Seconds to wait for each new connection.
+            See db_connect. Default: wait indefinitely.
+        :param statement_timeout: Seconds any statement may run on these
+            connections. See db_connect. Default: no limit.
+        """
+
+        self.port = port
+        self.user = user or getpass.getuser()
+        self.names = []
+
+        if max_size is not None:
+            self.max_size = int(max_size)
+
+        if idle_timeout is not None:
+            self.idle_timeout = float(idle_timeout)
+
+        if connect_timeout:
+            self.connect_timeout = float(connect_timeout)
+
+        if statement_timeout:
+            self.statement_timeout = float(statement_timeout)
+
+        self.__conns = {}
+        self.__used = {}
+        self.__busy = {}
+        self.__lock = threading.Lock()
+
+
+    def __getitem__(self, name):
+        """ Get a Connection to the Named Database, Connecting if Necessary
+
+        :param name: Name of the database to retrieve a connection for.
+
+        :retval connection: A psycopg2 connection object with autocommit.
+
+        :raises KeyError: If the database isn't known to this pool.
+        """
+
+        return self.__get(name)
+
+
+    @contextmanager
+    def use(self, name):
+        """ Borrow a connection to the named database for a block
+
+        While the block runs, the connection is never closed to make room
+        for others, or because it's idle. If every connection is busy, the
+        pool grows past its size limit rather than wait.
+
+        :param name: Name of the database to retrieve a connection for.
+
+        :retval connection: A psycopg2 connection object with autocommit.
+
+        :raises KeyError: If the database isn't known to this pool.
+        """
+
+        conn = self.__get(name, True)
+
+        try:
+            yield conn
+        finally:
+            with self.__lock:
+                self.__busy[name] -= 1
+                if not self.__busy[name]:
+                    del self.__busy[name]
+
+
+    def __get(self, name, busy = False):
+        """ Get a connection, optionally marking it busy
+
+        Connecting can be slow, so it happens without holding the pool lock.
+        That way, several threads can connect to different databases at once.
+        If two threads connect to the same database, the first connection
+        stored wins, and the other is closed.
+        """
+
+        if name not in self.names and name != 'template1':
+            raise KeyError(name)
+
+        with self.__lock:
+            self.__prune()
+
+            conn = self.__conns.get(name)
+
+            if conn is not None and not conn.closed:
+                return self.__claim(name, conn, busy)
+
+        conn = db_connect('localhost', self.user, name, self.port,
+            self.connect_timeout, self.statement_timeout)
+
+        with self.__lock:
+            existing = self.__conns.get(name)
+
+            if existing is not None and not existing.closed:
+                conn.close()
+                return self.__claim(name, existing, busy)
+
+            idle = [n for n in self.__conns if n not in self.__busy]
+
+            if idle and self.max_size and len(self.__conns) >= self.max_size:
+                self.__close(min(idle, key = self.__used.get))
+
+            self.__conns[name] = conn
+
+            return self.__claim(name, conn, busy)
+
+
+    def __claim(self, name, conn, busy):
+        """ Mark a connection used; the caller must hold the pool lock. """
+
+        self.__used[name] = time.time()
+
+        if busy:
+            self.__busy[name] = self.__busy.get(name, 0) + 1
+
+        return conn
+
+
+    def __contains__(self, name):
+        return name in self.names
+
+
+    def __iter__(self):
+        return iter(self.names)
+
+
+    def __len__(self):
+        return len(self.names)
+
+
+    def keys(self):
+        """ List all known databases, whether connected or not. """
+
+        return list(self.names)
+
+
+    def reset(self, names):
+        """ Replace the List of Known Databases
+
+        Any open connections to databases that were dropped from the list
+        are closed. Connections to databases that were never listed, such as
+        'template1', are left alone.
+
+        :param names: Iterable of database names within this instance.
+        """
+
+        with self.__lock:
+            (old_names, self.names) = (self.names, list(names))
+
+            for name in old_names:
+                if name not in self.names:
+                    self.__close(name)
+
+
+    def prune(self):
+        """ Close any connections that have exceeded the idle timeout. """
+
+        with self.__lock:
+            self.__prune()
+
+
+    def close(self):
+        """ Close every open connection in the pool. """
+
+        with self.__lock:
+            for name in list(self.__conns):
+                self.__close(name)
+
+
+    def __prune(self):
+        """ Close idle connections; the caller must hold the pool lock. """
+
+        if not self.idle_timeout:
+            return
+
+        cutoff = time.time() - self.idle_timeout
+
+        for name, used in list(self.__used.items()):
+            if used < cutoff and name not in self.__busy:
+                self.__close(name)
+
+
+    def __close(self, name):
+        """ Close and forget one connection; caller must hold the lock. """
+
+        conn = self.__conns.pop(name, None)
+        self.__used.pop(name, None)
+
+        if conn is not None and not conn.closed:
+            try:
+                conn.close()
+            except psycopg2.Error:
+                pass
+
+
 class Instance(object):
     """ Encapsulate a PostgreSQL Database Instance
     
@@ -63,16 +401,29 @@ class Instance(object):
     master_port = None
     invalid = False
     xlog_pos = None
+    probe = True
+    control = False
+    prepare = False
+
+    state = None
+    timeline = None
+    system_id = None
+    checkpoint_lsn = None
+    redo_lsn = None
+
+    standbys = None
 
     error = None
-    databases = {}
+    databases = None
+    run_workers = 8
 
     def __init__(self, *args, **kwargs):
         """ Set all of the basic variables and scan for active databases
 
         In addition to setting some important instance identifiers, this
-        function will attempt to connect to any PostgreSQL databases
-        it can find within the instance, except for template0 and template1.
+        function will list any PostgreSQL databases it can find within the
+        instance, except for template0 and template1. Connections to these
+        are only made on demand through the 'databases' pool.
         Any attributes beyond the sent parameters will be obtained by polling
         the environment and using various PostgreSQL CLI tools.
 
@@ -85,6 +436,23 @@ class Instance(object):
             Default: false
         :param pgdata: Full path to the directory where database files are
             stored. Needed to determine certain runtime elements.
+        :param pool_size: Maximum number of database connections to retain
+            for this instance. Default: see ConnectionPool.
+        :param idle_timeout: Seconds before an unused database connection is
+            closed. Default: see ConnectionPool.
+        :param connect_timeout: Seconds to wait when connecting to any
+            database in this instance. Default: wait indefinitely.
+        :param statement_timeout: Seconds any query against this instance may
+            run before the server cancels it. This keeps an instance that
+            is stuck from holding up a report. Default: no limit.
+        :param probe: Set to False to skip connecting to the instance
+            entirely, leaving only file-based information. Default: True.
+        :param control: Set to True to read cluster state, checkpoint
+            locations, timeline, and system identifier directly from the
+            pg_control and postmaster.pid files. Default: False.
+        :param prepare: Set to True to prepare polling queries on the server
+            once per connection, which helps when the instance is refreshed
+            repeatedly by a long-running process. Default: False.
         """
 
         for key in ('port', 'name', 'user', 'role', 'online', 'pgdata'):
@@ -103,6 +471,16 @@ class Instance(object):
 
             setattr(self, key, val)
 
+        # Each instance gets its own pool of database connections. Nothing
+        # actually connects until a database is requested from the pool.
+
+        self.databases = ConnectionPool(self.port,
+            max_size = kwargs.get('pool_size'),
+            idle_timeout = kwargs.get('idle_timeout'),
+            connect_timeout = kwargs.get('connect_timeout'),
+            statement_timeout = kwargs.get('statement_timeout')
+        )
+
         # Since the instance might be down, try to get the version from the
         # PG_VERSION file. If that doesn't even exist, this instance is
         # invalid, and should be noted as such. If the database is up, we'll
@@ -149,65 +527,273 @@ class Instance(object):
                 if info:
                     self.master_port = int(info.groups(1)[0])
 
-        # Finally, try to connect to all of the databases in the instance
-        # and record those connections for later use.
+        # Without connecting at all, the control file can tell us whether
+        # the instance is running, whether it's a replica, and roughly where
+        # its xlog position is. A live connection will refine these.
+
+        self.probe = kwargs.get('probe', True)
+        self.control = kwargs.get('control', False)
+        self.prepare = kwargs.get('prepare', False)
+        self.__queries = None
+
+        if self.control:
+            with metrics.timer('instance_control', port = self.port):
+                self.__read_control()
+
+        # Finally, connect to the instance to gather live information and
+        # list the databases available for later use.
+
+        if self.probe:
+            self.__connect()
+
+
+    def __read_control(self):
+        """ Fill instance information from the pg_control and pid files
+
+        This requires read access to the data directory, but no connection
+        to the instance itself. The latest checkpoint location stands in for
+        the xlog position, which is exact for cleanly stopped instances.
+        """
+
+        control = ControlData(self.pgdata)
+
+        self.online = control.running
+        self.state = control.state
+        self.timeline = control.timeline
+        self.system_id = control.system_identifier
+        self.checkpoint_lsn = control.checkpoint_lsn
+        self.redo_lsn = control.redo_lsn
+        self.xlog_pos = control.checkpoint_lsn
+
+        if control.in_recovery():
+            self.role = 'slave'
+
+        if control.error:
+            self.error = control.error
+
+
+    def refresh(self, poll = True):
+        """ Update only the volatile information for this instance
+
+        Rather than gathering everything again, re-read the control file if
+        that mode is enabled, and poll the role, xlog position, and attached
+        standbys over the retained 'template1' connection. Either of these
+        also updates whether the instance is online.
+
+        :param poll: Set to False to only re-read the control file, such as
+            when the caller polls the instance some other way. Default: True.
+        """
+
+        if self.control:
+            self.__read_control()
+
+        if not self.probe or not poll:
+            return
+
+        try:
+            with metrics.timer('instance_refresh', port = self.port):
+                sql = self.__registry(self.databases['template1'])
+                (recovery, xlog_pos) = sql.execute('poll').fetchone()
+                self.__set_position(recovery, xlog_pos)
+                self.__poll_replication(sql)
+
+            self.online = True
+            self.error = None
+
+        except psycopg2.OperationalError, e:
+            self.error = e
+            self.online = False
+
+        # Anything else means the instance is up, but some query failed.
+        # Note the problem, but don't stop other instances from reporting.
+
+        except psycopg2.Error, e:
+            self.error = e
 
-        self.__connect()
+
+    def describe(self):
+        """ Summarize this instance as a dictionary of plain values
+
+        This is convenient for serializing instance information, such as
+        when answering inventory queries. Live connections are excluded.
+
+        :retval dict: Reportable attributes, keyed by attribute name.
+        """
+
+        info = dict((key, getattr(self, key)) for key in (
+            'name', 'port', 'user', 'role', 'online', 'version', 'pgdata',
+            'master_host', 'master_port', 'invalid', 'xlog_pos', 'state',
+            'timeline', 'system_id', 'checkpoint_lsn', 'redo_lsn',
+            'standbys',
+        ))
+
+        info['databases'] = self.databases.keys()
+        info['error'] = self.error and str(self.error) or None
+
+        return info
+
+
+    def query(self, name):
+        """ Run a named QueryRegistry query over the 'template1' connection
+
+        :param name: Name of the query to run.
+
+        :retval list: Every row of the result.
+
+        :raises psycopg2.Error: If the query, or connecting, fails.
+        """
+
+        with self.databases.use('template1') as conn:
+            return self.__registry(conn).execute(name).fetchall()
+
+
+    def run(self, database, sql, params = None, timeout = None):
+        """ Run a statement in one database of this instance
+
+        :param database: Name of the database to run the statement in.
+        :param sql: Statement to run.
+        :param params: Sequence or mapping of statement parameters, if any.
+        :param timeout: Seconds the statement may run before the server
+            cancels it. Default: the instance's statement timeout, if any.
+
+        :retval mixed: List of result rows if the statement returns any, or
+            the number of rows affected otherwise.
+
+        :raises KeyError: If the database isn't known to this instance.
+        :raises psycopg2.Error: If the statement, or connecting, fails.
+        """
+
+        with self.databases.use(database) as conn:
+            cur = conn.cursor()
+
+            # A timeout of zero would mean no limit at all, so anything
+            # shorter than a millisecond is rounded up to one.
+
+            if timeout:
+                cur.execute("SET statement_timeout = %s",
+                    (max(1, int(timeout * 1000)),))
+
+            try:
+                cur.execute(sql, params)
+
+                if cur.description is None:
+                    return cur.rowcount
+
+                return cur.fetchall()
+
+            # Put the connection's own timeout back, since it stays in the
+            # pool. If the connection was lost, there's nothing to reset.
+
+            finally:
+                if timeout and not conn.closed:
+                    try:
+                        cur.execute("RESET statement_timeout")
+                    except psycopg2.Error:
+                        pass
+
+
+    def run_all(self, sql, params = None, workers = None, timeout = None,
+        databases = None):
+        """ Run a statement in every database of this instance at once
+
+        Each database gets its own pooled connection, and up to 'workers'
+        of them run the statement concurrently. Results are yielded as each
+        database finishes, so callers can act on them right away. A failure
+        in one database doesn't stop the others.
+
+        :param sql: Statement to run.
+        :param params: Sequence or mapping of statement parameters, if any.
+        :param workers: Most databases to run in at once. This never
+            exceeds the pool size. Default: 8.
+        :param timeout: Seconds the statement may run in each database.
+            Default: the instance's statement timeout, if any.
+        :param databases: Names of the databases to run in. Default: every
+            database in the instance, except templates.
+
+        :retval generator: Yields (database, result, error) tuples. The
+            result is as returned by run, or None if there was an error.
+        """
+
+        if databases is None:
+            databases = self.databases.keys()
+
+        workers = workers or self.run_workers
+
+        if self.databases.max_size:
+            workers = min(workers, self.databases.max_size)
+
+        tasks = [
+            functools.partial(self.__attempt, name, sql, params, timeout)
+            for name in databases
+        ]
+
+        for result in run_parallel(tasks, workers):
+            yield result
+
+
+    def __attempt(self, database, sql, params, timeout):
+        """ Run a statement in one database, capturing any error
+
+        :retval tuple: (database, result, error) as yielded by run_all.
+        """
+
+        try:
+            return (database, self.run(database, sql, params, timeout), None)
+        except (KeyError, psycopg2.Error), e:
+            return (database, None, e)
+
+
+    def snapshot(self):
+        """ Capture the reportable fields of this instance
+
+        :retval InstanceInfo: Connection-free snapshot of this instance.
+        """
+
+        return InstanceInfo.from_instance(self)
 
 
     def __connect(self):
-        """ Connect to all instance databases for potential script execution
+        """ Poll the instance and list databases for potential script execution
 
         Attempt to connect to our instance port using the current user to
         the 'template1' database which must exist. We use the local user
         assuming there is a `.pgpass` file that handles passwords for us,
-        or peer authentication is enabled.
+        or peer authentication is enabled. This connection is retained in
+        the pool, so later refreshes don't need to connect again.
         
         Once this is done, we will find all databases in the instance and
-        create a connection to each. These connections can be used to poll
-        for further instance information, or retained for script invocation.
+        register them with the connection pool. Connections are only made
+        when a database is first requested, and can be used to poll for
+        further instance information, or retained for script invocation.
         """
 
         try:
-            temp_conn = db_connect('localhost', getpass.getuser(),
-                'template1', self.port)
+            with metrics.timer('instance_connect', port = self.port):
+                conn = self.databases['template1']
 
             self.online = True
+            sql = self.__registry(conn)
 
             # Now that we're connected, get the most up-to-date system
-            # version. This should override the value obtained from PG_VERSION
-            # since it's more precise.
-
-            cur = temp_conn.cursor()
-            SQL = "SELECT substring(version() FROM '\d+(?:\.\d+){1,2}')"
-            cur.execute(SQL)
-            self.version = cur.fetchone()[0]
-
-            # Capture the xlog position so callers can use the information
-            # to calculate replication lag.
+            # version, role, and xlog position all at once. The version
+            # should override the value obtained from PG_VERSION since it's
+            # more precise.
 
-            usefunc = 'pg_current_xlog_location()'
-            if self.role == 'slave':
-                usefunc = 'pg_last_xlog_replay_location()'
+            with metrics.timer('instance_status', port = self.port):
+                (version, recovery, xlog_pos) = \
+                    sql.execute('status').fetchone()
 
-            SQL = "SELECT pg_xlog_location_diff(" + usefunc + ", '0/00000000')"
-            cur.execute(SQL)
-            self.xlog_pos = cur.fetchone()[0]
+                self.version = version
+                self.__set_position(recovery, xlog_pos)
 
-            # Try to connect individually to each database. At the end, we'll
-            # be throwing away the temporary connection.
+            with metrics.timer('instance_replication', port = self.port):
+                self.__poll_replication(sql)
 
-            cur = temp_conn.cursor()
-            cur.execute("SELECT datname FROM pg_stat_database \
-                          WHERE datname NOT LIKE 'template_'")
+            # Record each database name so the pool can connect on demand.
 
-            for row in cur:
-                conn = db_connect('localhost', getpass.getuser(),
-                    row[0], self.port)
-
-                self.databases[row[0]] = conn
-
-            temp_conn.close()
+            with metrics.timer('instance_databases', port = self.port):
+                self.databases.reset(
+                    row[0] for row in sql.execute('databases'))
 
         # In the case an exception happened above, either the instance went
         # down, or we can't communicate successfully with it. In any case,
@@ -217,7 +803,119 @@ class Instance(object):
             self.error = e
             self.online = False
 
+        # Any other database error means we connected, but a query failed.
+        # The instance is still online, so just note the problem.
+
+        except psycopg2.Error, e:
+            self.error = e
+
+
+    def __registry(self, conn):
+        """ Get the query registry for a connection to this instance
+
+        The pool may replace a connection at any time, and queries prepared
+        on the old one are lost with it, so a new registry is created
+        whenever the connection changes.
+
+        :param conn: Connection to the 'template1' database.
+
+        :retval QueryRegistry: Queries for the server behind 'conn'.
+        """
+
+        if self.__queries is None or self.__queries.conn is not conn:
+            self.__queries = QueryRegistry(conn, self.prepare)
+
+        return self.__queries
+
+
+    def set_status(self, version, recovery, xlog_pos):
+        """ Record the results of a 'status' or 'poll' query run elsewhere
+
+        Instances normally poll themselves, but callers that run the same
+        QueryRegistry queries on their own connections, such as AsyncEngine,
+        can fill in the results with this and set_replication.
+
+        :param version: Server version string, or None if not polled.
+        :param recovery: Whether the instance is in recovery.
+        :param xlog_pos: Current position as a byte offset, if known.
+        """
+
+        if version is not None:
+            self.version = version
+
+        self.__set_position(recovery, xlog_pos)
+
+
+    def set_replication(self, rows, conninfo = None):
+        """ Record the results of a 'replication' query run elsewhere
+
+        :param rows: Rows returned by the 'replication' query.
+        :param conninfo: Connection string from the 'wal_receiver' query,
+            if this is a replica that supports it.
+        """
+
+        self.standbys = [
+            dict(zip(('name', 'client_addr', 'state', 'sync_state', 'sent',
+                'write', 'flush', 'replay', 'lag_bytes', 'lag_seconds'), row))
+            for row in rows
+        ]
+
+        if not conninfo:
+            return
+
+        info = re.search('host\s?=\s?([\w\.-_]+)', conninfo)
+        if info and info.groups(1)[0] != 'localhost':
+            self.master_host = info.groups(1)[0]
+
+        info = re.search('port\s?=\s?(\d+)', conninfo)
+        if info:
+            self.master_port = int(info.groups(1)[0])
+
+
+    def __set_position(self, recovery, xlog_pos):
+        """ Record the role and xlog position reported by the instance
+
+        Callers can use the position to calculate replication lag. For
+        replicas, it's the last replayed location.
+
+        :param recovery: Whether the instance is in recovery.
+        :param xlog_pos: Current position as a byte offset, if known.
+        """
+
+        self.role = recovery and 'slave' or 'master'
+
+        if xlog_pos is not None:
+            self.xlog_pos = int(xlog_pos)
+
+
+    def __poll_replication(self, sql):
+        """ Capture every attached standby, and where this one's master is
+
+        A single query against pg_stat_replication lists each standby
+        streaming from this instance, along with how far it has received,
+        written, flushed, and replayed, and how far it lags behind our own
+        position. Since the master measures all of this itself, lag is
+        accurate without having to compare positions gathered from several
+        hosts. Positions are byte offsets, like xlog_pos.
+
+        Replicas are checked too, since they may have cascaded standbys of
+        their own. On 9.6 and above, they also report the master they're
+        actually streaming from, which supersedes recovery.conf.
+
+        :param sql: QueryRegistry for a connection to this instance.
+        """
+
+        rows = list(sql.execute('replication'))
+        conninfo = None
+
+        if self.role == 'slave' and sql.supports('wal_receiver'):
+            row = sql.execute('wal_receiver').fetchone()
+            conninfo = row and row[0]
+
+        self.set_replication(rows, conninfo)
+
 
 # Set up the object and external callables.
 
-__all__ = ['Instance', 'db_connect']
+__all__ = ['Instance', 'ConnectionPool', 'connect_params', 'db_connect',
+    'async_connect', 'run_parallel']
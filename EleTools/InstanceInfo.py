@@ -0,0 +1,173 @@
+import json
+import marshal
+
+class InstanceInfo(object):
+    """ A compact, connection-free snapshot of an Instance
+
+    Instance objects carry connection pools and other live state, so they
+    can't be cached, pickled, or sent to another process cheaply. This
+    record holds only the reportable fields of an instance at one moment,
+    and nothing else. Snapshots compare equal when all of their fields do,
+    and can be hashed, so finding instances that changed is a simple
+    comparison.
+
+    Snapshots are meant to be treated as read-only once created. They can
+    be serialized as compact JSON arrays, or as binary with marshal for the
+    fastest round trip between processes running the same Python version.
+
+    Standbys, when known, are a tuple of tuples ordered as standby_fields.
+    """
+
+    __slots__ = (
+        'name', 'port', 'version', 'role', 'online', 'pgdata',
+        'master_host', 'master_port', 'xlog_pos', 'standbys', 'invalid',
+    )
+
+    standby_fields = (
+        'name', 'client_addr', 'state', 'sync_state', 'sent', 'write',
+        'flush', 'replay', 'lag_bytes', 'lag_seconds',
+    )
+
+    def __init__(self, name = 'main', port = 5432, version = None,
+        role = 'master', online = False, pgdata = None, master_host = None,
+        master_port = None, xlog_pos = None, standbys = None,
+        invalid = False):
+        """ Record the reportable fields of a single instance
+
+        Parameters match the Instance attributes of the same names. The
+        standbys may be any iterable of sequences, such as decoded JSON.
+        """
+
+        self.name = name
+        self.port = port
+        self.version = version
+        self.role = role
+        self.online = online
+        self.pgdata = pgdata
+        self.master_host = master_host
+        self.master_port = master_port
+        self.xlog_pos = xlog_pos
+        self.invalid = invalid
+        self.standbys = None
+
+        if standbys is not None:
+            self.standbys = tuple(tuple(standby) for standby in standbys)
+
+
+    @classmethod
+    def from_instance(cls, inst):
+        """ Take a snapshot of an Instance
+
+        :param inst: Instance object to copy fields from.
+
+        :retval InstanceInfo: Snapshot of the instance as it is now.
+        """
+
+        standbys = None
+
+        if inst.standbys is not None:
+            standbys = [
+                [standby.get(field) for field in cls.standby_fields]
+                for standby in inst.standbys
+            ]
+
+        return cls(inst.name, inst.port, inst.version, inst.role,
+            inst.online, inst.pgdata, inst.master_host, inst.master_port,
+            inst.xlog_pos, standbys, inst.invalid)
+
+
+    @classmethod
+    def from_json(cls, data):
+        """ Restore a snapshot serialized by to_json. """
+
+        return cls(*json.loads(data))
+
+
+    @classmethod
+    def from_bytes(cls, data):
+        """ Restore a snapshot serialized by to_bytes. """
+
+        return cls(*marshal.loads(data))
+
+
+    def snapshot(self):
+        """ Return this snapshot, so it can stand in for an Instance. """
+
+        return self
+
+
+    def as_tuple(self):
+        """ List every field value, in __slots__ order. """
+
+        return tuple(getattr(self, field) for field in self.__slots__)
+
+
+    def as_dict(self):
+        """ Map every field name to its value
+
+        :retval dict: Field values keyed by name, with each standby as a
+            dictionary keyed by standby_fields.
+        """
+
+        info = dict(zip(self.__slots__, self.as_tuple()))
+
+        if self.standbys is not None:
+            info['standbys'] = [
+                dict(zip(self.standby_fields, standby))
+                for standby in self.standbys
+            ]
+
+        return info
+
+
+    def to_json(self):
+        """ Serialize as a compact JSON array of field values. """
+
+        return json.dumps(self.as_tuple(), separators = (',', ':'))
+
+
+    def to_bytes(self):
+        """ Serialize as marshal data, specific to this Python version. """
+
+        return marshal.dumps(self.as_tuple())
+
+
+    def __eq__(self, other):
+        if not isinstance(other, InstanceInfo):
+            return NotImplemented
+
+        return self.as_tuple() == other.as_tuple()
+
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+
+        if result is NotImplemented:
+            return result
+
+        return not result
+
+
+    def __hash__(self):
+        return hash(self.as_tuple())
+
+
+    def __repr__(self):
+        return 'InstanceInfo(%s)' % ', '.join(
+            '%s=%r' % (field, getattr(self, field))
+            for field in self.__slots__
+        )
+
+
+    def __getstate__(self):
+        return self.as_tuple()
+
+
+    def __setstate__(self, state):
+        for field, value in zip(self.__slots__, state):
+            setattr(self, field, value)
+
+
+# Set up the object and external callables.
+
+__all__ = ['InstanceInfo']
@@ -0,0 +1,180 @@
+import os
+import json
+import time
+import logging
+import tempfile
+import threading
+
+from contextlib import contextmanager
+
+class Metrics(object):
+    """ Record how long each phase of discovery and reporting takes
+
+    Phases are identified by name, along with optional labels such as the
+    instance port. Every time a phase is timed, its total duration and
+    count are accumulated, and the duration is logged at debug level. The
+    accumulated results can be written as a Prometheus node_exporter
+    textfile, or as JSON, so slow probes can be tracked and alerted on.
+
+    A shared 'metrics' object is provided at the module level, and is what
+    the rest of the library uses. Callers should reset it at the start of
+    each run, and write it out at the end.
+    """
+
+    prefix = 'ele_tools'
+
+    def __init__(self):
+        """ Start with no recorded phases. """
+
+        self.__lock = threading.Lock()
+        self.reset()
+
+
+    def reset(self):
+        """ Forget all recorded phases, and start a new run. """
+
+        with self.__lock:
+            self.phases = {}
+            self.started = time.time()
+
+
+    @contextmanager
+    def timer(self, phase, **labels):
+        """ Time the enclosed block as an instance of the given phase
+
+        The block is recorded even if it raises an exception.
+
+        :param phase: Name of the phase being timed.
+        :param labels: Any further identifying labels, such as port.
+        """
+
+        start = time.time()
+
+        try:
+            yield
+        finally:
+            self.record(phase, time.time() - start, **labels)
+
+
+    def record(self, phase, seconds, **labels):
+        """ Add a single timed occurrence of a phase
+
+        :param phase: Name of the phase that was timed.
+        :param seconds: How long this occurrence took.
+        :param labels: Any further identifying labels, such as port.
+        """
+
+        key = (phase, tuple(sorted((k, str(v)) for k, v in labels.items())))
+
+        with self.__lock:
+            (total, count) = self.phases.get(key, (0.0, 0))
+            self.phases[key] = (total + seconds, count + 1)
+
+        logging.debug("Phase %s%s took %.1fms", phase,
+            ''.join(' %s=%s' % label for label in key[1]), seconds * 1000)
+
+
+    def as_dict(self):
+        """ Summarize all recorded phases
+
+        :retval dict: The run start time, and a list of phases, each with
+            its name, labels, total seconds, and count.
+        """
+
+        with self.__lock:
+            phases = sorted(self.phases.items())
+
+        return {
+            'started': self.started,
+            'phases': [
+                {'phase': phase, 'labels': dict(labels),
+                 'seconds': total, 'count': count}
+                for ((phase, labels), (total, count)) in phases
+            ]
+        }
+
+
+    def write_json(self, path):
+        """ Write all recorded phases to a JSON file
+
+        :param path: Full path to the output file.
+        """
+
+        self.__write(path, json.dumps(self.as_dict(), indent = 2))
+
+
+    def write_textfile(self, path):
+        """ Write all recorded phases as a Prometheus textfile
+
+        The node_exporter textfile collector reads every *.prom file in its
+        configured directory. The file is replaced atomically, so a partial
+        file is never collected.
+
+        :param path: Full path to the output file, usually ending in .prom.
+        """
+
+        lines = [
+            '# HELP %s_phase_seconds Seconds spent in each phase of the '
+            'last run.' % self.prefix,
+            '# TYPE %s_phase_seconds gauge' % self.prefix,
+        ]
+
+        counts = [
+            '# HELP %s_phase_count Times each phase occurred in the '
+            'last run.' % self.prefix,
+            '# TYPE %s_phase_count gauge' % self.prefix,
+        ]
+
+        for item in self.as_dict()['phases']:
+            labels = dict(item['labels'], phase = item['phase'])
+            labels = ','.join(
+                '%s="%s"' % (k, self.__escape(v))
+                for k, v in sorted(labels.items())
+            )
+
+            lines.append('%s_phase_seconds{%s} %f' % (
+                self.prefix, labels, item['seconds']))
+            counts.append('%s_phase_count{%s} %d' % (
+                self.prefix, labels, item['count']))
+
+        lines.extend(counts)
+        lines.extend([
+            '# HELP %s_last_run_timestamp_seconds Start time of the last '
+            'run.' % self.prefix,
+            '# TYPE %s_last_run_timestamp_seconds gauge' % self.prefix,
+            '%s_last_run_timestamp_seconds %f' % (self.prefix, self.started),
+        ])
+
+        self.__write(path, '\n'.join(lines) + '\n')
+
+
+    def __escape(self, value):
+        """ Escape a label value for the Prometheus text format. """
+
+        return value.replace('\\', '\\\\').replace('"', '\\"').replace(
+            '\n', '\\n')
+
+
+    def __write(self, path, content):
+        """ Atomically replace a file with the given content. """
+
+        (fd, temp_path) = tempfile.mkstemp(
+            dir = os.path.dirname(path) or os.curdir,
+            prefix = '.' + os.path.basename(path) + '.')
+
+        try:
+            with os.fdopen(fd, 'w') as output:
+                output.write(content)
+
+            os.chmod(temp_path, 0644)
+            os.rename(temp_path, path)
+        except:
+            os.unlink(temp_path)
+            raise
+
+
+metrics = Metrics()
+
+# Set up the object and external callables.
+
+__all__ = ['Metrics', 'metrics']
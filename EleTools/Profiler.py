@@ -0,0 +1,139 @@
+import sys
+import time
+import threading
+
+class SamplingProfiler(object):
+    """ Periodically sample the call stacks of every running thread
+
+    Unlike cProfile, which traces every function call in a single thread,
+    this profiler wakes up every so often and records where each thread
+    currently is. That makes its overhead low and nearly constant, so it
+    can be left running in long-lived processes. The results are
+    statistical, but functions that dominate run time will dominate the
+    samples as well.
+
+    The methods mirror the parts of cProfile.Profile used by the CLI tools,
+    so either can be used interchangeably there.
+    """
+
+    interval = 0.01
+
+    def __init__(self, interval = None):
+        """ Prepare a profiler that hasn't started sampling yet
+
+        :param interval: Seconds between samples. Default: 0.01.
+        """
+
+        if interval:
+            self.interval = float(interval)
+
+        self.samples = 0
+        self.own = {}
+        self.total = {}
+
+        self.__stop = threading.Event()
+        self.__thread = None
+
+
+    def enable(self):
+        """ Start sampling in a background thread. """
+
+        self.__stop.clear()
+        self.__thread = threading.Thread(target = self.__sample)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+
+    def disable(self):
+        """ Stop sampling. """
+
+        self.__stop.set()
+
+        if self.__thread:
+            self.__thread.join()
+            self.__thread = None
+
+
+    def stats(self):
+        """ Summarize all samples, busiest functions first
+
+        :retval list: (function, own samples, total samples) tuples, sorted
+            by total samples. Own samples count the times the function was
+            running itself; total samples include its callees.
+        """
+
+        return sorted(
+            ((func, self.own.get(func, 0), count)
+             for func, count in self.total.items()),
+            key = lambda stat: (stat[2], stat[1]), reverse = True
+        )
+
+
+    def dump_stats(self, path):
+        """ Write all sample counts to a text file
+
+        :param path: Full path to the output file.
+        """
+
+        with open(path, 'w') as output:
+            self.__write(output, None)
+
+
+    def print_stats(self, limit = None):
+        """ Print the busiest functions to standard output
+
+        :param limit: Number of functions to print. Default: all of them.
+        """
+
+        self.__write(sys.stdout, limit)
+
+
+    def __write(self, output, limit):
+        """ Write a sample report to a file object. """
+
+        output.write("%d samples every %sms\n\n" % (
+            self.samples, self.interval * 1000))
+        output.write("%8s %8s %7s  %s\n" % ('own', 'total', 'pct', 'function'))
+
+        for (func, own, total) in self.stats()[:limit]:
+            output.write("%8d %8d %6.1f%%  %s\n" % (
+                own, total, 100.0 * total / max(self.samples, 1), func))
+
+
+    def __sample(self):
+        """ Record the current stack of every other thread until stopped. """
+
+        me = threading.current_thread().ident
+
+        while not self.__stop.wait(self.interval):
+            self.samples += 1
+
+            for (ident, frame) in sys._current_frames().items():
+                if ident == me:
+                    continue
+
+                seen = set()
+                leaf = True
+
+                while frame is not None:
+                    code = frame.f_code
+                    func = '%s:%d(%s)' % (code.co_filename,
+                        code.co_firstlineno, code.co_name)
+
+                    if leaf:
+                        self.own[func] = self.own.get(func, 0) + 1
+                        leaf = False
+
+                    # Recursive functions should only be counted once per
+                    # sample in their totals.
+
+                    if func not in seen:
+                        seen.add(func)
+                        self.total[func] = self.total.get(func, 0) + 1
+
+                    frame = frame.f_back
+
+
+# Set up the object and external callables.
+
+__all__ = ['SamplingProfiler']
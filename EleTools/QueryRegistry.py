@@ -0,0 +1,177 @@
+import psycopg2
+
+# PostgreSQL 10 renamed every xlog function and column to use wal and lsn
+# instead. Queries that need them are written once, and filled in with the
+# names that match each server.
+
+XLOG_NAMES = dict(
+    diff = 'pg_xlog_location_diff',
+    current = 'pg_current_xlog_location()',
+    replay = 'pg_last_xlog_replay_location()',
+    suffix = '_location',
+    lag_seconds = 'NULL',
+)
+
+WAL_NAMES = dict(
+    diff = 'pg_wal_lsn_diff',
+    current = 'pg_current_wal_lsn()',
+    replay = 'pg_last_wal_replay_lsn()',
+    suffix = '_lsn',
+    lag_seconds = 'extract(epoch FROM replay_lag)',
+)
+
+# Current location of an instance: the last replayed location on replicas,
+# and the current write location otherwise. Positions are the same location
+# as a byte offset.
+
+LOCATION = """CASE WHEN pg_is_in_recovery()
+            THEN %(replay)s ELSE %(current)s END"""
+
+POSITION = "%(diff)s(" + LOCATION + ", '0/0')"
+
+STATUS = """
+SELECT substring(version() FROM '\d+(?:\.\d+){1,2}'),
+       pg_is_in_recovery(),
+       (""" + POSITION + """)::BIGINT
+"""
+
+POLL = """
+SELECT pg_is_in_recovery(),
+       (""" + POSITION + """)::BIGINT
+"""
+
+REPLICATION = """
+SELECT application_name, client_addr::TEXT, state, sync_state,
+       %(diff)s(sent%(suffix)s, '0/0')::BIGINT,
+       %(diff)s(write%(suffix)s, '0/0')::BIGINT,
+       %(diff)s(flush%(suffix)s, '0/0')::BIGINT,
+       %(diff)s(replay%(suffix)s, '0/0')::BIGINT,
+       %(diff)s(""" + LOCATION + """, replay%(suffix)s)::BIGINT,
+       %(lag_seconds)s::FLOAT
+  FROM pg_stat_replication
+"""
+
+class QueryRegistry(object):
+    """ Provide the right version of each query for a single connection
+
+    Catalog views and functions are renamed from time to time, so the same
+    information requires different SQL depending on the server version.
+    Every query used to poll instances is listed here by name, with one
+    variant for each range of versions it applies to. The version is taken
+    from the connection itself, so choosing a variant costs nothing.
+
+    Queries run repeatedly, such as by daemons, can also be prepared on the
+    server, so they're only parsed and planned once for the connection.
+    Since prepared statements belong to a connection, each registry should
+    only be used with the connection it was created for.
+    """
+
+    # Each query lists (minimum server_version_num, SQL) pairs, newest
+    # first. A query without a variant for the server version is None.
+
+    queries = {
+        'status': (
+            (100000, STATUS % WAL_NAMES),
+            (0, STATUS % XLOG_NAMES),
+        ),
+        'poll': (
+            (100000, POLL % WAL_NAMES),
+            (0, POLL % XLOG_NAMES),
+        ),
+        'databases': (
+            (0, "SELECT datname FROM pg_stat_database"
+                " WHERE datname NOT LIKE 'template_'"),
+        ),
+        'replication': (
+            (100000, REPLICATION % WAL_NAMES),
+            (0, REPLICATION % XLOG_NAMES),
+        ),
+        'wal_receiver': (
+            (90600, "SELECT conninfo FROM pg_stat_wal_receiver"),
+        ),
+        'database_stats': (
+            (0, "SELECT datname, numbackends, xact_commit, xact_rollback,"
+                "       blks_read, blks_hit, tup_inserted, tup_updated,"
+                "       tup_deleted, temp_bytes, deadlocks"
+                "  FROM pg_stat_database"
+                " WHERE datname NOT LIKE 'template_'"),
+        ),
+    }
+
+    prefix = 'ele_'
+
+    def __init__(self, conn, prepare = False):
+        """ Choose queries to match the server of a connection
+
+        :param conn: psycopg2 connection these queries will be used with.
+        :param prepare: Set to True to prepare each query on the server the
+            first time it's executed, and execute the prepared statement
+            from then on. Default: False.
+        """
+
+        self.conn = conn
+        self.prepare = prepare
+        self.version = getattr(conn, 'server_version', 0)
+        self.prepared = set()
+
+
+    def get(self, name):
+        """ Get the SQL of a named query for this server version
+
+        :param name: Name of the query to retrieve.
+
+        :retval string: The SQL, or None if this version has no such query.
+        """
+
+        for (version, sql) in self.queries[name]:
+            if self.version >= version:
+                return sql
+
+        return None
+
+
+    def supports(self, name):
+        """ Check whether a named query applies to this server version. """
+
+        return self.get(name) is not None
+
+
+    def execute(self, name, cur = None):
+        """ Execute a named query, preparing it first if necessary
+
+        :param name: Name of the query to execute.
+        :param cur: Cursor to execute with. Default: a new cursor on the
+            registry's connection.
+
+        :retval cursor: The cursor, ready to fetch results from.
+
+        :raises psycopg2.ProgrammingError: If this server version has no
+            such query.
+        """
+
+        sql = self.get(name)
+
+        if sql is None:
+            raise psycopg2.ProgrammingError(
+                "Query %s is not supported by server version %s" % (
+                    name, self.version))
+
+        if cur is None:
+            cur = self.conn.cursor()
+
+        if not self.prepare:
+            cur.execute(sql)
+            return cur
+
+        if name not in self.prepared:
+            cur.execute("PREPARE %s%s AS %s" % (self.prefix, name, sql))
+            self.prepared.add(name)
+
+        cur.execute("EXECUTE %s%s" % (self.prefix, name))
+
+        return cur
+
+
+# Set up the object and external callables.
+
+__all__ = ['QueryRegistry']
@@ -0,0 +1,638 @@
+import sys
+import json
+import time
+import Queue
+import socket
+import logging
+import threading
+import psycopg2
+
+from cStringIO import StringIO
+
+from EleTools.Instance import db_connect
+from EleTools.Metrics import metrics
+
+class Reporter(object):
+    """ Transmit local PostgreSQL instance information upstream
+
+    This class handles communication with a remote ElepHaaS administration
+    database. It maintains a single upstream connection, which is opened when
+    first needed and reused for every subsequent transmission. If that
+    connection fails, it's discarded so the next transmission can try again
+    with a fresh one.
+
+    To avoid overloading the remote admin system, only instances that have
+    changed since their last successful transmission are sent, and only
+    with the fields that changed. Changes are tracked with a StateStore,
+    when one is provided.
+    """
+
+    conn = None
+    state = None
+    xlog_bytes = 0
+    xlog_seconds = 0
+    connect_timeout = None
+    statement_timeout = None
+
+    key_fields = ('sHost', 'sHerd', 'nPort')
+
+    # Fields that change continuously on a busy instance, and are subject to
+    # the xlog thresholds when nothing else has changed.
+
+    position_fields = ('nXlog', 'aStandbys')
+
+    # InstanceInfo.standby_fields, and the check-in keys used to send them.
+
+    standby_fields = (
+        ('name', 'sName'), ('client_addr', 'sClientAddr'),
+        ('state', 'sState'), ('sync_state', 'sSyncState'),
+        ('sent', 'nSent'), ('write', 'nWrite'), ('flush', 'nFlush'),
+        ('replay', 'nReplay'), ('lag_bytes', 'nLagBytes'),
+        ('lag_seconds', 'fLagSeconds'),
+    )
+
+    # DatabaseStats fields, and the check-in keys used to send them.
+
+    database_fields = (
+        ('database', 'sDatabase'), ('stats_time', 'fStatsTime'),
+        ('detail_time', 'fDetailTime'), ('size_bytes', 'nSizeBytes'),
+        ('tables', 'nTables'), ('table_bytes', 'nTableBytes'),
+        ('bloat_bytes', 'nBloatBytes'), ('dead_tuples', 'nDeadTuples'),
+        ('numbackends', 'nBackends'), ('xact_commit', 'nCommits'),
+        ('xact_rollback', 'nRollbacks'), ('blks_read', 'nBlocksRead'),
+        ('blks_hit', 'nBlocksHit'), ('tup_inserted', 'nInserted'),
+        ('tup_updated', 'nUpdated'), ('tup_deleted', 'nDeleted'),
+        ('temp_bytes', 'nTempBytes'), ('deadlocks', 'nDeadlocks'),
+    )
+
+    # Columns of the upstream staging table, in the order bulk transmissions
+    # COPY them, along with the instance field that fills each.
+
+    stage_columns = (
+        ('hostname', 'sHost'), ('herd', 'sHerd'), ('db_port', 'nPort'),
+        ('version', 'sVer'), ('is_online', 'bOnline'),
+        ('pgdata', 'sDataDir'), ('master_host', 'sMasterHost'),
+        ('xlog_pos', 'nXlog'),
+    )
+
+    def __init__(self, conf, state = None, host = None, xlog_bytes = 0,
+        xlog_seconds = 0, connect_timeout = None, statement_timeout = None):
+        """ Prepare to report to an upstream admin database
+
+        :param conf: Config container with db_host, db_port, db_user, and
+            db_name attributes describing the upstream database.
+        :param state: StateStore used to skip instances that haven't changed
+            since they were last transmitted. If not provided, every
+            instance is transmitted on every call.
+        :param host: Hostname to report instances under. Default: the
+            name of the current system.
+        :param xlog_bytes: If the xlog position is the only change, only
+            transmit once it has moved at least this many bytes.
+        :param xlog_seconds: If the xlog position is the only change, only
+            transmit once this many seconds have passed since the last
+            transmission.
+        :param connect_timeout: Seconds to wait when connecting upstream.
+            Default: wait indefinitely.
+        :param statement_timeout: Seconds any upstream call may run before
+            the server cancels it. Default: no limit.
+        """
+
+        self.conf = conf
+        self.state = state
+        self.host = host or socket.gethostname()
+        self.xlog_bytes = int(xlog_bytes or 0)
+        self.xlog_seconds = float(xlog_seconds or 0)
+        self.connect_timeout = connect_timeout
+        self.statement_timeout = statement_timeout
+
+
+    def connect(self):
+        """ Get the upstream connection, connecting if necessary
+
+        :retval connection: A psycopg2 connection to the admin database.
+        """
+
+        if self.conn is None or self.conn.closed:
+            logging.debug("Connecting to %s", self.conf.db_host)
+
+            self.conn = db_connect(self.conf.db_host, self.conf.db_user,
+                self.conf.db_name, self.conf.db_port, self.connect_timeout,
+                self.statement_timeout)
+
+        return self.conn
+
+
+    def close(self):
+        """ Close the upstream connection, if there is one. """
+
+        if self.conn is not None and not self.conn.closed:
+            try:
+                self.conn.close()
+            except psycopg2.Error:
+                pass
+
+        self.conn = None
+
+
+    def transmit(self, instances, prune = True):
+        """ Send any changed instances to the upstream admin database
+
+        Every changed instance is sent in a single batch call, so the remote
+        system only needs one round trip and one server lookup for this
+        host. Once that succeeds, the current information is saved in the
+        state store for the next iteration; any problems will prevent the
+        save, so we can try again later.
+
+        If the upstream connection fails, it's closed before the exception
+        is re-raised, so the next call will reconnect.
+
+        :param instances: Iterable of Instance or InstanceInfo objects to
+            report.
+        :param prune: Forget the state of any instance not listed. Set this
+            to False when only reporting some of the local instances.
+            Default: True.
+
+        :retval int: Number of instances transmitted.
+        """
+
+        changed = []
+        current = []
+
+        for inst in instances:
+            inst = inst.snapshot()
+
+            if inst.invalid:
+                continue
+
+            current.append((inst.name, inst.port))
+
+            change = self.change(inst)
+            if change:
+                changed.append(change)
+
+        self.__send(changed)
+        self.save(current, prune)
+
+        return len(changed)
+
+
+    def transmit_stream(self, instances, prune = True):
+        """ Send changed instances upstream while they're still being found
+
+        This works like transmit, except that instances are sent from a
+        separate thread as soon as the iterable produces them. Whenever the
+        upstream system is busy with one batch, any instances produced in
+        the meantime are gathered into the next one. This way, probing
+        local instances and transmitting them overlap, rather than one
+        waiting for the other.
+
+        If sending fails, the remaining instances are still consumed, but
+        not sent. The error is re-raised once the iterable is exhausted.
+
+        :param instances: Iterable of Instance or InstanceInfo objects to
+            report, such as the generator returned by
+            Environment.iter_snapshots.
+        :param prune: See transmit.
+
+        :retval int: Number of instances transmitted.
+        """
+
+        pending = Queue.Queue()
+        status = {'sent': 0, 'error': None}
+
+        def sender():
+            done = False
+
+            while not done:
+                batch = [pending.get()]
+
+                while True:
+                    try:
+                        batch.append(pending.get_nowait())
+                    except Queue.Empty:
+                        break
+
+                if None in batch:
+                    batch.remove(None)
+                    done = True
+
+                if status['error'] or not batch:
+                    continue
+
+                try:
+                    self.__send(batch)
+                    status['sent'] += len(batch)
+                except Exception:
+                    status['error'] = sys.exc_info()
+
+        thread = threading.Thread(target = sender)
+        thread.daemon = True
+        thread.start()
+
+        current = []
+
+        try:
+            for inst in instances:
+                inst = inst.snapshot()
+
+                if inst.invalid:
+                    continue
+
+                current.append((inst.name, inst.port))
+
+                change = self.change(inst)
+                if change:
+                    pending.put(change)
+        finally:
+            pending.put(None)
+            thread.join()
+
+        if status['error']:
+            raise status['error'][0], status['error'][1], status['error'][2]
+
+        self.save(current, prune)
+
+        return status['sent']
+
+
+    def transmit_bulk(self, instances, prune = True):
+        """ Send every instance upstream in bulk, whether it changed or not
+
+        This is meant for resynchronizing the upstream system after it has
+        lost track of instances, such as after an admin database failover,
+        or when the local state store is gone. Rather than calling a
+        function for each instance, every instance is streamed with COPY
+        into an upstream staging table, and then merged into the instance
+        table with a single statement. Replication topology is sent in the
+        same transaction, with one call for each instance that has it.
+
+        Since everything is sent regardless, the state store is only
+        updated, not consulted.
+
+        :param instances: Iterable of Instance or InstanceInfo objects to
+            report.
+        :param prune: See transmit.
+
+        :retval int: Number of instances transmitted.
+        """
+
+        records = []
+        current = []
+
+        for inst in instances:
+            inst = inst.snapshot()
+
+            if inst.invalid:
+                continue
+
+            current.append((inst.name, inst.port))
+            records.append(((inst.name, inst.port), self.__info(inst)))
+
+        if not records:
+            self.save(current, prune)
+            return 0
+
+        data = StringIO()
+
+        for key, info in records:
+            data.write('\t'.join(
+                self.__copy_value(info[field])
+                for column, field in self.stage_columns
+            ) + '\n')
+
+        data.seek(0)
+
+        try:
+            with metrics.timer('upstream_connect'):
+                cur = self.connect().cursor()
+
+            # The staged rows only belong to this transaction, so an error
+            # anywhere discards them along with any partial merge.
+
+            with metrics.timer('checkin_bulk'):
+                cur.execute("BEGIN")
+
+                try:
+                    cur.copy_expert(
+                        "COPY utility.ele_instance_stage (%s) FROM STDIN" %
+                        ', '.join(c for c, f in self.stage_columns), data
+                    )
+                    cur.execute("SELECT utility.sp_instance_merge()")
+                    skipped = cur.fetchone()[0]
+
+                    for key, info in records:
+                        if info['aStandbys'] is None:
+                            continue
+
+                        cur.execute(
+                            "SELECT utility.sp_replication_checkin(%s, %s, %s)",
+                            (self.host, info['nPort'],
+                             json.dumps(info['aStandbys']))
+                        )
+
+                    cur.execute("COMMIT")
+                except psycopg2.Error:
+                    if not self.conn.closed:
+                        cur.execute("ROLLBACK")
+                    raise
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            self.close()
+            raise
+
+        self.record(
+            [(key, info, None) for key, info in records], skipped
+        )
+
+        self.save(current, prune)
+
+        return len(records)
+
+
+    def transmit_databases(self, stats):
+        """ Send per-database statistics upstream
+
+        Activity counters change on every collection, so there's no point
+        checking them against the state store. Instead, the databases of
+        every instance replace whatever was last recorded for it, all in a
+        single transaction.
+
+        :param stats: Dictionary of database lists, keyed by instance port,
+            as returned by DatabaseStats.collect_all.
+
+        :retval int: Number of databases transmitted.
+        """
+
+        if not stats:
+            return 0
+
+        count = 0
+
+        try:
+            with metrics.timer('upstream_connect'):
+                cur = self.connect().cursor()
+
+            with metrics.timer('checkin_databases'):
+                cur.execute("BEGIN")
+
+                try:
+                    for port, databases in sorted(stats.items()):
+                        cur.execute(
+                            "SELECT utility.sp_database_checkin(%s, %s, %s)",
+                            (self.host, port, json.dumps([
+                                dict((name, db.get(field))
+                                     for field, name in self.database_fields)
+                                for db in databases
+                            ]))
+                        )
+                        count += len(databases)
+
+                    cur.execute("COMMIT")
+                except psycopg2.Error:
+                    if not self.conn.closed:
+                        cur.execute("ROLLBACK")
+                    raise
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            self.close()
+            raise
+
+        return count
+
+
+    def __info(self, inst):
+        """ Gather every field transmitted for an instance
+
+        :param inst: InstanceInfo snapshot to describe.
+
+        :retval dict: Instance fields, keyed by check-in parameter name.
+        """
+
+        standbys = None
+
+        if inst.standbys is not None:
+            standbys = [
+                dict((name, standby.get(attr))
+                     for attr, name in self.standby_fields)
+                for standby in inst.as_dict()['standbys']
+            ]
+
+        return dict(
+            sHost = self.host, sHerd = inst.name, nPort = inst.port,
+            sVer = inst.version, bOnline = inst.online,
+            sDataDir = inst.pgdata, sMasterHost = inst.master_host,
+            nXlog = inst.xlog_pos, aStandbys = standbys
+        )
+
+
+    def __copy_value(self, value):
+        """ Format a single value for COPY's text format. """
+
+        if value is None:
+            return '\\N'
+
+        if isinstance(value, bool):
+            return value and 't' or 'f'
+
+        return str(value).replace('\\', '\\\\').replace(
+            '\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+    def change(self, inst):
+        """ Determine what, if anything, should be sent for an instance
+
+        The transmit methods call this for every instance. It's public so
+        other senders, such as AsyncEngine, can make the same decisions.
+
+        :param inst: InstanceInfo snapshot to check.
+
+        :retval tuple: (key, curr_info, delta) for the instance, or None if
+            nothing needs to be sent.
+        """
+
+        key = (inst.name, inst.port)
+        curr_info = self.__info(inst)
+
+        # Only transmit data when at least one optional field has changed
+        # since the last successful transmission, and then only send the
+        # fields that changed. We can quickly find any differences by
+        # checking against our state store, if available. If there is no
+        # previous state, everything is sent, since the stored procedure
+        # may need to INSERT a new instance.
+
+        with metrics.timer('state_compare', port = inst.port):
+            (stamp, prev_info) = (None, None)
+            if self.state:
+                (stamp, prev_info) = self.state.get(key)
+
+            delta = self.__delta(curr_info, prev_info, stamp)
+
+        if not delta:
+            logging.debug(" * %s hasn't changed since last xmit.", inst.name)
+            return None
+
+        logging.debug(" * " + ', '.join(str(x) for x in (
+            self.host, inst.name, inst.port, inst.version, inst.role,
+            inst.online, inst.pgdata, inst.master_host, inst.master_port,
+            inst.xlog_pos))
+        )
+
+        return (key, curr_info, delta)
+
+
+    def __send(self, changed):
+        """ Transmit a batch of changes in a single upstream call
+
+        Once the call succeeds, each instance is recorded in the state
+        store, though the store isn't saved until the caller is finished.
+
+        :param changed: List of (key, curr_info, delta) tuples.
+        """
+
+        if not changed:
+            return
+
+        try:
+            with metrics.timer('upstream_connect'):
+                cur = self.connect().cursor()
+
+            with metrics.timer('checkin'):
+                cur.execute(*self.checkin_call(changed))
+                skipped = cur.fetchone()[0]
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            self.close()
+            raise
+
+        self.record(changed, skipped)
+
+
+    def checkin_call(self, changed):
+        """ Build the upstream call that checks in a batch of changes
+
+        :param changed: List of (key, curr_info, delta) tuples, as returned
+            by change.
+
+        :retval tuple: (SQL, parameters) ready to execute. The call returns
+            a single row, holding the ports of any instances that couldn't
+            be registered; see record.
+        """
+
+        return ("SELECT utility.sp_instance_checkin_batch(%s, %s)",
+            (self.host, json.dumps([d for k, i, d in changed])))
+
+
+    def record(self, changed, skipped = None):
+        """ Note a batch of changes as sent, once the check-in succeeds
+
+        The upstream system can't register a new instance until a herd
+        exists for it. Since only changes are sent after the first check-in,
+        any instance it skipped is forgotten instead, so it's sent in full
+        again next time.
+
+        This only changes the state store in memory; see save.
+
+        :param changed: List of (key, curr_info, delta) tuples.
+        :param skipped: Ports the upstream system couldn't register, if any.
+        """
+
+        if not self.state:
+            return
+
+        skipped = set(int(port) for port in skipped or ())
+
+        for key, curr_info, delta in changed:
+            if int(curr_info['nPort']) in skipped:
+                logging.info("Upstream has no herd for %s on port %s yet",
+                    curr_info['sHerd'], curr_info['nPort'])
+                self.state.forget(key)
+            else:
+                self.state.update(key, curr_info)
+
+
+    def save(self, current, prune = True):
+        """ Save the state store after a transmission
+
+        :param current: List of keys for every instance just reported.
+        :param prune: Forget the state of any instance not in 'current'.
+        """
+
+        if not self.state:
+            return
+
+        if prune:
+            self.state.retain(current)
+
+        with metrics.timer('state_save'):
+            self.state.save()
+
+
+    def __delta(self, curr_info, prev_info, stamp):
+        """ Determine which fields need to be transmitted for an instance
+
+        Only fields that differ from the previous transmission are included,
+        along with the fields that identify the instance. WAL movement alone
+        is ignored until it passes the configured byte or time threshold, so
+        an active master doesn't cause an upstream write on every report.
+        The same applies to standbys whose positions moved, as long as none
+        of them connected, disconnected, or changed state. If anything else
+        changed, the current positions are sent along with it.
+
+        :param curr_info: Dictionary of current instance information.
+        :param prev_info: Dictionary of previously transmitted information,
+            or None if there is none.
+        :param stamp: Time of the previous transmission, if any.
+
+        :retval dict: Fields to transmit, or an empty dict if none.
+        """
+
+        if prev_info is None:
+            return dict(curr_info)
+
+        delta = dict(
+            (k, v) for k, v in curr_info.items()
+            if k not in self.key_fields and prev_info.get(k) != v
+        )
+
+        thresholds = self.xlog_bytes or self.xlog_seconds
+
+        moving = set(delta) <= set(self.position_fields) and (
+            'aStandbys' not in delta or
+            self.__topology(curr_info) == self.__topology(prev_info)
+        )
+
+        if delta and moving and thresholds:
+            moved = abs((curr_info['nXlog'] or 0) - (prev_info['nXlog'] or 0))
+            age = time.time() - stamp
+
+            if not (self.xlog_bytes and moved >= self.xlog_bytes or
+                    self.xlog_seconds and age >= self.xlog_seconds):
+                return {}
+
+        if not delta:
+            return {}
+
+        for k in self.key_fields:
+            delta[k] = curr_info[k]
+
+        return delta
+
+
+    def __topology(self, info):
+        """ Describe the attached standbys, ignoring their positions
+
+        :param info: Dictionary of instance information.
+
+        :retval list: Sorted (name, address, state, sync state) tuples, or
+            None if standbys weren't checked.
+        """
+
+        if info.get('aStandbys') is None:
+            return None
+
+        return sorted(
+            (s['sName'], s['sClientAddr'], s['sState'], s['sSyncState'])
+            for s in info['aStandbys']
+        )
+
+
+# Set up the object and external callables.
+
+__all__ = ['Reporter']
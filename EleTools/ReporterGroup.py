@@ -0,0 +1,411 @@
+import sys
+import time
+import Queue
+import logging
+import functools
+import threading
+
+class ReporterGroup(object):
+    """ Send the same instances to several upstream admin databases at once
+
+    Some sites run more than one ElepHaaS administration system, such as
+    one in each datacenter. Rather than discovering local instances once
+    for each of them, this class discovers them once, and hands the same
+    snapshots to a Reporter for every upstream system. Each Reporter keeps
+    its own connection and state store, so changes are tracked separately
+    for each upstream.
+
+    Every upstream is sent to from its own thread, so one that is slow or
+    down doesn't hold up the others. Failures are counted for each upstream
+    separately. An upstream that fails is logged, its connection is closed,
+    and it's skipped until an exponentially growing backoff has passed,
+    while the others carry on as usual. Those that succeeded still save
+    their state, so retrying only resends what failed.
+
+    By default, every transmission waits for every upstream to finish. If
+    'wait' is set, it waits no longer than that many seconds after
+    discovery is finished. Any upstream still busy then is left to finish
+    in the background, and is skipped until it does.
+
+    The transmit methods work just like those of Reporter, except that they
+    don't raise upstream errors; see failing. They return the number of
+    instances transmitted to each upstream that succeeded, keyed by label.
+    """
+
+    retry_min = 1
+    retry_max = 300
+    wait = None
+
+    def __init__(self, reporters, retry_min = None, retry_max = None):
+        """ Group several Reporters together
+
+        :param reporters: Dictionary of Reporter objects, keyed by a label
+            for each upstream system, such as its config section.
+        :param retry_min: Seconds to skip an upstream after it first fails.
+            This doubles with every further failure. Default: 1.
+        :param retry_max: Most seconds an upstream is ever skipped for.
+            Default: 300.
+        """
+
+        self.reporters = dict(reporters)
+
+        if retry_min is not None:
+            self.retry_min = float(retry_min)
+
+        if retry_max is not None:
+            self.retry_max = float(retry_max)
+
+        self.__failures = {}
+        self.__retry = {}
+        self.__busy = set()
+        self.__lock = threading.Lock()
+
+
+    def close(self):
+        """ Close every upstream connection. """
+
+        for reporter in self.reporters.values():
+            reporter.close()
+
+
+    def only(self, labels):
+        """ Get a group of just some of these upstreams
+
+        The new group shares failure counts and backoffs with this one, so
+        sending through either is tracked the same way.
+
+        :param labels: Labels of the upstreams to include.
+
+        :retval object: ReporterGroup for the listed upstreams.
+        """
+
+        group = ReporterGroup(
+            (label, self.reporters[label])
+            for label in labels if label in self.reporters
+        )
+
+        group.retry_min = self.retry_min
+        group.retry_max = self.retry_max
+        group.wait = self.wait
+        group.__failures = self.__failures
+        group.__retry = self.__retry
+        group.__busy = self.__busy
+        group.__lock = self.__lock
+
+        return group
+
+
+    def failing(self):
+        """ Count consecutive failures for every upstream that is failing
+
+        :retval dict: Number of failures in a row, keyed by label.
+        """
+
+        with self.__lock:
+            return dict(
+                (label, count) for label, count in self.__failures.items()
+                if label in self.reporters
+            )
+
+
+    def retrying(self):
+        """ List failing upstreams whose backoff has passed
+
+        :retval list: Labels of the upstreams that should be retried now.
+        """
+
+        return sorted(
+            label for label in self.failing()
+            if label in self.__due()
+        )
+
+
+    def next_retry(self):
+        """ Find when the next failing upstream should be retried
+
+        Upstreams still busy with an earlier transmission aren't counted,
+        since they can't be retried until they finish.
+
+        :retval float: Time of the earliest retry, or None if no upstream
+            is waiting for one.
+        """
+
+        with self.__lock:
+            times = [
+                self.__retry[label] for label in self.__failures
+                if label in self.reporters and label not in self.__busy
+            ]
+
+        return times and min(times) or None
+
+
+    def transmit(self, instances, prune = True):
+        """ Send changed instances to every upstream. See Reporter. """
+
+        return self.__fan_out('transmit', instances, prune)
+
+
+    def transmit_stream(self, instances, prune = True):
+        """ Stream changed instances to every upstream. See Reporter. """
+
+        return self.__fan_out('transmit_stream', instances, prune)
+
+
+    def transmit_bulk(self, instances, prune = True):
+        """ Send every instance to every upstream in bulk. See Reporter. """
+
+        return self.__fan_out('transmit_bulk', instances, prune)
+
+
+    def transmit_async(self, engine, env, timeout = None, incremental = False,
+        prune = True):
+        """ Discover and send changes with an AsyncEngine
+
+        This does what AsyncEngine.report does, but only for upstreams that
+        aren't backing off, and counts their failures like the other
+        transmit methods.
+
+        :param engine: AsyncEngine to probe and check in with.
+        :param env: Environment to discover instances with.
+        :param timeout: See AsyncEngine.report.
+        :param incremental: See AsyncEngine.report.
+        :param prune: See Reporter.transmit.
+
+        :retval dict: Number of instances transmitted, keyed by label.
+        """
+
+        labels = self.__due()
+
+        if not labels:
+            return {}
+
+        errors = {}
+
+        with self.__lock:
+            self.__busy.update(labels)
+
+        try:
+            sent = engine.report(env,
+                dict((label, self.reporters[label]) for label in labels),
+                timeout, incremental, prune, errors)
+        finally:
+            with self.__lock:
+                self.__busy.difference_update(labels)
+
+        for label in labels:
+            if label in errors:
+                self.__failed(label, errors[label])
+            else:
+                self.__succeeded(label)
+
+        return dict(
+            (label, count) for label, count in sent.items()
+            if label not in errors
+        )
+
+
+    def transmit_databases(self, stats):
+        """ Send per-database statistics to every upstream. See Reporter. """
+
+        def send(reporter):
+            return reporter.transmit_databases(stats)
+
+        return self.__call_all(dict.fromkeys(self.__due(), send))
+
+
+    def __due(self):
+        """ List the upstreams that should be sent to right now
+
+        :retval list: Labels of upstreams that aren't backing off after a
+            failure, or still busy with an earlier transmission.
+        """
+
+        now = time.time()
+
+        with self.__lock:
+            return sorted(
+                label for label in self.reporters
+                if label not in self.__busy and
+                    self.__retry.get(label, 0) <= now
+            )
+
+
+    def __succeeded(self, label):
+        """ Clear the failure count of an upstream. """
+
+        with self.__lock:
+            self.__failures.pop(label, None)
+            self.__retry.pop(label, None)
+
+
+    def __failed(self, label, error):
+        """ Count a failure for an upstream, and start its backoff
+
+        :param label: Label of the upstream that failed.
+        :param error: sys.exc_info() for the failure.
+        """
+
+        self.reporters[label].close()
+
+        with self.__lock:
+            count = self.__failures.get(label, 0) + 1
+            delay = min(self.retry_max, self.retry_min * 2 ** (count - 1))
+
+            self.__failures[label] = count
+            self.__retry[label] = time.time() + delay
+
+        logging.error("Could not report to %s (attempt %s), retrying in %s " +
+            "seconds: %s", label, count, delay, error[1])
+
+
+    def __fan_out(self, method, instances, prune):
+        """ Feed the same instances to a transmit method of every Reporter
+
+        Instances are taken from the iterable once, as snapshots, and
+        queued for each Reporter separately. That way, an upstream that is
+        slow to receive them never stops the others, or discovery itself,
+        from moving on.
+
+        If discovery fails part way, every Reporter is stopped before it
+        saves or prunes anything, and the error is raised from here. It
+        isn't counted against any upstream, since none of them caused it.
+
+        :param method: Name of the Reporter method to call.
+        :param instances: Iterable of Instance or InstanceInfo objects.
+        :param prune: See Reporter.transmit.
+
+        :retval dict: Number of instances transmitted, keyed by label.
+        """
+
+        labels = self.__due()
+        queues = dict((label, Queue.Queue()) for label in labels)
+        aborted = []
+
+        def feed(pending, done):
+            while True:
+                info = pending.get()
+
+                if info is None:
+                    done.append(True)
+                    return
+
+                if info is aborted:
+                    done.append(True)
+                    raise aborted[0], aborted[1], aborted[2]
+
+                yield info
+
+        def send(reporter, pending):
+            done = []
+
+            try:
+                return getattr(reporter, method)(feed(pending, done), prune)
+
+            # If sending stopped early, keep consuming, so the queue doesn't
+            # hold every remaining instance for nothing.
+
+            finally:
+                if not done:
+                    for info in feed(pending, done):
+                        pass
+
+        tasks = dict(
+            (label, functools.partial(send, pending = queues[label]))
+            for label in labels
+        )
+
+        return self.__call_all(tasks,
+            functools.partial(self.__feed_all, instances, queues, aborted),
+            aborted)
+
+
+    def __feed_all(self, instances, queues, aborted):
+        """ Queue a snapshot of every instance for every Reporter
+
+        :param instances: Iterable of Instance or InstanceInfo objects.
+        :param queues: Dictionary of queues to fill, keyed by label.
+        :param aborted: Empty list. If the iterable fails, this is filled
+            with sys.exc_info(), and queued in place of the end marker.
+        """
+
+        last = None
+
+        try:
+            for inst in instances:
+                info = inst.snapshot()
+
+                for pending in queues.values():
+                    pending.put(info)
+        except Exception:
+            aborted.extend(sys.exc_info())
+            last = aborted
+            raise
+        finally:
+            for pending in queues.values():
+                pending.put(last)
+
+
+    def __call_all(self, tasks, feed = None, aborted = None):
+        """ Call a function for every Reporter, each in its own thread
+
+        Every call is tracked as a success or failure of its upstream. Any
+        error from 'feed' itself is raised as usual.
+
+        :param tasks: Dictionary of functions keyed by label. Each is called
+            with the Reporter for its label.
+        :param feed: Optional function to call in this thread while the
+            others run, such as one feeding them instances.
+        :param aborted: Optional list that 'feed' fills with sys.exc_info()
+            if it fails. A task that raises that same error isn't counted
+            as a success or failure of its upstream.
+
+        :retval dict: Return value of each function that succeeded, keyed
+            by label.
+        """
+
+        results = {}
+
+        with self.__lock:
+            self.__busy.update(tasks)
+
+        def run(label, reporter):
+            try:
+                results[label] = tasks[label](reporter)
+                self.__succeeded(label)
+            except Exception:
+                if not aborted or sys.exc_info()[1] is not aborted[1]:
+                    self.__failed(label, sys.exc_info())
+            finally:
+                with self.__lock:
+                    self.__busy.discard(label)
+
+        threads = []
+
+        for label in sorted(tasks):
+            thread = threading.Thread(target = run,
+                args = (label, self.reporters[label]))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        # Only wait so long for slow upstreams, if there's a limit. They
+        # stay busy until they finish, so they're skipped until then.
+
+        try:
+            if feed:
+                feed()
+        finally:
+            deadline = time.time() + (self.wait or 0)
+
+            for thread in threads:
+                if self.wait is None:
+                    thread.join()
+                else:
+                    thread.join(max(0, deadline - time.time()))
+
+        return dict(results)
+
+
+# Set up the object and external callables.
+
+__all__ = ['ReporterGroup']
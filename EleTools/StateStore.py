@@ -0,0 +1,179 @@
+import os
+import time
+import errno
+import pickle
+import logging
+import tempfile
+
+class StateStore(object):
+    """ Track the last transmitted state of every local instance
+
+    Reporting tools should only send instance information upstream when it
+    has changed. This class keeps the last successfully transmitted
+    information for every instance in a single file, which is read once when
+    the store is created, and replaced atomically whenever it is saved. That
+    way, a failed or interrupted write can never leave a partial state
+    behind.
+
+    Entries also remember when they were last sent. If a maximum age is set,
+    any entry older than that is considered changed, so every instance is
+    sent again at least once per period even if nothing else happened.
+    """
+
+    max_age = None
+
+    def __init__(self, state_file, max_age = None):
+        """ Load the state file, if it exists
+
+        :param state_file: Full path to the file where state is stored. The
+            containing directory is created if necessary.
+        :param max_age: Seconds after which an entry is always considered
+            changed. Zero or None disables this. Default: None.
+        """
+
+        self.state_file = os.path.expanduser(state_file)
+        self.entries = {}
+
+        if max_age:
+            self.max_age = float(max_age)
+
+        self.load()
+
+
+    def load(self):
+        """ Read all entries from the state file
+
+        A missing or unreadable state file simply results in an empty store,
+        so every instance will be considered changed. Anything but a missing
+        file is logged first.
+        """
+
+        self.entries = {}
+
+        try:
+            with open(self.state_file, 'rb') as state:
+                entries = pickle.load(state)
+
+            if not isinstance(entries, dict):
+                raise ValueError("Expected a dictionary, not %s" %
+                    type(entries).__name__)
+
+            self.entries = entries
+
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                logging.error("Could not read state file %s: %s",
+                    self.state_file, e)
+        except Exception, e:
+            logging.error("Ignoring corrupt state file %s: %s",
+                self.state_file, e)
+
+
+    def changed(self, key, info):
+        """ Check whether information differs from what was last stored
+
+        :param key: Hashable key identifying the instance.
+        :param info: Current information for this instance.
+
+        :retval bool: True if the information differs, was never stored, or
+            is older than the maximum age.
+        """
+
+        (stamp, prev_info) = self.get(key)
+
+        if stamp is None:
+            return True
+
+        return info != prev_info
+
+
+    def get(self, key):
+        """ Get the information last stored for an instance
+
+        Entries older than the maximum age are treated as if they were never
+        stored, so callers will send everything again.
+
+        :param key: Hashable key identifying the instance.
+
+        :retval tuple: (timestamp, info) of the last transmission, or
+            (None, None) if there is no current entry.
+        """
+
+        if key not in self.entries:
+            return (None, None)
+
+        (stamp, info) = self.entries[key]
+
+        if self.max_age and time.time() - stamp >= self.max_age:
+            return (None, None)
+
+        return (stamp, info)
+
+
+    def update(self, key, info):
+        """ Record information as successfully transmitted
+
+        This only changes the in-memory copy; call save to keep it.
+
+        :param key: Hashable key identifying the instance.
+        :param info: Information that was transmitted for this instance.
+        """
+
+        self.entries[key] = (time.time(), info)
+
+
+    def forget(self, key):
+        """ Forget one entry, so it's considered changed next time
+
+        :param key: Hashable key identifying the instance.
+        """
+
+        self.entries.pop(key, None)
+
+
+    def retain(self, keys):
+        """ Forget every entry not in the given list of keys
+
+        This keeps entries for removed instances from piling up. Should any
+        of them return, they'll simply be considered changed.
+
+        :param keys: Iterable of keys that should be kept.
+        """
+
+        keys = set(keys)
+
+        for key in list(self.entries):
+            if key not in keys:
+                del self.entries[key]
+
+
+    def save(self):
+        """ Atomically replace the state file with the current entries
+
+        The entries are written to a temporary file in the same directory,
+        which is then renamed over the old state file.
+        """
+
+        state_dir = os.path.dirname(self.state_file) or os.curdir
+
+        if not os.path.isdir(state_dir):
+            os.makedirs(state_dir)
+
+        (fd, temp_path) = tempfile.mkstemp(dir = state_dir,
+            prefix = os.path.basename(self.state_file) + '.')
+
+        try:
+            with os.fdopen(fd, 'wb') as state:
+                pickle.dump(self.entries, state, pickle.HIGHEST_PROTOCOL)
+                state.flush()
+                os.fsync(state.fileno())
+
+            os.rename(temp_path, self.state_file)
+        except:
+            os.unlink(temp_path)
+            raise
+
+
+# Set up the object and external callables.
+
+__all__ = ['StateStore']
@@ -0,0 +1,167 @@
+import os
+import re
+import errno
+import ctypes
+import select
+import struct
+import ctypes.util
+
+class SocketWatcher(object):
+    """ Watch socket directories for Postgres instances starting or stopping
+
+    Rather than repeatedly scanning socket directories for lock files, this
+    class uses Linux inotify to be told whenever a lock file is written or
+    removed. Each change updates the socket information of the associated
+    Environment, which no longer needs to scan those directories at all
+    while it's being watched.
+
+    inotify is accessed directly through the C library, so no additional
+    modules are needed. On systems without it, creating a watcher raises
+    an OSError.
+    """
+
+    # inotify event flags, as defined in sys/inotify.h.
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_DELETE = 0x00000200
+
+    event_header = struct.Struct('=iIII')
+    lock_pattern = re.compile(r'^\.s\.PGSQL\.(\d+)\.lock$')
+
+    fd = None
+
+    def __init__(self, env):
+        """ Start watching the socket directories of an Environment
+
+        Watches are added before the directories are scanned once, so no
+        instance can start or stop unnoticed in between. From then on, the
+        Environment relies on this watcher for socket information.
+
+        :param env: Environment object to keep updated.
+        """
+
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+
+        if not hasattr(libc, 'inotify_init'):
+            raise OSError(errno.ENOSYS, "inotify is not available")
+
+        self.fd = libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "Could not initialize inotify")
+
+        self.env = env
+        self.dirs = {}
+
+        mask = (self.IN_CLOSE_WRITE | self.IN_MOVED_TO |
+                self.IN_MOVED_FROM | self.IN_DELETE)
+
+        for sock in env.socket_dirs:
+            if not os.path.isdir(sock):
+                continue
+
+            wd = libc.inotify_add_watch(self.fd, sock, mask)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), "Could not watch %s" % sock)
+
+            self.dirs[wd] = sock
+
+        env.scan_sockets()
+        env.watching = True
+
+
+    def attach(self, env):
+        """ Keep a different Environment updated from now on
+
+        The directories being watched stay the same, so nothing can change
+        unnoticed in the meantime. The new Environment scans them once, just
+        as the first one did.
+
+        :param env: Environment object to keep updated instead.
+        """
+
+        self.env.watching = False
+        self.env = env
+
+        env.scan_sockets()
+        env.watching = True
+
+
+    def fileno(self):
+        """ Get the inotify file descriptor, for use with select. """
+
+        return self.fd
+
+
+    def wait(self, timeout = None):
+        """ Wait for lock files to change, and update the Environment
+
+        :param timeout: Maximum seconds to wait for a change. Default: wait
+            until a change occurs.
+
+        :retval set: Ports whose lock files were written or removed. This is
+            empty if nothing changed before the timeout.
+        """
+
+        try:
+            (ready, w, x) = select.select([self.fd], [], [], timeout)
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                return set()
+            raise
+
+        if not ready:
+            return set()
+
+        return self.read()
+
+
+    def read(self):
+        """ Read all pending inotify events, and update the Environment
+
+        :retval set: Ports whose lock files were written or removed.
+        """
+
+        data = os.read(self.fd, 65536)
+        ports = set()
+        offset = 0
+
+        while offset + self.event_header.size <= len(data):
+            (wd, mask, cookie, length) = self.event_header.unpack_from(
+                data, offset)
+
+            offset += self.event_header.size
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+
+            match = self.lock_pattern.match(name)
+            if not match or wd not in self.dirs:
+                continue
+
+            port = match.group(1)
+
+            if mask & (self.IN_CLOSE_WRITE | self.IN_MOVED_TO):
+                port = self.env.add_socket(os.path.join(self.dirs[wd], name))
+            else:
+                self.env.remove_socket(port)
+
+            if port:
+                ports.add(port)
+
+        return ports
+
+
+    def close(self):
+        """ Stop watching, and let the Environment scan on its own again. """
+
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+        self.env.watching = False
+
+
+# Set up the object and external callables.
+
+__all__ = ['SocketWatcher']
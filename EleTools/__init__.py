@@ -3,5 +3,18 @@
 __version__ = '0.4.0'
 
 from EleTools.Environment import *
+from EleTools.ControlData import *
+from EleTools.QueryRegistry import *
 from EleTools.Instance import *
+from EleTools.InstanceInfo import *
+from EleTools.Metrics import *
 from EleTools.Config import *
+from EleTools.StateStore import *
+from EleTools.FailureTracker import *
+from EleTools.DatabaseStats import *
+from EleTools.Reporter import *
+from EleTools.ReporterGroup import *
+from EleTools.AsyncEngine import *
+from EleTools.Watcher import *
+from EleTools.Agent import *
+from EleTools.Profiler import *
@@ -1,7 +1,11 @@
 from EleTools import __version__
+from EleTools.Profiler import SamplingProfiler
 from argparse import ArgumentParser
 
 import logging
+import cProfile
+import pstats
+import atexit
 import sys
 
 def get_arg_parser(command_desc):
@@ -16,6 +20,7 @@ def get_arg_parser(command_desc):
     * -c/--config : Config file to read for operation settings.
     * -L/--log    : Full path to output log file.
     * -d/--debug  : Enable verbose debugging output.
+    * --profile   : Full path to profiling output. See init_profiling.
 
     This function returns the raw parser in case the caller wants to define a few
     new options before parsing arguments.
@@ -45,6 +50,22 @@ def get_arg_parser(command_desc):
              "will go to standard output."
     )
 
+    parser.add_argument('--profile', action='store',
+        help="Profile this command, and write the statistics to this file " +
+             "when it exits."
+    )
+
+    parser.add_argument('--profile-sample', action='store_true',
+        help="Profile by periodically sampling all threads rather than " +
+             "tracing every call. This has much lower overhead, and is " +
+             "better suited to long-running commands."
+    )
+
+    parser.add_argument('--profile-top', action='store', type=int,
+        help="At exit, also print this many of the most expensive " +
+             "functions found while profiling."
+    )
+
     return parser
 
 
@@ -88,3 +109,44 @@ def init_logging(log_path=None, debug_output=False):
             format="%(asctime)s %(levelname)s: %(message)s",
             datefmt='%Y-%m-%d %I:%M:%S'
         )
+
+
+def init_profiling(args):
+    """ Start Profiling the Current Command, if Requested
+
+    When the --profile option is given, start a profiler that runs until
+    the command exits, at which point the statistics are written to the
+    requested file. By default, cProfile traces every call in the main
+    thread, and its output can be read with the pstats module. With
+    --profile-sample, all threads are sampled instead, and the output is a
+    plain text report.
+
+    If --profile-top is set, the most expensive functions are also printed
+    at exit.
+
+    :param args: Parsed arguments from a get_arg_parser parser.
+    """
+
+    if not args.profile:
+        return
+
+    if args.profile_sample:
+        profiler = SamplingProfiler()
+    else:
+        profiler = cProfile.Profile()
+
+    def finish():
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+
+        if not args.profile_top:
+            return
+
+        if args.profile_sample:
+            profiler.print_stats(args.profile_top)
+        else:
+            stats = pstats.Stats(profiler, stream=sys.stdout)
+            stats.sort_stats('cumulative').print_stats(args.profile_top)
+
+    atexit.register(finish)
+    profiler.enable()
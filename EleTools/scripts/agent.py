@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+from EleTools import scripts
+from EleTools.scripts.instances import read_config
+import EleTools as util
+
+import os
+import sys
+import json
+import logging
+
+# The socket lives in a directory private to the user running the agent, so
+# nobody else can replace it with their own. See Agent.serve_unix.
+
+DEFAULT_SOCKET = os.path.join('~', '.ele_tools', 'agent.sock')
+
+def main():
+    parser = scripts.get_arg_parser('Serve Local PG Instance Inventory')
+    parser.set_defaults(config='/etc/ele_tools/report.ini')
+
+    parser.add_argument('-s', '--socket', action='store',
+        help="Answer queries on this UNIX socket. If neither this nor " +
+             "--port is specified, %s is used." % DEFAULT_SOCKET
+    )
+
+    parser.add_argument('-p', '--port', action='store', type=int,
+        help="Answer queries over HTTP on this loopback port."
+    )
+
+    parser.add_argument('-i', '--interval', action='store', type=float,
+        default=60,
+        help="Seconds between inventory refreshes. Default: %(default)s"
+    )
+
+    parser.add_argument('-w', '--workers', action='store', type=int,
+        help="Probe up to this many local instances concurrently."
+    )
+
+    parser.add_argument('-t', '--timeout', action='store', type=float,
+        help="Seconds to wait for any single concurrent instance probe " +
+             "before reporting that instance as offline. Requires --workers."
+    )
+
+    args = parser.parse_args()
+    scripts.init_logging(args.log, args.debug)
+    scripts.init_profiling(args)
+    sys.excepthook = scripts.handler
+
+    # Probe instances with the same timeouts as ele_report, so a broken
+    # cluster can't stall every refresh.
+
+    conf = read_config(args.config)
+
+    env = util.Environment(prepare=True,
+        connect_timeout=float(conf.probe.connect_timeout),
+        statement_timeout=float(conf.probe.statement_timeout)
+    )
+
+    agent = util.Agent(env, args.interval, args.workers, args.timeout)
+    agent.start()
+
+    logging.info("Inventory agent started")
+
+    try:
+        if args.port:
+            agent.serve_http(args.port)
+        else:
+            agent.serve_unix(os.path.expanduser(
+                args.socket or DEFAULT_SOCKET))
+    except KeyboardInterrupt:
+        pass
+
+    agent.stop()
+    logging.info("Inventory agent stopped")
+
+
+def query():
+    parser = scripts.get_arg_parser('Query Local PG Instance Inventory Agent')
+
+    parser.add_argument('command', nargs='?', default='list',
+        choices=('list', 'get', 'refresh'),
+        help="Query to send to the agent. Default: %(default)s"
+    )
+
+    parser.add_argument('instance_port', nargs='?',
+        help="Port of the instance to describe, for the 'get' command."
+    )
+
+    parser.add_argument('-s', '--socket', action='store',
+        help="Query the agent on this UNIX socket. If neither this nor " +
+             "--port is specified, %s is used." % DEFAULT_SOCKET
+    )
+
+    parser.add_argument('-p', '--port', action='store', type=int,
+        help="Query the agent over HTTP on this loopback port."
+    )
+
+    args = parser.parse_args()
+    scripts.init_logging(args.log, args.debug)
+    scripts.init_profiling(args)
+    sys.excepthook = scripts.handler
+
+    request = {'command': args.command}
+
+    if args.command == 'get':
+        if not args.instance_port:
+            parser.error("The 'get' command requires an instance port.")
+        request['port'] = args.instance_port
+
+    path = args.socket
+    if not path and not args.port:
+        path = os.path.expanduser(DEFAULT_SOCKET)
+
+    response = util.query(request, path, args.port)
+
+    print json.dumps(response, indent=2, sort_keys=True)
+
+    if 'error' in response:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,21 +4,35 @@ from EleTools import scripts
 import EleTools as util
 
 import os
+import re
 import sys
-import socket
+import time
+import random
+import signal
 import logging
-import pickle
 
-def main():
-    parser = scripts.get_arg_parser('Transmit Local PG Instance Report')
-    parser.set_defaults(config='/etc/ele_tools/report.ini')
+# When running as a daemon, failed reports are retried with an exponential
+# backoff starting at RETRY_MIN seconds, up to RETRY_MAX seconds. Each
+# upstream system that fails is retried on its own backoff.
 
-    args = parser.parse_args()
-    scripts.init_logging(args.log, args.debug)
-    sys.excepthook = scripts.handler
+RETRY_MIN = 1
+RETRY_MAX = 300
+
+def read_config(config_file):
+    """ Read the report configuration file
 
-    # For now, this tool only seeks connection to an external system to report
-    # the instances.
+    For now, this tool only seeks connection to an external system to report
+    the instances. There may be several, each in its own upstream section,
+    such as [Upstream:east]. It also needs to know where to track what it
+    has already sent, so unchanged instances aren't sent again, and how long
+    to wait on local instances that don't respond. Upstream systems use the
+    same timeouts as local instances, unless their section sets its own.
+
+    :param config_file: Full path to the report configuration file.
+
+    :retval object: Config object with upstream, state, probe, and
+        databases sections.
+    """
 
     sections = {
         'Upstream': {
@@ -26,90 +40,450 @@ def main():
             'db_port': '5432',
             'db_user': 'util_user',
             'db_name': 'admin',
+            'connect_timeout': '',
+            'statement_timeout': '',
+        },
+        'State': {
+            'state_dir': '~/.ele_tools',
+            'max_age': '0',
+            'xlog_bytes': '0',
+            'xlog_seconds': '0',
+        },
+        'Probe': {
+            'connect_timeout': '10',
+            'statement_timeout': '30',
+            'failure_threshold': '3',
+            'failure_backoff': '60',
+            'failure_max_backoff': '3600',
+        },
+        'Databases': {
+            'time_budget': '5',
+            'query_budget': '10',
         }
     }
-    all_conf = util.Config(args.config, sections)
-    conf = all_conf.upstream
 
-    # Loop through all of the known instances and call the registration
-    # function on each. This assumes that the target system has the
-    # requisite stored procedures and/or tables.
+    return util.Config(config_file, sections, repeat = ('Upstream',))
+
+
+def get_reporter(conf):
+    """ Build Reporters for every upstream system described in the config
+
+    Each upstream tracks what was sent to it in its own state file. The
+    unlabeled [Upstream] section keeps using 'report.state', and labeled
+    sections such as [Upstream:east] use 'report-east.state'. Sections
+    without a db_host are skipped, unless no section has one.
+
+    :param conf: Config object as returned by read_config.
 
-    env = util.Environment()
-    host = socket.gethostname()
+    :retval object: ReporterGroup with a Reporter for each upstream.
+    """
 
-    if args.debug:
-        logging.debug("Transmitting instances to %s", conf.db_host)
+    upstreams = dict(
+        (section, upstream)
+        for section, upstream in conf.sections('Upstream').items()
+        if upstream.db_host
+    )
 
-    conn = util.db_connect(conf.db_host, conf.db_user, conf.db_name,
-        conf.db_port)
-    cur = conn.cursor()
+    if not upstreams:
+        upstreams = {'Upstream': conf.upstream}
 
-    env.discover()
+    reporters = {}
 
-    for inst in env.instances.values():
+    for section, upstream in upstreams.items():
+        state_file = 'report.state'
+        label = section.partition(':')[2]
 
-        if inst.invalid:
-            continue;
+        if label:
+            state_file = 'report-%s.state' % re.sub('[^\w.-]', '_', label)
 
-        curr_info = dict(
-            sHost = host, sHerd = inst.name, nPort = inst.port,
-            sVer = inst.version, bOnline = inst.online,
-            sDataDir = inst.pgdata, sMasterHost = inst.master_host,
-            nXlog = inst.xlog_pos
+        state = util.StateStore(
+            os.path.join(conf.state.state_dir, state_file),
+            max_age = float(conf.state.max_age)
         )
 
-        # To avoid overloading the remote admin system, only transmit data
-        # when at least one optional field has changed since the last
-        # successful transmission. We can quickly find any differences
-        # by checking against our cache, if available. The stored
-        # procedure will do an INSERT or UPDATE based on whether this
-        # instance is listed already or not, so we can't know which is
-        # happening. Thus, we have to send all information whenever a
-        # change is detected.
-
-        cache_file = os.path.join(os.sep, 'tmp',
-            'ele_tools.%s.%s.cache' % (inst.name, inst.port) 
+        reporters[section] = util.Reporter(upstream, state,
+            xlog_bytes = int(conf.state.xlog_bytes),
+            xlog_seconds = float(conf.state.xlog_seconds),
+            connect_timeout = float(
+                upstream.connect_timeout or conf.probe.connect_timeout),
+            statement_timeout = float(
+                upstream.statement_timeout or conf.probe.statement_timeout)
         )
 
-        if os.path.exists(cache_file):
-            prev_info = pickle.load(open(cache_file, 'rb'))
-            if curr_info == prev_info:
-                if args.debug:
-                    logging.debug(
-                        " * %s hasn't changed since last xmit.", inst.name
-                    )
+    return util.ReporterGroup(reporters, RETRY_MIN, RETRY_MAX)
+
+
+def get_environment(conf, args):
+    """ Build an Environment for discovering local instances
+
+    :param conf: Config object as returned by read_config.
+    :param args: Parsed command-line arguments.
+
+    :retval object: Environment with probe options and a failure tracker.
+    """
+
+    opts = dict(
+        connect_timeout = float(conf.probe.connect_timeout),
+        statement_timeout = float(conf.probe.statement_timeout),
+    )
+
+    if args.no_connect:
+        opts.update(probe=False, control=True)
+
+    # Daemons poll the same instances over the same connections repeatedly,
+    # so prepare those queries once rather than parsing them every time.
+
+    if args.daemon:
+        opts.update(prepare=True)
+
+    env = util.Environment(**opts)
+    env.use_lsclusters = args.lsclusters
+
+    if args.use_async and not args.no_connect:
+        env.engine = util.AsyncEngine(args.workers)
+
+    env.failures = util.FailureTracker(
+        os.path.join(conf.state.state_dir, 'failures.state'),
+        threshold = int(conf.probe.failure_threshold),
+        backoff = float(conf.probe.failure_backoff),
+        max_backoff = float(conf.probe.failure_max_backoff)
+    )
+
+    return env
+
+
+def get_collector(conf, args):
+    """ Build a DatabaseStats collector, if database stats were requested
+
+    :param conf: Config object as returned by read_config.
+    :param args: Parsed command-line arguments.
+
+    :retval object: DatabaseStats collector, or None if not requested.
+    """
+
+    if not args.database_stats or args.no_connect:
+        return None
+
+    return util.DatabaseStats(
+        os.path.join(conf.state.state_dir, 'databases.state'),
+        time_budget = float(conf.databases.time_budget),
+        query_budget = int(conf.databases.query_budget)
+    )
+
+
+def report(env, reporter, args, bulk = False, collector = None,
+    snapshots = None):
+    """ Discover local instances and transmit any changes upstream
+
+    This assumes that the target system has the requisite stored procedures
+    and/or tables. Timing for each phase is written afterwards if requested,
+    even if the report fails.
+
+    :param env: Environment object to use for instance discovery.
+    :param reporter: ReporterGroup for every upstream system.
+    :param args: Parsed command-line arguments.
+    :param bulk: Send every instance with COPY, whether it changed or not.
+        Default: False.
+    :param collector: DatabaseStats collector. If given, statistics for the
+        databases in each instance are sent after the instances themselves.
+    :param snapshots: Optional dictionary. Once every instance has been
+        discovered and transmitted, it's replaced by an InstanceInfo
+        snapshot of each, keyed by port, so they can be sent again later.
+    """
+
+    logging.debug("Transmitting instances to %s", ', '.join(sorted(
+        r.conf.db_host for r in reporter.reporters.values())))
+
+    util.metrics.reset()
+
+    # Start transmitting instances as soon as they're found, rather than
+    # waiting for all of them to be probed first. Database stats need the
+    # connections afterwards, so only close them once those are collected.
+
+    incremental = args.daemon or collector is not None
+    instances = env.iter_snapshots(args.workers, args.timeout, incremental)
+
+    try:
+        with util.metrics.timer('report'):
+            if bulk:
+                reporter.transmit_bulk(instances)
+            elif env.engine:
+                reporter.transmit_async(env.engine, env, args.timeout,
+                    incremental)
+            else:
+                reporter.transmit_stream(instances)
+
+            if snapshots is not None:
+                snapshots.clear()
+                snapshots.update(env.snapshots())
+
+            if collector:
+                reporter.transmit_databases(collector.collect_all(
+                    env.instances.values(), args.workers,
+                    close = not args.daemon
+                ))
+    finally:
+        if args.metrics_file:
+            util.metrics.write_textfile(args.metrics_file)
+        if args.metrics_json:
+            util.metrics.write_json(args.metrics_json)
+
+    logging.debug("Transmission complete")
+
+
+def daemon(env, reporter, args, watcher = None, collector = None):
+    """ Report local instances repeatedly until terminated
+
+    Rather than paying for startup, configuration, and a new upstream
+    connection on every run, keep all of these in memory and report every
+    'interval' seconds, plus some random jitter so many hosts don't all
+    report at the same moment.
+
+    Each upstream system keeps its own failure count. One that fails has its
+    connection discarded, and is retried on its own exponential backoff,
+    between the regular reports. Retries resend the instances found by the
+    last regular report, rather than discovering them all over again. The
+    others are still reported to on the usual interval. No report waits more than one interval for a slow
+    upstream; it's left to finish in the background instead. If discovery
+    itself fails, the whole report is retried with a backoff.
+
+    Discovery is incremental here, so instances that haven't restarted or
+    changed roles only need their online state and xlog position polled.
+
+    Sending SIGHUP will reload the configuration file before the next
+    report, and rebuild discovery, database stats collection, and every
+    upstream Reporter from it. Any socket watcher is kept, and simply
+    updates the new Environment. SIGTERM or SIGINT will stop the loop.
+
+    If a bulk report was requested, only the first report is sent in bulk;
+    later reports only send changes. Any upstream that misses the bulk
+    report has its state cleared, so it's sent every instance in full once
+    it recovers.
+
+    :param env: Environment object to use for instance discovery.
+    :param reporter: ReporterGroup for every upstream system.
+    :param args: Parsed command-line arguments.
+    :param watcher: Optional SocketWatcher for the Environment. Instances
+        that start or stop are then reported immediately.
+    :param collector: Optional DatabaseStats collector. See report.
+    """
+
+    flags = {'reload': False, 'running': True}
+
+    def hangup(signum, frame):
+        flags['reload'] = True
+
+    def terminate(signum, frame):
+        flags['running'] = False
+
+    signal.signal(signal.SIGHUP, hangup)
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGINT, terminate)
+
+    jitter = args.jitter
+    if jitter is None:
+        jitter = args.interval / 10.0
+
+    failures = 0
+    bulk = args.bulk
+    snapshots = {}
+    next_report = time.time()
+    reporter.wait = args.interval
+
+    while flags['running']:
+
+        if flags['reload']:
+            flags['reload'] = False
+            logging.info("Reloading configuration from %s", args.config)
+
+            # Only replace anything once everything could be rebuilt, so a
+            # broken file leaves the daemon running as it was.
+
+            try:
+                conf = read_config(args.config)
+                rebuilt = (get_environment(conf, args), get_reporter(conf),
+                    get_collector(conf, args))
+            except Exception, e:
+                logging.error("Could not reload configuration: %s", e)
+            else:
+                reporter.close()
+                env.close()
+
+                (env, reporter, collector) = rebuilt
+                reporter.wait = args.interval
+
+                if watcher:
+                    watcher.attach(env)
+
+        # Regular reports go to every upstream that isn't backing off. In
+        # between, upstreams whose backoff has passed are retried alone.
+
+        if time.time() >= next_report:
+            delay = args.interval + random.uniform(0, jitter)
+
+            try:
+                report(env, reporter, args, bulk, collector, snapshots)
+                failures = 0
+            except Exception, e:
+                failures += 1
+                delay = min(RETRY_MAX, RETRY_MIN * 2 ** (failures - 1))
+                logging.error("Report failed (attempt %s), retrying in %s " +
+                    "seconds: %s", failures, delay, e)
+
+            if bulk and not failures:
+                bulk = False
+
+                for label in reporter.failing():
+                    if reporter.reporters[label].state:
+                        reporter.reporters[label].state.retain([])
+
+            next_report = time.time() + delay
+
+        elif snapshots:
+            retry = reporter.retrying()
+
+            if retry:
+                logging.debug("Retrying %s", ', '.join(retry))
+                group = reporter.only(retry)
+
+                if bulk:
+                    group.transmit_bulk(snapshots.values())
+                else:
+                    group.transmit(snapshots.values())
+
+        # Sleep in short increments so signals are handled promptly, even
+        # when the interval is long. If we're watching for instances to start
+        # or stop, report those right away instead of waiting.
+
+        while flags['running'] and not flags['reload']:
+            wake = next_report
+
+            if snapshots:
+                wake = min(wake, reporter.next_retry() or wake)
+
+            pause = min(1, wake - time.time())
+
+            if pause <= 0:
+                break
+
+            if not watcher:
+                time.sleep(pause)
                 continue
 
-        # Now transmit the various elements. Build the function call based
-        # on the fields remaining in the argument list.
+            for port in watcher.wait(pause):
+                try:
+                    logging.info("Instance on port %s changed state", port)
+                    info = env.probe(port).snapshot()
+                    reporter.transmit([info], prune = False)
 
-        if args.debug:
-            logging.debug(" * " + ', '.join(str(x) for x in (
-                host, inst.name, inst.port, inst.version, inst.role,
-                inst.user, inst.online, inst.pgdata, inst.master_host,
-                inst.master_port, inst.xlog_pos))
-            )
+                    if snapshots:
+                        snapshots[port] = info
+                except Exception, e:
+                    logging.error("Could not report port %s: %s", port, e)
 
-        # We have the parameter list, but we need to build the query string.
-        # Since we have a convenient dictionary, build it based on dictionary
-        # string substitution. Then we can cache the current information for
-        # the next iteration; any problems will prevent the cache, so we can
-        # try again later.
+    reporter.close()
+    env.close()
+    logging.info("Daemon stopped")
 
-        sql_params = ', '.join(
-            [k + ':=%(' + k + ')s' for k in curr_info.keys()]
-        )
-        SQL = "SELECT utility.sp_instance_checkin(" + sql_params + ')'
 
-        cur.execute(SQL, curr_info)
+def main():
+    parser = scripts.get_arg_parser('Transmit Local PG Instance Report')
+    parser.set_defaults(config='/etc/ele_tools/report.ini')
+
+    parser.add_argument('-w', '--workers', action='store', type=int,
+        help="Probe up to this many local instances concurrently. If not " +
+             "specified, instances are probed one at a time."
+    )
+
+    parser.add_argument('-t', '--timeout', action='store', type=float,
+        help="Seconds to wait for any single concurrent instance probe " +
+             "before reporting that instance as offline. Requires --workers " +
+             "or --async."
+    )
+
+    parser.add_argument('--async', dest='use_async', action='store_true',
+        help="Probe instances and send check-ins from a single thread with " +
+             "asynchronous connections, rather than a thread per probe. " +
+             "--workers then limits how many run at once (default: 32)."
+    )
+
+    parser.add_argument('--no-connect', action='store_true',
+        help="Don't connect to local instances. Instead, read their state " +
+             "and xlog position from the pg_control and postmaster.pid files."
+    )
+
+    parser.add_argument('--lsclusters', action='store_true',
+        help="Also call pg_lsclusters to detect Debian clusters that " +
+             "couldn't be fully read from their configuration files."
+    )
+
+    parser.add_argument('--metrics-file', action='store',
+        help="After each report, write phase timings to this file in the " +
+             "Prometheus textfile format."
+    )
+
+    parser.add_argument('--metrics-json', action='store',
+        help="After each report, write phase timings to this JSON file."
+    )
+
+    parser.add_argument('--bulk', action='store_true',
+        help="Send every instance, changed or not, with a single COPY and " +
+             "merge. Use this to resynchronize the upstream system."
+    )
+
+    parser.add_argument('--database-stats', action='store_true',
+        help="Also send size, activity, and bloat statistics for every " +
+             "database, within the budgets in the [Databases] section."
+    )
+
+    parser.add_argument('--daemon', action='store_true',
+        help="Keep running, and report instances every --interval seconds " +
+             "over a persistent upstream connection."
+    )
+
+    parser.add_argument('--watch', action='store_true',
+        help="In daemon mode, watch socket directories with inotify, and " +
+             "report instances as soon as they start or stop."
+    )
+
+    parser.add_argument('-i', '--interval', action='store', type=float,
+        default=60,
+        help="Seconds between reports in daemon mode. Default: %(default)s"
+    )
+
+    parser.add_argument('--jitter', action='store', type=float,
+        help="Maximum random seconds to add to each daemon interval. " +
+             "Default: 10 percent of the interval."
+    )
+
+    args = parser.parse_args()
+    scripts.init_logging(args.log, args.debug)
+    scripts.init_profiling(args)
+    sys.excepthook = scripts.handler
+
+    conf = read_config(args.config)
+    env = get_environment(conf, args)
+    reporter = get_reporter(conf)
+    collector = get_collector(conf, args)
+
+    if args.daemon:
+        watcher = None
+        if args.watch:
+            watcher = util.SocketWatcher(env)
+
+        daemon(env, reporter, args, watcher, collector)
+        return
+
+    report(env, reporter, args, args.bulk, collector)
+    reporter.close()
 
-        pickle.dump(curr_info, open(cache_file, 'wb'))
+    if env.engine:
+        env.engine.close()
 
-    conn.close()
+    # Upstream failures were already logged, but should still fail the run.
 
-    if args.debug:
-        logging.debug("Transmission complete")
+    if reporter.failing():
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+
+"""
+Benchmark Instance Discovery and Reporting With Synthetic Clusters
+
+This script builds a throwaway environment containing any number of fake
+PostgreSQL clusters: socket lock files, data directories with PG_VERSION and
+recovery.conf files, Debian-style configuration directories, and a stub
+pg_lsclusters. Database connections are simulated through the pluggable
+EleTools.Instance.connection_factory, optionally with a fixed latency per
+query. With --pg-bin, a temporary real PostgreSQL server is started instead,
+and every synthetic cluster connects to it.
+
+Each scenario is timed several times at each requested cluster count, and
+results are printed as one JSON object per line, so they can be stored and
+compared between versions:
+
+    python bench/bench_ele_tools.py --sizes 1,10,100,1000 > results.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import getpass
+import tempfile
+import subprocess
+
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import EleTools as util
+
+# The package exports the Instance class under the same name as its module,
+# so fetch the module itself to replace its connection factory.
+
+import EleTools.Instance
+instance_module = sys.modules['EleTools.Instance']
+
+BASE_PORT = 20000
+
+
+class FakeCursor(object):
+    """ Answer the queries ele_tools sends, after an optional delay. """
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.rows = []
+
+    def execute(self, sql, params = None):
+        if self.latency:
+            time.sleep(self.latency)
+
+        if 'version()' in sql:
+            self.rows = [('9.6.5', False, 123456789)]
+        elif 'pg_stat_replication' in sql:
+            self.rows = []
+        elif 'datname' in sql:
+            self.rows = [('postgres',), ('app',)]
+        elif 'location' in sql:
+            self.rows = [(False, 123456789)]
+        else:
+            self.rows = [(None,)]
+
+    def fetchone(self):
+        return self.rows[0]
+
+    def __iter__(self):
+        return iter(self.rows)
+
+
+class FakeConnection(object):
+    """ Stand in for a psycopg2 connection. """
+
+    closed = 0
+    autocommit = False
+    server_version = 90605
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def cursor(self):
+        return FakeCursor(self.latency)
+
+    def close(self):
+        self.closed = 1
+
+
+class Synthetic(object):
+    """ A temporary directory tree describing N fake clusters. """
+
+    def __init__(self, count, root):
+        self.root = root
+        self.sockets = os.path.join(root, 'sockets')
+        self.etc = os.path.join(root, 'etc', 'postgresql')
+        self.bin = os.path.join(root, 'bin')
+
+        for path in (self.sockets, self.etc, self.bin):
+            os.makedirs(path)
+
+        clusters = []
+
+        for i in range(count):
+            port = BASE_PORT + i
+            name = 'bench%d' % i
+            pgdata = os.path.join(root, 'data', name)
+            os.makedirs(pgdata)
+
+            with open(os.path.join(pgdata, 'PG_VERSION'), 'w') as x:
+                x.write('9.6\n')
+
+            # Every other cluster is a replica of the one before it.
+
+            if i % 2:
+                with open(os.path.join(pgdata, 'recovery.conf'), 'w') as x:
+                    x.write("standby_mode = 'on'\n")
+                    x.write("primary_conninfo = 'host=localhost port=%d'\n"
+                        % (port - 1))
+
+            lock = os.path.join(self.sockets, '.s.PGSQL.%d.lock' % port)
+            with open(lock, 'w') as x:
+                x.write('%d\n%s\n%d\n%d\n' % (
+                    os.getpid(), pgdata, int(time.time()), port))
+
+            conf_dir = os.path.join(self.etc, '9.6', name)
+            os.makedirs(conf_dir)
+            with open(os.path.join(conf_dir, 'postgresql.conf'), 'w') as x:
+                x.write("data_directory = '%s'\nport = %d\n" % (pgdata, port))
+
+            clusters.append('9.6 %s %d online%s %s %s' % (
+                name, port, i % 2 and ',recovery' or '', getpass.getuser(),
+                pgdata))
+
+        # The pg_lsclusters stub simply prints the cluster list, so its
+        # cost is mostly the process spawn itself.
+
+        stub = os.path.join(self.bin, 'pg_lsclusters')
+        with open(stub, 'w') as x:
+            x.write('#!/bin/sh\ncat <<EOF\n%s\nEOF\n' % '\n'.join(clusters))
+        os.chmod(stub, 0755)
+
+    def environment(self, **instance_opts):
+        env = util.Environment(**instance_opts)
+        env.socket_dirs = [self.sockets]
+        env.debian_conf_dir = self.etc
+
+        return env
+
+
+class Upstream(object):
+    """ Minimal config container for a Reporter. """
+
+    db_host = 'bench'
+    db_port = 5432
+    db_user = 'bench'
+    db_name = 'bench'
+
+
+def start_postgres(pg_bin, root):
+    """ Initialize and start a temporary PostgreSQL server
+
+    :retval tuple: (data directory, socket directory, port) of the running
+        server.
+    """
+
+    pgdata = os.path.join(root, 'pg')
+    sockdir = os.path.join(root, 'pgsock')
+    os.makedirs(sockdir)
+
+    probe = socket.socket()
+    probe.bind(('127.0.0.1', 0))
+    port = probe.getsockname()[1]
+    probe.close()
+
+    with open(os.devnull, 'w') as quiet:
+        subprocess.check_call((os.path.join(pg_bin, 'initdb'), '-A', 'trust',
+            '-U', getpass.getuser(), '-D', pgdata), stdout = quiet)
+        subprocess.check_call((os.path.join(pg_bin, 'pg_ctl'), '-w', '-D',
+            pgdata, '-l', os.path.join(root, 'pg.log'), '-o',
+            "-p %d -k %s -c listen_addresses=''" % (port, sockdir), 'start'),
+            stdout = quiet)
+
+    return (pgdata, sockdir, port)
+
+
+def stop_postgres(pg_bin, pgdata):
+    with open(os.devnull, 'w') as quiet:
+        subprocess.call((os.path.join(pg_bin, 'pg_ctl'), '-w', '-D', pgdata,
+            '-m', 'immediate', 'stop'), stdout = quiet)
+
+
+def timed(func, repeat):
+    """ Run a function several times, and summarize its durations. """
+
+    times = []
+
+    for i in range(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+
+    times.sort()
+
+    return {
+        'min': times[0],
+        'median': times[len(times) // 2],
+        'max': times[-1],
+    }
+
+
+def run_size(count, args):
+    """ Time every scenario for a single cluster count. """
+
+    root = tempfile.mkdtemp(prefix = 'ele_bench.')
+    results = []
+
+    try:
+        synth = Synthetic(count, root)
+        os.environ['PATH'] = synth.bin + os.pathsep + os.environ['PATH']
+
+        def record(scenario, stats):
+            stats.update(scenario = scenario, instances = count,
+                latency_ms = args.latency, real_pg = bool(args.pg_bin))
+            results.append(stats)
+            print json.dumps(stats, sort_keys = True)
+            sys.stdout.flush()
+
+        env = synth.environment()
+
+        record('discover', timed(env.discover, args.repeat))
+        record('discover_workers', timed(
+            lambda: env.discover(args.workers), args.repeat))
+
+        env.discover()
+        record('discover_incremental', timed(
+            lambda: env.discover(incremental = True), args.repeat))
+
+        lsenv = synth.environment()
+        lsenv.use_lsclusters = True
+        record('discover_lsclusters', timed(lsenv.discover, args.repeat))
+
+        noconn = synth.environment(probe = False, control = True)
+        record('discover_no_connect', timed(noconn.discover, args.repeat))
+
+        detect = env.detect.values()
+        record('instance_construct', timed(
+            lambda: [util.Instance(**inst_env) for inst_env in detect],
+            args.repeat))
+
+        # The upstream connection is always simulated, since the admin
+        # schema relies on tables that belong to ElepHaaS itself.
+
+        instances = env.instances.values()
+        state_file = os.path.join(root, 'report.state')
+
+        def transmit_all():
+            if os.path.exists(state_file):
+                os.unlink(state_file)
+
+            reporter = util.Reporter(Upstream(), util.StateStore(state_file))
+            reporter.conn = FakeConnection(args.latency / 1000.0)
+            reporter.transmit(instances)
+
+        record('transmit_changed', timed(transmit_all, args.repeat))
+
+        reporter = util.Reporter(Upstream(), util.StateStore(state_file))
+        reporter.conn = FakeConnection(args.latency / 1000.0)
+        reporter.transmit(instances)
+        record('transmit_unchanged', timed(
+            lambda: reporter.transmit(instances), args.repeat))
+
+        record('report_stream', timed(
+            lambda: reporter.transmit_stream(env.iter_discover(args.workers)),
+            args.repeat))
+
+    finally:
+        shutil.rmtree(root, ignore_errors = True)
+
+    return results
+
+
+def main():
+    parser = ArgumentParser(description = 'Benchmark ele_tools discovery ' +
+        'and reporting against synthetic clusters.')
+
+    parser.add_argument('--sizes', default = '1,10,100,1000',
+        help = "Comma-separated cluster counts to test. Default: %(default)s")
+    parser.add_argument('--repeat', type = int, default = 5,
+        help = "Times to run each scenario. Default: %(default)s")
+    parser.add_argument('--workers', type = int, default = 8,
+        help = "Workers for concurrent scenarios. Default: %(default)s")
+    parser.add_argument('--latency', type = float, default = 0,
+        help = "Simulated milliseconds per query. Default: %(default)s")
+    parser.add_argument('--pg-bin',
+        help = "Directory with initdb and pg_ctl. If given, connect every " +
+               "synthetic cluster to a temporary real server instead of " +
+               "simulating connections.")
+    parser.add_argument('--output',
+        help = "Also write all results to this file as a JSON list.")
+
+    args = parser.parse_args()
+
+    server = None
+
+    if args.pg_bin:
+        server_root = tempfile.mkdtemp(prefix = 'ele_bench_pg.')
+        (pgdata, sockdir, port) = start_postgres(args.pg_bin, server_root)
+        server = (server_root, pgdata)
+        connect = instance_module.connection_factory
+
+        def factory(**kwargs):
+            kwargs.update(host = sockdir, port = port)
+            return connect(**kwargs)
+
+        instance_module.connection_factory = factory
+    else:
+        latency = args.latency / 1000.0
+        instance_module.connection_factory = \
+            lambda **kwargs: FakeConnection(latency)
+
+    results = []
+
+    try:
+        for count in [int(size) for size in args.sizes.split(',')]:
+            results.extend(run_size(count, args))
+    finally:
+        if server:
+            stop_postgres(args.pg_bin, server[1])
+            shutil.rmtree(server[0], ignore_errors = True)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent = 2, sort_keys = True)
+
+
+if __name__ == "__main__":
+    main()
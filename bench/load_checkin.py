@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+
+"""
+Load Test Instance Check-ins on an Administration Server
+
+This script simulates many hosts checking their instances in at the same
+moment, as happens when every host reports at the top of the minute. Each
+simulated host calls sp_instance_checkin_batch, or sp_instance_checkin once
+per instance with --single, from a pool of concurrent client connections.
+
+The admin schema relies on ElepHaaS tables, so the target database is given
+minimal stand-ins for ele_server, ele_herd, and ele_instance with --setup,
+along with a server, herds, and an environment to match. Then
+sql/create_schema.sql is installed on top. Only use --setup on a scratch
+database; with --pg-bin, a temporary server is created for the purpose.
+
+Each round is timed, and reported as one JSON object per line, along with
+the most check-ins seen waiting on locks at once:
+
+    python bench/load_checkin.py --pg-bin /usr/lib/postgresql/9.6/bin \\
+        --hosts 2000 --instances 4 --clients 50 --rounds 5
+"""
+
+import os
+import sys
+import json
+import time
+import Queue
+import shutil
+import tempfile
+import threading
+
+import psycopg2
+
+from argparse import ArgumentParser
+
+from bench_ele_tools import start_postgres, stop_postgres
+
+SCHEMA_FILE = os.path.join(os.path.dirname(__file__), os.pardir, 'sql',
+    'create_schema.sql')
+
+# Just enough of the ElepHaaS tables for the check-in functions to work.
+
+FIXTURE = """
+DO $$
+BEGIN
+  PERFORM 1 FROM pg_roles WHERE rolname = 'postgres';
+
+  IF NOT FOUND THEN
+    EXECUTE 'CREATE ROLE postgres';
+  END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE SCHEMA IF NOT EXISTS utility;
+
+CREATE TABLE utility.ele_server (
+  server_id       SERIAL PRIMARY KEY,
+  hostname        VARCHAR NOT NULL,
+  environment_id  INT
+);
+
+CREATE TABLE utility.ele_herd (
+  herd_id         SERIAL PRIMARY KEY,
+  base_name       VARCHAR NOT NULL,
+  db_port         INT NOT NULL,
+  pgdata          VARCHAR,
+  environment_id  INT
+);
+
+CREATE TABLE utility.ele_instance (
+  instance_id     SERIAL PRIMARY KEY,
+  herd_id         INT NOT NULL REFERENCES utility.ele_herd,
+  server_id       INT NOT NULL REFERENCES utility.ele_server,
+  master_id       INT REFERENCES utility.ele_instance,
+  version         VARCHAR,
+  local_pgdata    VARCHAR,
+  is_online       BOOLEAN,
+  xlog_pos        BIGINT
+);
+"""
+
+
+def host_name(num):
+    return 'loadhost%05d' % num
+
+
+def connect(args):
+    return psycopg2.connect(host = args.host, port = args.port,
+        database = args.dbname, user = args.user)
+
+
+def setup(args):
+    """ Create the stand-in tables, sample data, and the admin schema. """
+
+    conn = connect(args)
+    conn.autocommit = True
+    cur = conn.cursor()
+
+    cur.execute(FIXTURE)
+
+    cur.execute(
+        "INSERT INTO utility.ele_server (hostname, environment_id) "
+        "SELECT %s || lpad(n::TEXT, 5, '0'), 1 "
+        "  FROM generate_series(0, %s) n",
+        ('loadhost', args.hosts - 1)
+    )
+
+    cur.execute(
+        "INSERT INTO utility.ele_herd (base_name, db_port, pgdata, "
+        "       environment_id) "
+        "SELECT 'herd' || n, 5432 + n, '/data/herd' || n, 1 "
+        "  FROM generate_series(0, %s) n",
+        (args.instances - 1,)
+    )
+
+    with open(SCHEMA_FILE) as schema:
+        cur.execute(schema.read())
+
+    cur.execute("ANALYZE")
+    conn.close()
+
+
+def checkin(cur, args, host, rnd):
+    """ Send one round of instances for a single simulated host. """
+
+    instances = []
+
+    for i in range(args.instances):
+        inst = {'sHerd': 'herd%d' % i, 'nPort': 5432 + i}
+
+        # The first round registers everything. Afterwards, instances only
+        # send their xlog position, and only some of them have moved.
+
+        if rnd == 0:
+            inst.update(sVer = '9.6.5', bOnline = True,
+                sDataDir = '/data/herd%d' % i)
+            if host:
+                inst['sMasterHost'] = host_name(0)
+        elif (host + i + rnd) % 100 < args.changed:
+            inst['nXlog'] = rnd * 1000000 + host
+        else:
+            inst['bOnline'] = True
+
+        instances.append(inst)
+
+    if args.single:
+        for inst in instances:
+            cur.execute(
+                "SELECT utility.sp_instance_checkin(%(sHerd)s, %(sHost)s, "
+                "       %(nPort)s, %(sVer)s, %(bOnline)s, %(sDataDir)s, "
+                "       %(sMasterHost)s, %(nXlog)s)",
+                dict({'sVer': None, 'bOnline': None, 'sDataDir': None,
+                      'sMasterHost': None, 'nXlog': None},
+                     sHost = host_name(host), **inst)
+            )
+    else:
+        cur.execute("SELECT utility.sp_instance_checkin_batch(%s, %s)",
+            (host_name(host), json.dumps(instances)))
+
+
+def run_round(args, rnd):
+    """ Check every simulated host in once, as fast as possible. """
+
+    hosts = Queue.Queue()
+    for host in range(args.hosts):
+        hosts.put(host)
+
+    latencies = []
+    errors = []
+    done = threading.Event()
+    waiting = [0]
+
+    def client():
+        conn = connect(args)
+        conn.autocommit = True
+        cur = conn.cursor()
+
+        try:
+            while True:
+                try:
+                    host = hosts.get_nowait()
+                except Queue.Empty:
+                    return
+
+                start = time.time()
+                try:
+                    checkin(cur, args, host, rnd)
+                except psycopg2.Error, e:
+                    errors.append(str(e))
+                latencies.append(time.time() - start)
+        finally:
+            conn.close()
+
+    def watch_locks():
+        conn = connect(args)
+        conn.autocommit = True
+        cur = conn.cursor()
+
+        while not done.wait(0.05):
+            cur.execute("SELECT count(DISTINCT pid) FROM pg_locks "
+                        " WHERE NOT granted")
+            waiting[0] = max(waiting[0], cur.fetchone()[0])
+
+        conn.close()
+
+    watcher = threading.Thread(target = watch_locks)
+    watcher.start()
+
+    clients = [threading.Thread(target = client) for i in range(args.clients)]
+    start = time.time()
+
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+
+    elapsed = time.time() - start
+    done.set()
+    watcher.join()
+
+    latencies.sort()
+    count = len(latencies)
+
+    return {
+        'round': rnd,
+        'hosts': args.hosts,
+        'instances': args.instances,
+        'clients': args.clients,
+        'mode': args.single and 'single' or 'batch',
+        'seconds': elapsed,
+        'checkins_per_second': count / elapsed,
+        'median': latencies[count // 2],
+        'p95': latencies[int(count * 0.95)],
+        'max': latencies[-1],
+        'max_lock_waiters': waiting[0],
+        'errors': len(errors),
+    }
+
+
+def main():
+    parser = ArgumentParser(description = 'Simulate many hosts checking ' +
+        'instances in to an admin database at once.')
+
+    parser.add_argument('--hosts', type = int, default = 1000,
+        help = "Number of simulated hosts. Default: %(default)s")
+    parser.add_argument('--instances', type = int, default = 4,
+        help = "Instances on each host. Default: %(default)s")
+    parser.add_argument('--clients', type = int, default = 20,
+        help = "Concurrent admin connections. Default: %(default)s")
+    parser.add_argument('--rounds', type = int, default = 3,
+        help = "Check-in rounds after registration. Default: %(default)s")
+    parser.add_argument('--changed', type = int, default = 20,
+        help = "Percent of instances whose xlog moves in each round. " +
+               "Default: %(default)s")
+    parser.add_argument('--single', action = 'store_true',
+        help = "Call sp_instance_checkin per instance instead of the " +
+               "batch function.")
+    parser.add_argument('--setup', action = 'store_true',
+        help = "Create stand-in ElepHaaS tables and install the admin " +
+               "schema first. Only use this on a scratch database.")
+    parser.add_argument('--pg-bin',
+        help = "Directory with initdb and pg_ctl. If given, run against a " +
+               "temporary server, and imply --setup.")
+    parser.add_argument('-H', '--host', help = "Admin database host.")
+    parser.add_argument('-p', '--port', type = int, default = 5432,
+        help = "Admin database port. Default: %(default)s")
+    parser.add_argument('-d', '--dbname', default = 'postgres',
+        help = "Admin database name. Default: %(default)s")
+    parser.add_argument('-U', '--user', help = "Admin database user.")
+
+    args = parser.parse_args()
+
+    server = None
+
+    if args.pg_bin:
+        root = tempfile.mkdtemp(prefix = 'ele_load_pg.')
+        (pgdata, args.host, args.port) = start_postgres(args.pg_bin, root)
+        server = (root, pgdata)
+        args.setup = True
+
+    try:
+        if args.setup:
+            setup(args)
+
+        for rnd in range(args.rounds + 1):
+            print json.dumps(run_round(args, rnd), sort_keys = True)
+            sys.stdout.flush()
+    finally:
+        if server:
+            stop_postgres(args.pg_bin, server[1])
+            shutil.rmtree(server[0], ignore_errors = True)
+
+
+if __name__ == "__main__":
+    main()
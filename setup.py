@@ -31,6 +31,8 @@ setup(name=EleTools.__name__,
       entry_points = {
           'console_scripts': [
               'ele_report = EleTools.scripts.instances:main',
+              'ele_agent = EleTools.scripts.agent:main',
+              'ele_query = EleTools.scripts.agent:query',
           ]
       }
 )
@@ -62,7 +62,122 @@ SET search_path TO utility;
 -- CREATE TABLES / VIEWS 
 --------------------------------------------------------------------------------
 
--- Nothing here. See ElepHaaS project
+-- Most tables belong to the ElepHaaS project. The exception is this staging
+-- table, which bulk check-ins fill with COPY before merging everything into
+-- ele_instance at once. It's unlogged because rows only live for the duration
+-- of a single transaction, and each session only sees its own rows.
+
+CREATE UNLOGGED TABLE IF NOT EXISTS ele_instance_stage (
+  backend_pid  INT NOT NULL DEFAULT pg_backend_pid(),
+  hostname     VARCHAR NOT NULL,
+  herd         VARCHAR NOT NULL,
+  db_port      INT NOT NULL,
+  version      VARCHAR,
+  is_online    BOOLEAN,
+  pgdata       VARCHAR,
+  master_host  VARCHAR,
+  xlog_pos     BIGINT
+);
+
+GRANT ALL ON ele_instance_stage TO util_exec;
+
+-- Replication topology as each instance reports it: one row for every
+-- standby streaming from it, with positions as byte offsets. Each report
+-- replaces every row for the reporting instance, so lag is always as of the
+-- last report, and the timestamp says when that was.
+
+CREATE TABLE IF NOT EXISTS ele_replication (
+  hostname     VARCHAR NOT NULL,
+  db_port      INT NOT NULL,
+  standby      VARCHAR,
+  client_addr  VARCHAR,
+  state        VARCHAR,
+  sync_state   VARCHAR,
+  sent_pos     BIGINT,
+  write_pos    BIGINT,
+  flush_pos    BIGINT,
+  replay_pos   BIGINT,
+  lag_bytes    BIGINT,
+  lag_seconds  FLOAT,
+  reported_at  TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+GRANT ALL ON ele_replication TO util_exec;
+
+-- Size, activity, and bloat statistics for every database in each instance.
+-- Counters and sizes are collected on different schedules, so each has its
+-- own timestamp. Each report replaces every row for the reporting instance.
+
+CREATE TABLE IF NOT EXISTS ele_database (
+  hostname       VARCHAR NOT NULL,
+  db_port        INT NOT NULL,
+  datname        VARCHAR NOT NULL,
+  size_bytes     BIGINT,
+  tables         BIGINT,
+  table_bytes    BIGINT,
+  bloat_bytes    BIGINT,
+  dead_tuples    BIGINT,
+  backends       INT,
+  xact_commit    BIGINT,
+  xact_rollback  BIGINT,
+  blks_read      BIGINT,
+  blks_hit       BIGINT,
+  tup_inserted   BIGINT,
+  tup_updated    BIGINT,
+  tup_deleted    BIGINT,
+  temp_bytes     BIGINT,
+  deadlocks      BIGINT,
+  stats_at       TIMESTAMPTZ,
+  detail_at      TIMESTAMPTZ,
+  reported_at    TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+GRANT ALL ON ele_database TO util_exec;
+
+--------------------------------------------------------------------------------
+-- CREATE INDEXES
+--------------------------------------------------------------------------------
+
+-- Instance check-ins find existing instances by hostname, herd name, and
+-- port, which span the server, herd, and instance tables. Make sure each step
+-- of that lookup is indexed, so concurrent check-ins hold their row locks
+-- briefly. Tables that don't exist yet are skipped, as are tables that already
+-- have an index leading with the same column.
+
+DO $$
+DECLARE
+  aIndex TEXT[];
+BEGIN
+  FOREACH aIndex SLICE 1 IN ARRAY ARRAY[
+    ['ele_server', 'idx_ele_server_hostname', 'hostname'],
+    ['ele_herd', 'idx_ele_herd_base_name_db_port', 'base_name, db_port'],
+    ['ele_instance', 'idx_ele_instance_server_id_herd_id', 'server_id, herd_id'],
+    ['ele_instance_stage', 'idx_ele_instance_stage_backend_pid', 'backend_pid'],
+    ['ele_replication', 'idx_ele_replication_hostname_db_port',
+     'hostname, db_port'],
+    ['ele_database', 'idx_ele_database_hostname_db_port', 'hostname, db_port']
+  ]
+  LOOP
+    PERFORM 1 FROM pg_tables
+     WHERE schemaname = 'utility'
+       AND tablename = aIndex[1];
+
+    CONTINUE WHEN NOT FOUND;
+
+    PERFORM 1
+       FROM pg_index x
+       JOIN pg_attribute a ON (a.attrelid = x.indrelid
+                               AND a.attnum = x.indkey[0])
+      WHERE x.indrelid = ('utility.' || aIndex[1])::REGCLASS
+        AND a.attname = split_part(aIndex[3], ',', 1);
+
+    CONTINUE WHEN FOUND;
+
+    EXECUTE format('CREATE INDEX %I ON utility.%I (%s)',
+      aIndex[2], aIndex[1], aIndex[3]);
+  END LOOP;
+END;
+$$ LANGUAGE plpgsql;
 
 --------------------------------------------------------------------------------
 -- CREATE FUNCTIONS
@@ -130,10 +245,10 @@ $$ LANGUAGE SQL;
 
 
 /**
-* Register instance information or changes
+* Register instance information or changes for a known server
 *
-* When remote systems call this function to register instances, we want to
-* do two things:
+* This is the workhorse behind the check-in functions below. When remote
+* systems register instances, we want to do two things:
 *
 * - Deflect duplicate inserts.
 * - Catch relevant changes
@@ -142,12 +257,19 @@ $$ LANGUAGE SQL;
 * and modify existing instances with newly updated details as the xlog
 * position moves, or something gets shut down, for example.
 *
-* All of the "DEFAULT" parameters is optional because there are so many of
-* them. The best use of this function is to call it with named arguments
-* and only pass data that has changed since the last call. The presumption
-* here is that only automated systems will invoke this.
+* Callers that already know the server ID should pass it, so it isn't looked
+* up again for every instance on the same host. If it's NULL, the server is
+* discovered by hostname only when a new instance needs to be inserted.
+*
+* @return BOOLEAN FALSE if the instance is new, and couldn't be inserted
+*     because no herd or environment was found for it.
 */
-CREATE OR REPLACE FUNCTION sp_instance_checkin(
+DROP FUNCTION IF EXISTS sp_register_instance(
+  INT, VARCHAR, VARCHAR, INT, VARCHAR, BOOLEAN, VARCHAR, VARCHAR, BIGINT
+);
+
+CREATE OR REPLACE FUNCTION sp_register_instance(
+  nSrv INT,
   sHerd VARCHAR,
   sHost VARCHAR,
   nPort INT,
@@ -157,36 +279,44 @@ CREATE OR REPLACE FUNCTION sp_instance_checkin(
   sMasterHost VARCHAR DEFAULT NULL,
   nXlog BIGINT DEFAULT NULL
 )
-RETURNS VOID
+RETURNS BOOLEAN
 AS $$
 DECLARE
   rInst  RECORD;
   rHerd  RECORD;
 
   nLead  INT;
-  nSrv   INT;
   sData  VARCHAR;
+  sNewVer VARCHAR;
 BEGIN
   -- Look for any existing instances. If we find one, this will need to be an
   -- update. Lock accordingly. We do this first to avoid possible race
-  -- conditions.
-
-  SELECT INTO rInst *
-    FROM utility.v_flat_instance
-   WHERE hostname = sHost
-     AND base_name = sHerd
-     AND db_port = nPort
-     FOR UPDATE;
+  -- conditions. Only the instance row itself is locked. Locking through
+  -- v_flat_instance would also lock the herd and server rows, which every
+  -- other instance in the same herd or on the same host shares, and
+  -- serialize otherwise unrelated check-ins.
+
+  SELECT INTO rInst i.instance_id, i.is_online, i.master_id, i.version,
+         i.local_pgdata, i.xlog_pos, h.pgdata
+    FROM utility.ele_instance i
+    JOIN utility.ele_herd h USING (herd_id)
+    JOIN utility.ele_server s ON (s.server_id = i.server_id)
+   WHERE s.hostname = lower(sHost)
+     AND h.base_name = sHerd
+     AND h.db_port = nPort
+     FOR UPDATE OF i;
 
   -- If there's master information, look up the instance of the referring
   -- reference.
 
   IF sMasterHost IS NOT NULL THEN
-    SELECT INTO nLead instance_id
-      FROM utility.v_flat_instance
-     WHERE hostname = sMasterHost
-       AND base_name = sHerd
-       AND db_port = nPort;
+    SELECT INTO nLead i.instance_id
+      FROM utility.ele_instance i
+      JOIN utility.ele_herd h USING (herd_id)
+      JOIN utility.ele_server s ON (s.server_id = i.server_id)
+     WHERE s.hostname = lower(sMasterHost)
+       AND h.base_name = sHerd
+       AND h.db_port = nPort;
   END IF;
 
   -- If this instance doesn't exist, dump all of the fields into the tracking
@@ -203,7 +333,9 @@ BEGIN
     -- best if we have the name of the master server to derive the correct
     -- herd. Autodiscovery is kinda treacherous like that.
 
-    nSrv = utility.sp_discover_server(sHost);
+    IF nSrv IS NULL THEN
+      nSrv = utility.sp_discover_server(sHost);
+    END IF;
 
     IF nLead IS NULL THEN
       SELECT INTO rHerd herd_id, pgdata
@@ -220,7 +352,7 @@ BEGIN
     END IF;
 
     IF nSrv IS NULL OR NOT FOUND THEN
-      RETURN;
+      RETURN FALSE;
     END IF;
 
     sData = '';
@@ -234,7 +366,7 @@ BEGIN
         sVer, sData, bOnline, rHerd.herd_id, nSrv, nLead
     );
 
-    RETURN;
+    RETURN TRUE;
   END IF;
 
   -- Of the mentioned relevant fields in our header, only update when those
@@ -242,26 +374,381 @@ BEGIN
   -- systems adhere to the recommended SOP, many of these could change.
   -- Because the version may depend on the instance being up to get the
   -- full value, we'll use the highest between the two.
+  --
+  -- Callers only send fields that changed, so a NULL means "keep the current
+  -- value." Compare the final values rather than the parameters, so repeated
+  -- or partial check-ins that change nothing don't write anything at all.
+
+  sNewVer = array_to_string(
+              GREATEST(
+                string_to_array(rInst.version, '.')::INT[],
+                string_to_array(sVer, '.')::INT[]
+              ), '.'
+            );
+
+  sData = rInst.local_pgdata;
+  IF sDataDir IS NOT NULL THEN
+    sData = '';
+    IF sDataDir != rInst.pgdata THEN
+      sData = sDataDir;
+    END IF;
+  END IF;
 
-  IF (bOnline, nLead, sVer, sDataDir, nXlog)
+  IF (COALESCE(bOnline, rInst.is_online), COALESCE(nLead, rInst.master_id),
+      sNewVer, sData, COALESCE(nXlog, rInst.xlog_pos))
        IS DISTINCT FROM
-     (rInst.is_online, rInst.master_id, rInst.version, rInst.pgdata, rInst.xlog_pos)
+     (rInst.is_online, rInst.master_id, rInst.version, rInst.local_pgdata,
+      rInst.xlog_pos)
   THEN
     UPDATE utility.ele_instance
        SET is_online = COALESCE(bOnline, rInst.is_online),
            master_id = COALESCE(nLead, rInst.master_id),
-           version = array_to_string(
-                       GREATEST(
-                         string_to_array(rInst.version, '.')::INT[],
-                         string_to_array(sVer, '.')::INT[]
-                       ), '.'
-                     ),
-           local_pgdata = COALESCE(sData, rInst.local_pgdata),
+           version = sNewVer,
+           local_pgdata = sData,
            xlog_pos = COALESCE(nXlog, rInst.xlog_pos)
      WHERE instance_id = rInst.instance_id;
   END IF;
 
-  RETURN;
+  RETURN TRUE;
+
+END;
+$$ LANGUAGE plpgsql;
+
+
+/**
+* Register instance information or changes
+*
+* Remote systems call this function to register a single instance. See
+* sp_register_instance for how new and existing instances are handled.
+*
+* All of the "DEFAULT" parameters is optional because there are so many of
+* them. The best use of this function is to call it with named arguments
+* and only pass data that has changed since the last call. The presumption
+* here is that only automated systems will invoke this.
+*/
+CREATE OR REPLACE FUNCTION sp_instance_checkin(
+  sHerd VARCHAR,
+  sHost VARCHAR,
+  nPort INT,
+  sVer VARCHAR DEFAULT NULL,
+  bOnline BOOLEAN DEFAULT NULL,
+  sDataDir VARCHAR DEFAULT NULL,
+  sMasterHost VARCHAR DEFAULT NULL,
+  nXlog BIGINT DEFAULT NULL
+)
+RETURNS VOID
+AS $$
+  SELECT utility.sp_register_instance(
+    NULL, sHerd, sHost, nPort, sVer, bOnline, sDataDir, sMasterHost, nXlog
+  );
+$$ LANGUAGE SQL;
+
+
+/**
+* Replace the replication topology reported by one instance
+*
+* Rather than estimating lag by matching xlog positions reported by separate
+* hosts, each instance reports the standbys streaming from it, as seen in its
+* own pg_stat_replication view. This function records that report as-is.
+*
+* Each element of the JSON array is an object describing one standby, with
+* these keys: sName, sClientAddr, sState, sSyncState, nSent, nWrite, nFlush,
+* nReplay, nLagBytes, and fLagSeconds. An empty array means no standbys are
+* currently attached.
+*
+* @param sHost String of the hostname of the reporting instance.
+* @param nPort Port number of the reporting instance.
+* @param jStandbys JSON array of standby objects.
+*
+* @return INT Number of standbys recorded.
+*/
+CREATE OR REPLACE FUNCTION sp_replication_checkin(
+  sHost VARCHAR,
+  nPort INT,
+  jStandbys JSON
+)
+RETURNS INT
+AS $$
+DECLARE
+  nCount INT;
+BEGIN
+  DELETE FROM utility.ele_replication
+   WHERE hostname = lower(sHost)
+     AND db_port = nPort;
+
+  INSERT INTO utility.ele_replication (
+      hostname, db_port, standby, client_addr, state, sync_state,
+      sent_pos, write_pos, flush_pos, replay_pos, lag_bytes, lag_seconds
+  )
+  SELECT lower(sHost), nPort, s->>'sName', s->>'sClientAddr', s->>'sState',
+         s->>'sSyncState', (s->>'nSent')::BIGINT, (s->>'nWrite')::BIGINT,
+         (s->>'nFlush')::BIGINT, (s->>'nReplay')::BIGINT,
+         (s->>'nLagBytes')::BIGINT, (s->>'fLagSeconds')::FLOAT
+    FROM json_array_elements(jStandbys) s;
+
+  GET DIAGNOSTICS nCount = ROW_COUNT;
+
+  RETURN nCount;
+
+END;
+$$ LANGUAGE plpgsql;
+
+
+/**
+* Replace the database statistics reported by one instance
+*
+* Each element of the JSON array is an object describing one database, with
+* these keys: sDatabase, fStatsTime, fDetailTime, nSizeBytes, nTables,
+* nTableBytes, nBloatBytes, nDeadTuples, nBackends, nCommits, nRollbacks,
+* nBlocksRead, nBlocksHit, nInserted, nUpdated, nDeleted, nTempBytes, and
+* nDeadlocks. Times are in seconds since the epoch. Any statistic that hasn't
+* been collected yet may be null.
+*
+* @param sHost String of the hostname of the reporting instance.
+* @param nPort Port number of the reporting instance.
+* @param jDatabases JSON array of database objects.
+*
+* @return INT Number of databases recorded.
+*/
+CREATE OR REPLACE FUNCTION sp_database_checkin(
+  sHost VARCHAR,
+  nPort INT,
+  jDatabases JSON
+)
+RETURNS INT
+AS $$
+DECLARE
+  nCount INT;
+BEGIN
+  DELETE FROM utility.ele_database
+   WHERE hostname = lower(sHost)
+     AND db_port = nPort;
+
+  INSERT INTO utility.ele_database (
+      hostname, db_port, datname, size_bytes, tables, table_bytes,
+      bloat_bytes, dead_tuples, backends, xact_commit, xact_rollback,
+      blks_read, blks_hit, tup_inserted, tup_updated, tup_deleted,
+      temp_bytes, deadlocks, stats_at, detail_at
+  )
+  SELECT lower(sHost), nPort, d->>'sDatabase', (d->>'nSizeBytes')::BIGINT,
+         (d->>'nTables')::BIGINT, (d->>'nTableBytes')::BIGINT,
+         (d->>'nBloatBytes')::BIGINT, (d->>'nDeadTuples')::BIGINT,
+         (d->>'nBackends')::INT, (d->>'nCommits')::BIGINT,
+         (d->>'nRollbacks')::BIGINT, (d->>'nBlocksRead')::BIGINT,
+         (d->>'nBlocksHit')::BIGINT, (d->>'nInserted')::BIGINT,
+         (d->>'nUpdated')::BIGINT, (d->>'nDeleted')::BIGINT,
+         (d->>'nTempBytes')::BIGINT, (d->>'nDeadlocks')::BIGINT,
+         to_timestamp((d->>'fStatsTime')::FLOAT),
+         to_timestamp((d->>'fDetailTime')::FLOAT)
+    FROM json_array_elements(jDatabases) d;
+
+  GET DIAGNOSTICS nCount = ROW_COUNT;
+
+  RETURN nCount;
+
+END;
+$$ LANGUAGE plpgsql;
+
+
+/**
+* Register information or changes for every instance on a host at once
+*
+* Rather than calling sp_instance_checkin once per instance, remote systems
+* can send their whole inventory in a single call. The server is discovered
+* once for the entire batch, and each instance is then registered in turn.
+*
+* Each element of the JSON array should be an object using the same keys as
+* the sp_instance_checkin parameter names: sHerd, nPort, sVer, bOnline,
+* sDataDir, sMasterHost, and nXlog. Just as with that function, any key
+* other than sHerd and nPort may be omitted if it hasn't changed.
+*
+* Objects may also include an aStandbys key, holding the replication
+* topology of that instance. See sp_replication_checkin.
+*
+* Instances that can't be registered yet, because no herd or environment
+* was found for them, are returned so the caller can send them in full
+* again later, once the herd exists.
+*
+* @param sHost String of the hostname for all of these instances.
+* @param jInstances JSON array of instance objects.
+*
+* @return INT[] Ports of any instances that couldn't be registered.
+*/
+DROP FUNCTION IF EXISTS sp_instance_checkin_batch(VARCHAR, JSON);
+
+CREATE OR REPLACE FUNCTION sp_instance_checkin_batch(
+  sHost VARCHAR,
+  jInstances JSON
+)
+RETURNS INT[]
+AS $$
+DECLARE
+  jInst    JSON;
+  nSrv     INT;
+  aSkipped INT[] := '{}';
+BEGIN
+  nSrv = utility.sp_discover_server(sHost);
+
+  FOR jInst IN SELECT json_array_elements(jInstances)
+  LOOP
+    IF NOT utility.sp_register_instance(
+      nSrv, jInst->>'sHerd', sHost, (jInst->>'nPort')::INT,
+      jInst->>'sVer', (jInst->>'bOnline')::BOOLEAN, jInst->>'sDataDir',
+      jInst->>'sMasterHost', (jInst->>'nXlog')::BIGINT
+    ) THEN
+      aSkipped = aSkipped || (jInst->>'nPort')::INT;
+    END IF;
+
+    IF jInst->>'aStandbys' IS NOT NULL THEN
+      PERFORM utility.sp_replication_checkin(
+        sHost, (jInst->>'nPort')::INT, jInst->'aStandbys'
+      );
+    END IF;
+  END LOOP;
+
+  RETURN aSkipped;
+
+END;
+$$ LANGUAGE plpgsql;
+
+
+/**
+* Merge every staged instance into the instance table in one statement
+*
+* Bulk check-ins COPY their instances into ele_instance_stage, then call this
+* function in the same transaction. The result is the same as calling
+* sp_instance_checkin for each staged row, but servers, herds, masters, and
+* existing instances are resolved for the whole set at once with joins,
+* rather than with several lookups per instance. That makes re-registering
+* an entire fleet, such as after an admin failover, far faster.
+*
+* As with sp_register_instance, NULL columns mean "unchanged", the highest
+* version wins, existing rows are only written when something changed, and
+* new instances are only inserted when a herd can be found for them. If
+* several herds or lead instances match a staged row, only the one with the
+* lowest ID is used, so each staged row is merged exactly once.
+*
+* Only rows staged by the current session are merged, and they're removed
+* afterwards.
+*
+* @return INT[] Ports of any staged instances that couldn't be registered,
+*     as with sp_instance_checkin_batch.
+*/
+DROP FUNCTION IF EXISTS sp_instance_merge();
+
+CREATE OR REPLACE FUNCTION sp_instance_merge()
+RETURNS INT[]
+AS $$
+DECLARE
+  aSkipped INT[];
+BEGIN
+  -- Register any servers we haven't seen before. As with
+  -- sp_discover_server, these will need an environment before their
+  -- instances can be inserted.
+
+  INSERT INTO utility.ele_server (hostname)
+  SELECT DISTINCT lower(st.hostname)
+    FROM utility.ele_instance_stage st
+   WHERE st.backend_pid = pg_backend_pid()
+     AND NOT EXISTS (SELECT 1 FROM utility.ele_server s
+                      WHERE s.hostname = lower(st.hostname));
+
+  WITH flat AS (
+    SELECT i.*, s.hostname, h.base_name, h.db_port, h.pgdata AS herd_pgdata
+      FROM utility.ele_instance i
+      JOIN utility.ele_herd h USING (herd_id)
+      JOIN utility.ele_server s ON (s.server_id = i.server_id)
+  ),
+  staged AS (
+    SELECT DISTINCT ON (lower(hostname), herd, db_port)
+           lower(hostname) AS hostname, herd, db_port, version, is_online,
+           pgdata, lower(master_host) AS master_host, xlog_pos
+      FROM utility.ele_instance_stage
+     WHERE backend_pid = pg_backend_pid()
+     ORDER BY lower(hostname), herd, db_port
+  ),
+  resolved AS (
+    SELECT DISTINCT ON (st.hostname, st.herd, st.db_port)
+           st.*, s.server_id, cur.instance_id,
+           cur.is_online AS cur_online, cur.master_id AS cur_master,
+           cur.version AS cur_version, cur.local_pgdata AS cur_pgdata,
+           cur.xlog_pos AS cur_xlog, cur.herd_pgdata AS cur_herd_pgdata,
+           lead.instance_id AS lead_id,
+           COALESCE(lead.herd_id, env.herd_id) AS new_herd_id,
+           CASE WHEN lead.instance_id IS NULL THEN env.pgdata
+                ELSE lead.herd_pgdata END AS new_herd_pgdata
+      FROM staged st
+      JOIN utility.ele_server s ON (s.hostname = st.hostname)
+      LEFT JOIN flat cur ON (cur.hostname = st.hostname
+                             AND cur.base_name = st.herd
+                             AND cur.db_port = st.db_port)
+      LEFT JOIN flat lead ON (lead.hostname = st.master_host
+                              AND lead.base_name = st.herd
+                              AND lead.db_port = st.db_port)
+      LEFT JOIN utility.ele_herd env ON (env.base_name = lower(st.herd)
+                                         AND env.db_port = st.db_port
+                                         AND env.environment_id =
+                                             s.environment_id)
+     ORDER BY st.hostname, st.herd, st.db_port, cur.instance_id,
+              lead.instance_id, env.herd_id
+  ),
+  merged AS (
+    SELECT r.*,
+           COALESCE(r.is_online, r.cur_online) AS new_online,
+           COALESCE(r.lead_id, r.cur_master) AS new_master,
+           array_to_string(
+             GREATEST(
+               string_to_array(r.cur_version, '.')::INT[],
+               string_to_array(r.version, '.')::INT[]
+             ), '.'
+           ) AS new_version,
+           CASE WHEN r.pgdata IS NULL THEN r.cur_pgdata
+                WHEN r.pgdata != r.cur_herd_pgdata THEN r.pgdata
+                ELSE '' END AS new_pgdata,
+           COALESCE(r.xlog_pos, r.cur_xlog) AS new_xlog
+      FROM resolved r
+  ),
+  updated AS (
+    UPDATE utility.ele_instance i
+       SET is_online = m.new_online,
+           master_id = m.new_master,
+           version = m.new_version,
+           local_pgdata = m.new_pgdata,
+           xlog_pos = m.new_xlog
+      FROM merged m
+     WHERE i.instance_id = m.instance_id
+       AND (m.new_online, m.new_master, m.new_version, m.new_pgdata,
+            m.new_xlog)
+             IS DISTINCT FROM
+           (m.cur_online, m.cur_master, m.cur_version, m.cur_pgdata,
+            m.cur_xlog)
+    RETURNING 1
+  ),
+  inserted AS (
+    INSERT INTO utility.ele_instance (
+        version, local_pgdata, is_online, herd_id, server_id, master_id
+    )
+    SELECT version,
+           CASE WHEN pgdata != new_herd_pgdata THEN pgdata ELSE '' END,
+           is_online, new_herd_id, server_id, lead_id
+      FROM merged
+     WHERE instance_id IS NULL
+       AND new_herd_id IS NOT NULL
+    RETURNING 1
+  )
+  -- The updated and inserted statements run to completion whether or not
+  -- their results are read. What's left is any new instance with no herd.
+
+  SELECT INTO aSkipped
+         COALESCE(array_agg(db_port ORDER BY db_port), '{}')
+    FROM merged
+   WHERE instance_id IS NULL
+     AND new_herd_id IS NULL;
+
+  DELETE FROM utility.ele_instance_stage
+   WHERE backend_pid = pg_backend_pid();
+
+  RETURN aSkipped;
 
 END;
 $$ LANGUAGE plpgsql;